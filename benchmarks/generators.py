@@ -0,0 +1,188 @@
+"""Synthetic evidence generators for the preprocessor benchmarks.
+Peptides are drawn from the isoforms of a FASTA file, so every generated row maps to the protein."""
+import csv
+import random
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from Bio import SeqIO
+
+# modification name: (modified residues, mass used by MS Fragger)
+MODIFICATIONS = {
+    'Phospho': ('STY', '79.9663'),
+    'Acetyl': ('K', '42.0106'),
+    'Methyl': ('KR', '14.0157'),
+    'GG': ('K', '114.0429'),
+    'Citrullination': ('R', '0.9840'),
+}
+
+
+@dataclass
+class PeptideRow:
+    """One identified peptide with its modifications as (1-based position in the peptide, modification)."""
+    accession: str
+    peptide: str
+    previous_aa: str
+    mods: list[tuple[int, str]] = field(default_factory=list)
+    experiment: str = ''
+
+
+def read_isoforms(fasta_file: Path | str, aligned_fasta_file: Path | str, isoforms: int | None = None) -> list[tuple[str, str, int]]:
+    """Return (accession, sequence, end of the sampled region) of the first isoforms of the FASTA file.
+    Peptides are only drawn in front of the first gap in the alignment of an isoform, so that every
+    generated site maps onto the aligned sequence."""
+    aligned = {record.id: str(record.seq) for record in SeqIO.parse(aligned_fasta_file, 'fasta')}
+    records = []
+    for record in SeqIO.parse(fasta_file, 'fasta'):
+        first_gap = aligned[record.id].find('-')
+        records.append((record.id.split('|')[1], str(record.seq), len(record.seq) if first_gap == -1 else first_gap))
+    return records[:isoforms] if isoforms else records
+
+
+def generate_peptide_rows(fasta_file: Path | str, aligned_fasta_file: Path | str, rows: int, experiments: list[str],
+                          isoforms: int | None = None, mods_per_peptide: int = 2, seed: int = 0) -> list[PeptideRow]:
+    """Sample peptides of the isoforms with up to mods_per_peptide modifications, assigned to random experiments."""
+    rng = random.Random(seed)
+    sequences = read_isoforms(fasta_file, aligned_fasta_file, isoforms)
+    # a pool of distinct peptide forms that is observed repeatedly, like in real evidence files
+    pool = []
+    for _ in range(max(1, rows // 4)):
+        accession, sequence, end = rng.choice(sequences)
+        length = rng.randint(7, 20)
+        start = rng.randint(1, end - length)
+        peptide = sequence[start:start + length]
+        candidates = [(i + 1, name) for i, aa in enumerate(peptide)
+                      for name, (residues, _) in MODIFICATIONS.items() if aa in residues]
+        mods = rng.sample(candidates, min(len(candidates), rng.randint(0, mods_per_peptide)))
+        # at most one modification per residue
+        mods = sorted(dict(mods).items())
+        pool.append((accession, peptide, sequence[start - 1], mods))
+    return [PeptideRow(*rng.choice(pool), experiment=rng.choice(experiments)) for _ in range(rows)]
+
+
+def write_groups_csv(groups_file: Path, file_names: list[str]):
+    """Write a groups.csv with one group per experiment."""
+    with groups_file.open('w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file_name', 'group_name', 'replicate'])
+        for i, file_name in enumerate(file_names):
+            writer.writerow([file_name, f'Group {i % 3}', ''])
+
+
+def write_max_quant(peptide_rows: list[PeptideRow], evidence_file: Path):
+    """Write a MaxQuant evidence.txt."""
+    with evidence_file.open('w', encoding='utf-8') as f:
+        f.write('\t'.join(['Sequence', 'Length', 'Modifications', 'Modified sequence', 'Proteins', 'Experiment', 'PEP']) + '\n')
+        for row in peptide_rows:
+            modified = list(row.peptide)
+            for position, name in reversed(row.mods):
+                modified.insert(position, f'({name} ({row.peptide[position - 1]}))')
+            modifications = '; '.join(f'{name} ({row.peptide[position - 1]})' for position, name in row.mods) or 'Unmodified'
+            f.write('\t'.join([row.peptide, str(len(row.peptide)), modifications, f"_{''.join(modified)}_",
+                               row.accession, row.experiment, '0.001']) + '\n')
+
+
+def write_ms_fragger(peptide_rows: list[PeptideRow], experiments: list[str], tsv_file: Path):
+    """Write an MS Fragger combined_modified_peptide.tsv with one intensity column per experiment."""
+    forms = {}
+    for row in peptide_rows:
+        modified = list(row.peptide)
+        for position, name in reversed(row.mods):
+            modified.insert(position, f'[{MODIFICATIONS[name][1]}]')
+        key = (row.accession, row.peptide, ''.join(modified))
+        forms.setdefault(key, set()).add(row.experiment)
+    with tsv_file.open('w', encoding='utf-8') as f:
+        f.write('\t'.join(['Peptide Sequence', 'Modified Sequence', 'Protein ID'] + [f'{experiment} Intensity' for experiment in experiments]) + '\n')
+        for (accession, peptide, modified), observed in forms.items():
+            intensities = ['1.0' if experiment in observed else '0.0' for experiment in experiments]
+            f.write('\t'.join([peptide, modified, accession] + intensities) + '\n')
+
+
+def write_mascot(peptide_rows: list[PeptideRow], experiments: list[str], mascot_dir: Path):
+    """Write one Mascot CSV export per experiment (file name)."""
+    mod_ids = {name: i + 1 for i, name in enumerate(MODIFICATIONS)}
+    mascot_dir.mkdir(parents=True, exist_ok=True)
+    for experiment in experiments:
+        with (mascot_dir / experiment).open('w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerows([[], ['Header', '-' * 56], [], ['synthetic'], [],
+                              ['Variable modifications', '-' * 56], [],
+                              ['Identifier', 'Name', 'Delta']])
+            for name, (residues, mass) in MODIFICATIONS.items():
+                writer.writerow([mod_ids[name], f'{name} ({residues})', mass])
+            writer.writerows([[], ['Protein hits', '-' * 56], [],
+                              ['prot_hit_num', 'prot_acc', 'pep_seq', 'pep_var_mod', 'pep_var_mod_pos']])
+            for row in peptide_rows:
+                if row.experiment != experiment:
+                    continue
+                positions = ['0'] * len(row.peptide)
+                for position, name in row.mods:
+                    positions[position - 1] = str(mod_ids[name])
+                var_mod = '; '.join(f'{name} ({row.peptide[position - 1]})' for position, name in row.mods)
+                writer.writerow([1, row.accession, row.peptide, var_mod, f"0.{''.join(positions)}.0" if row.mods else ''])
+
+
+def write_protein_pilot(peptide_rows: list[PeptideRow], experiments: list[str], protein_pilot_dir: Path):
+    """Write one ProteinPilot workbook with peptide summary and FDR sheet per experiment (file name)."""
+    import openpyxl
+
+    protein_pilot_dir.mkdir(parents=True, exist_ok=True)
+    for experiment in experiments:
+        workbook = openpyxl.Workbook()
+        summary = workbook.active
+        summary.title = 'Peptide Summary'
+        summary.append(['N', 'Accessions', 'Conf', 'Sequence', 'Modifications', 'ProteinModifications', 'Cleavages'])
+        for row in peptide_rows:
+            if row.experiment != experiment:
+                continue
+            mods = '; '.join(f'{name}({row.peptide[position - 1]})@{position}' for position, name in row.mods)
+            summary.append([1, f'|{row.accession}', 99.0, row.peptide, mods, '',
+                            f'cleaved {row.previous_aa}-{row.peptide[0]}@N-term'])
+        fdr = workbook.create_sheet('Distinct Peptide Level Data')
+        fdr.append(['Fit Confidence Threshold', 'Fit Global FDR', 'Fit Local FDR'])
+        for threshold, global_fdr in ((0.99, 0.001), (0.95, 0.01), (0.5, 0.5)):
+            fdr.append([threshold, global_fdr, global_fdr])
+        workbook.save(protein_pilot_dir / experiment)
+
+
+def shared_region_end(aligned_fasta_file: Path | str) -> int:
+    """Return the number of leading alignment columns that are identical in all isoforms."""
+    aligned = [str(record.seq) for record in SeqIO.parse(aligned_fasta_file, 'fasta')]
+    for column, residues in enumerate(zip(*aligned)):
+        if len(set(residues)) > 1:
+            return column
+    return min(len(sequence) for sequence in aligned)
+
+
+def write_result_csv(result_file: Path, fasta_file: Path | str, aligned_fasta_file: Path | str, sites: int, samples: int,
+                     kind: str = 'mods', groups: tuple[str, ...] = ('CTRL', 'FTLD-Tau', 'FTLD-PiD'), seed: int = 0):
+    """Write a preprocessor result CSV with the given number of sites (columns) and samples (rows).
+    Sites are placed on the part of the sequence shared by all isoforms. Beyond the number of possible
+    sites, sites are repeated."""
+    rng = random.Random(seed)
+    sequence = read_isoforms(fasta_file, aligned_fasta_file, 1)[0][1][:shared_region_end(aligned_fasta_file)]
+    if kind == 'mods':
+        candidates = [(position, name, f'{aa}{position}') for position, aa in enumerate(sequence, start=1)
+                      for name, (residues, _) in MODIFICATIONS.items() if aa in residues]
+    else:
+        candidates = [(position, 'Non-Tryptic', str(position)) for position in range(1, len(sequence) + 1)]
+        candidates += [(position, 'Non-Tryptic', f'{position}-{position + 2}') for position in range(1, len(sequence) - 1)]
+    chosen = rng.sample(candidates, min(sites, len(candidates)))
+    chosen += rng.choices(candidates, k=sites - len(chosen))
+    chosen.sort(key=lambda site: site[0])
+
+    with result_file.open('w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        if kind == 'mods':
+            writer.writerow(['ID', 'Group'] + [f'{name}({label[0]})@{position}_general' for position, name, label in chosen])
+        else:
+            writer.writerow(['ID', 'Group'] + [f'{label}_general' for _, _, label in chosen])
+        writer.writerow(['', ''] + [name for _, name, _ in chosen])
+        writer.writerow(['', ''] + [label for _, _, label in chosen])
+        writer.writerow(['', ''] + ['general'] * len(chosen))
+        for sample in range(samples):
+            if kind == 'mods':
+                values = [int(rng.random() < 0.3) for _ in chosen]
+            else:
+                values = [round(rng.random(), 3) for _ in chosen]
+            writer.writerow([f'sample_{sample}', groups[sample % len(groups)]] + values)
@@ -0,0 +1,189 @@
+"""Rendering benchmark for the plotters on synthetic result files.
+Every case runs in a fresh process. The time is split into CSV loading, sequence layout,
+figure construction by the plotter and export, and the size of the resulting figure is recorded."""
+import argparse
+import functools
+import json
+import multiprocessing
+import tempfile
+import time
+import traceback
+import warnings
+from collections import defaultdict
+from pathlib import Path
+
+from benchmarks import generators
+from benchmarks.preprocessor_benchmark import ALIGNED_FASTA_FILE, FASTA_FILE, load_config
+from protein_sequencing import static_export
+
+PLOTS = ('bar', 'details', 'overview')
+GROUPS = ('CTRL', 'FTLD-Tau', 'FTLD-PiD')
+
+
+class PhaseTimer:
+    """Wrap functions to accumulate their exclusive wall time per phase.
+    Time spent in a nested wrapped function is only counted for the inner phase."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self._stack = []
+        self._patched = []
+
+    def wrap(self, owner, attribute: str, phase: str):
+        """Replace owner.attribute by a timed version."""
+        original = getattr(owner, attribute)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            self._stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                children = self._stack.pop()
+                self.totals[phase] += elapsed - children
+                if self._stack:
+                    self._stack[-1] += elapsed
+
+        setattr(owner, attribute, timed)
+        self._patched.append((owner, attribute, original))
+
+    def restore(self):
+        """Restore all wrapped functions."""
+        for owner, attribute, original in reversed(self._patched):
+            setattr(owner, attribute, original)
+        self._patched.clear()
+
+
+def run_case(plot: str, sites: int, samples: int, width: int, height: int, export_formats: tuple[str, ...],
+             export_backend: str = 'auto') -> dict:
+    """Generate the input of one case, render it and return the measurements.
+    A case the plotter cannot draw at this figure size, e.g. with more bars than fit, is returned as skipped with the reason."""
+    import pandas as pd
+    from protein_sequencing import exon_helper, sequence_plot, static_export, utils
+    from protein_sequencing.bar_plot import BarPlotter
+    from protein_sequencing.details_plot import DetailsPlotter
+    from protein_sequencing.layout import Layout
+    from protein_sequencing.overview_plot import OverviewPlotter
+
+    # keep the table readable, the plotters assign to slices of the input frames
+    warnings.simplefilter('ignore', pd.errors.SettingWithCopyWarning)
+    warnings.filterwarnings('ignore', message='.*cleavage labels are left out')
+    result = {'plot': plot, 'sites': sites, 'samples': samples, 'figure_size': f'{width}x{height}'}
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        # the plotters remove all files in the output folder, so the input lives next to it
+        input_dir = work_dir / 'input'
+        output_dir = work_dir / 'output'
+        input_dir.mkdir()
+        output_dir.mkdir()
+        mods_file = input_dir / 'result_mods.csv'
+        cleavages_file = input_dir / 'result_cleavages.csv'
+        generators.write_result_csv(mods_file, FASTA_FILE, ALIGNED_FASTA_FILE, sites, samples, 'mods', GROUPS)
+        generators.write_result_csv(cleavages_file, FASTA_FILE, ALIGNED_FASTA_FILE, sites, samples, 'cleavages', GROUPS)
+
+        config = load_config('configs.default_config', FIGURE_WIDTH=width, FIGURE_HEIGHT=height, OUTPUT_FOLDER=str(output_dir))
+        sequence_plot.CONFIG = config
+        utils.CONFIG = config
+        plot_settings = {'SAVE_PLOT': False, 'SHOW_PLOT': False}
+        if plot == 'bar':
+            plot_config = load_config('configs.default_bar', BAR_INPUT_FILE=str(mods_file),
+                                      BAR_GROUPS={group: group for group in GROUPS}, **plot_settings)
+            plotter_class, create = BarPlotter, 'create_bar_plot'
+        elif plot == 'details':
+            plot_config = load_config('configs.default_details',
+                                      INPUT_FILES={'A': ('PTM', str(mods_file)), 'B': ('Cleavage', str(cleavages_file))}, **plot_settings)
+            plotter_class, create = DetailsPlotter, 'create_details_plot'
+        else:
+            plot_config = load_config('configs.default_overview', INPUT_FILE=str(mods_file), **plot_settings)
+            plotter_class, create = OverviewPlotter, 'create_overview_plot'
+
+        timer = PhaseTimer()
+        timer.wrap(pd, 'read_csv', 'csv_load')
+        timer.wrap(OverviewPlotter, 'get_present_modifications', 'csv_load')
+        timer.wrap(OverviewPlotter, 'get_modifications_per_position', 'csv_load')
+        timer.wrap(exon_helper, 'retrieve_exon', 'exon_detection')
+        timer.wrap(sequence_plot, 'create_plot', 'sequence_layout')
+        for owner, attribute in ((BarPlotter, 'add_bar_plot'), (DetailsPlotter, 'plot_cleavages'),
+                                 (DetailsPlotter, 'plot_ptms'), (OverviewPlotter, 'plot_labels'), (Layout, 'to_figure')):
+            timer.wrap(owner, attribute, 'figure')
+        start = time.perf_counter()
+        try:
+            fig = getattr(plotter_class(config, plot_config, FASTA_FILE, str(output_dir)), create)()
+        except (AssertionError, ValueError) as e:
+            # the limits of the plotters are reported with assertions and ValueErrors
+            frame = traceback.extract_tb(e.__traceback__)[-1]
+            result['skipped'] = f'{type(e).__name__} in {Path(frame.filename).name}:{frame.lineno} {e}'.strip()
+            return result
+        finally:
+            timer.restore()
+        result['phases'] = dict(timer.totals)
+        result['total'] = time.perf_counter() - start
+        result['phases']['other'] = result['total'] - sum(timer.totals.values())
+
+        result['traces'] = len(fig.data)
+        result['shapes'] = len(fig.layout.shapes)
+        result['annotations'] = len(fig.layout.annotations)
+        result['json_bytes'] = len(fig.to_json())
+        for image_format in export_formats:
+            output_file = output_dir / f'figure1.{image_format}'
+            start = time.perf_counter()
+            static_export.write_image(fig, output_file, export_backend)
+            result['phases'][f'export_{image_format}'] = time.perf_counter() - start
+            result[f'{image_format}_bytes'] = output_file.stat().st_size
+    return result
+
+
+def main():
+    """Run the rendering benchmark over all combinations of plot type, sites, samples and figure size."""
+    parser = argparse.ArgumentParser(description='Benchmark the plotters on synthetic result files.')
+    parser.add_argument('-p', '--plot', nargs='+', choices=PLOTS, default=list(PLOTS), help='Plot types to benchmark. Default=all')
+    parser.add_argument('--sites', type=int, nargs='+', default=[100, 1000, 10000], help='Number of sites. Default=100 1000 10000')
+    parser.add_argument('--samples', type=int, nargs='+', default=[10, 100, 1000], help='Number of samples. Default=10 100 1000')
+    parser.add_argument('--figure-sizes', nargs='+', default=['1200x1000'], help='Figure sizes as WIDTHxHEIGHT. Default=1200x1000')
+    parser.add_argument('--no-export', action='store_true', help='Skip the png and svg export.')
+    parser.add_argument('--export-backend', choices=static_export.EXPORT_BACKENDS, default='auto',
+                        help='Backend of the png and svg export. Default=auto (kaleido if installed, otherwise native)')
+    parser.add_argument('-o', '--output', default=None, help='Write the results as JSON to this file.')
+    args = parser.parse_args()
+
+    export_formats = () if args.no_export else tuple(image_format for image_format in ('png', 'svg')
+                                                     if static_export.format_available(image_format, args.export_backend))
+    if not args.no_export and len(export_formats) < 2:
+        print(f"The {args.export_backend} export backend cannot write {' and '.join({'png', 'svg'} - set(export_formats))}, "
+              f"this export is skipped.")
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    print(f"{'plot':<10}{'sites':>7}{'samples':>9}{'size':>11}{'csv':>8}{'exons':>8}{'layout':>8}{'figure':>8}"
+          f"{'export':>8}{'total':>8}{'traces':>8}{'shapes':>8}{'annot.':>8}")
+    for size in args.figure_sizes:
+        width, height = (int(value) for value in size.split('x'))
+        for plot in args.plot:
+            for sites in args.sites:
+                for samples in args.samples:
+                    with context.Pool(1) as pool:
+                        result = pool.apply(run_case, (plot, sites, samples, width, height, export_formats, args.export_backend))
+                    results.append(result)
+                    prefix = f"{plot:<10}{sites:>7}{samples:>9}{size:>11}"
+                    if 'skipped' in result:
+                        print(f"{prefix}  skipped: {result['skipped']}")
+                        continue
+                    phases = result['phases']
+                    export_time = phases.get('export_png', 0) + phases.get('export_svg', 0)
+                    print(f"{prefix}{phases.get('csv_load', 0):>8.3f}{phases.get('exon_detection', 0):>8.3f}"
+                          f"{phases.get('sequence_layout', 0):>8.3f}{phases.get('figure', 0):>8.3f}{export_time:>8.3f}"
+                          f"{result['total'] + export_time:>8.3f}{result['traces']:>8}{result['shapes']:>8}{result['annotations']:>8}")
+
+    skipped = sum('skipped' in result for result in results)
+    if skipped:
+        print(f"\n{skipped} of {len(results)} cases were skipped, the plotter cannot draw them at the figure size.")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
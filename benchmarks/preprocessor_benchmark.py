@@ -0,0 +1,127 @@
+"""Throughput benchmark for the preprocessors on synthetic evidence files.
+Every preprocessor runs in a fresh process, which reports the wall time and its peak RSS."""
+import argparse
+import importlib
+import json
+import multiprocessing
+import resource
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from benchmarks import generators
+
+FASTA_FILE = 'tests/test_data/input.fasta'
+ALIGNED_FASTA_FILE = 'tests/test_data/aligned.fasta'
+PREPROCESSORS = ('max_quant', 'ms_fragger', 'mascot', 'protein_pilot')
+
+
+def load_config(module: str, **overrides) -> SimpleNamespace:
+    """Copy the settings of a config module and override single settings."""
+    config = importlib.import_module(module)
+    settings = {name: getattr(config, name) for name in dir(config) if name.isupper()}
+    settings.update(overrides)
+    return SimpleNamespace(**settings)
+
+
+def prepare(name: str, work_dir: Path, args) -> tuple[SimpleNamespace, SimpleNamespace, int]:
+    """Generate the input files of a preprocessor and return its configs and the number of generated rows."""
+    if name in ('mascot', 'protein_pilot'):
+        suffix = '.csv' if name == 'mascot' else '.xlsx'
+        experiments = [f'experiment_{i}{suffix}' for i in range(args.experiments)]
+    else:
+        experiments = [f'Experiment {i}' for i in range(args.experiments)]
+    rows = generators.generate_peptide_rows(FASTA_FILE, ALIGNED_FASTA_FILE, args.rows, experiments, args.isoforms, args.mods_per_peptide, args.seed)
+
+    overrides = {'FASTA_FILE': FASTA_FILE, 'GROUPS_CSV': str(work_dir / 'groups.csv')}
+    generators.write_groups_csv(work_dir / 'groups.csv', experiments)
+    if name == 'max_quant':
+        generators.write_max_quant(rows, work_dir / 'evidence.txt')
+        overrides['MAX_QUANT_FILE'] = str(work_dir / 'evidence.txt')
+    elif name == 'ms_fragger':
+        generators.write_ms_fragger(rows, experiments, work_dir / 'combined_modified_peptide.tsv')
+        overrides['MS_FRAGGER_FILE'] = str(work_dir / 'combined_modified_peptide.tsv')
+    elif name == 'mascot':
+        generators.write_mascot(rows, experiments, work_dir / 'mascot')
+        overrides['MASCOT_INPUT_DIR'] = f"{work_dir / 'mascot'}/"
+    else:
+        generators.write_protein_pilot(rows, experiments, work_dir / 'protein_pilot')
+        overrides['PROTEIN_PILOT_INPUT_DIR'] = f"{work_dir / 'protein_pilot'}/"
+
+    config = load_config('tests.configs.default_config', OUTPUT_FOLDER=f"{work_dir / 'output'}/")
+    preprocessor_config = load_config(f'tests.configs.{name}_config', **overrides)
+    Path(config.OUTPUT_FOLDER).mkdir(parents=True, exist_ok=True)
+    return config, preprocessor_config, len(rows)
+
+
+def run_preprocessor(name: str, config: SimpleNamespace, preprocessor_config: SimpleNamespace) -> tuple[float, float, float]:
+    """Run a preprocessor in the current process and return wall time, peak RSS and RSS before the run in MB."""
+    if name == 'max_quant':
+        from protein_sequencing.data_preprocessing.max_quant_preprocessor import MaxQuantPreprocessor as Preprocessor
+    elif name == 'ms_fragger':
+        from protein_sequencing.data_preprocessing.ms_fragger_preprocessor import MSFraggerPreprocessor as Preprocessor
+    elif name == 'mascot':
+        from protein_sequencing.data_preprocessing.mascot_preprocessor import MascotPreprocessor as Preprocessor
+    else:
+        from protein_sequencing.data_preprocessing.protein_pilot_preprocessor import ProteinPilotPreprocessor as Preprocessor
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    Preprocessor(config, preprocessor_config)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is reported in KiB on Linux
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, start_rss / 1024
+
+
+def benchmark(name: str, args) -> dict:
+    """Run the benchmark of a preprocessor and return the best of the repeats."""
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as work_dir:
+        config, preprocessor_config, rows = prepare(name, Path(work_dir), args)
+        measurements = []
+        for _ in range(args.repeat):
+            with context.Pool(1) as pool:
+                measurements.append(pool.apply(run_preprocessor, (name, config, preprocessor_config)))
+    seconds, peak_rss, start_rss = min(measurements)
+    return {'preprocessor': name, 'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds,
+            'peak_rss_mb': peak_rss, 'rss_increase_mb': peak_rss - start_rss}
+
+
+def main():
+    """Run the preprocessor benchmarks and print rows per second and peak RSS."""
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessors on synthetic evidence files.')
+    parser.add_argument('-p', '--preprocessor', nargs='+', choices=PREPROCESSORS, default=list(PREPROCESSORS),
+                        help='Preprocessors to benchmark. Default=all')
+    parser.add_argument('--rows', type=int, default=20000, help='Number of generated evidence rows. Default=20000')
+    parser.add_argument('--experiments', type=int, default=9, help='Number of experiments (files for Mascot and ProteinPilot). Default=9')
+    parser.add_argument('--isoforms', type=int, default=None, help='Number of isoforms peptides are drawn from. Default=all')
+    parser.add_argument('--mods-per-peptide', type=int, default=2, help='Maximum number of modifications per peptide. Default=2')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generators. Default=0')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per preprocessor, the fastest is reported. Default=3')
+    parser.add_argument('-o', '--output', default=None, help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', default=None, help='JSON results of an earlier run to compare against.')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = {result['preprocessor']: result for result in json.load(f)}
+
+    results = []
+    print(f"{'preprocessor':<15}{'rows':>10}{'seconds':>10}{'rows/s':>12}{'peak RSS MB':>14}{'RSS +MB':>10}{'vs. base':>10}")
+    for name in args.preprocessor:
+        result = benchmark(name, args)
+        results.append(result)
+        ratio = ''
+        if name in baseline:
+            ratio = f"{result['rows_per_second'] / baseline[name]['rows_per_second']:.2f}x"
+        print(f"{name:<15}{result['rows']:>10}{result['seconds']:>10.3f}{result['rows_per_second']:>12.0f}"
+              f"{result['peak_rss_mb']:>14.1f}{result['rss_increase_mb']:>10.1f}{ratio:>10}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -49,6 +49,15 @@ INCLUDED_MODIFICATIONS = {'Phospho': ['S', 'T', 'Y'],
 
 # Input Output Settings
 OUTPUT_FOLDER = 'output'
+# Static export of png and svg: 'kaleido', 'native' (without a browser, png needs resvg-py or cairosvg)
+# or 'auto' (kaleido if it is installed, otherwise native)
+EXPORT_BACKEND = 'auto'
+# Debug option: raise a ValueError for invalid properties of the figures instead of leaving them out
+VALIDATE_FIGURES = False
+# Isoform alignment: 'clustalo', 'builtin' or 'auto' (Clustal Omega if it can be found, otherwise builtin)
+ALIGNER = 'auto'
+# Isoforms aligned in parallel against the longest isoform, None for one worker per core
+ALIGNMENT_WORKERS = 1
 
 # Plot Settings
 FIGURE_ORIENTATION = 0  # 0 for horizontal, 1 for vertical, note figure height and width are then automatically swapped
@@ -65,6 +74,10 @@ PTM_HIGHLIGHT_LABEL_COLOR = '#cfcfcf'
 
 # Default Parameters
 FONT = 'Arial'
+# Label widths: 'font' (glyph widths of FONT, read with fontTools if installed) or 'approximate' (FONT_SIZE / 1.5 per character)
+TEXT_MEASUREMENT = 'font'
+# Font file to measure the labels with, None to search the font folders of the system for FONT
+FONT_FILE = None
 
 # Margins for sequence Plot
 # TODO remove margins and auto calculate based on legend
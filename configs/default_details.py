@@ -38,4 +38,9 @@ GROUPS = {"CTRL": (["CTRL", "CTR", "Control"], '#4DAF4A'),
                    "FTLD-Tau": (["FTLD-Tau"], '#17DFFF'),
                    "FTLD-PiD": (["FTLD-PiD"], '#984EA3'),}
 PTM_RECT_LENGTH = 25
+# space for the labels between the sequence and the heatmaps (in pixels), PTM labels that are too close to each
+# other are spread over as many rows as fit into it
+LABEL_PLOT_HEIGHT = 150
+# adjacent sites are merged into one heatmap cell while a site is narrower than this (in pixels)
+HEATMAP_MIN_CELL_PIXELS = 4
 REGION_LABEL_ANGLE_GROUPS = 0
\ No newline at end of file
@@ -45,4 +45,9 @@ GROUPS = {
     'Exon': (['Exon'], '#984EA3'),
 }
 PTM_RECT_LENGTH = 25
+# space for the labels between the sequence and the heatmaps (in pixels), PTM labels that are too close to each
+# other are spread over as many rows as fit into it
+LABEL_PLOT_HEIGHT = 150
+# adjacent sites are merged into one heatmap cell while a site is narrower than this (in pixels)
+HEATMAP_MIN_CELL_PIXELS = 4
 REGION_LABEL_ANGLE_GROUPS = 0
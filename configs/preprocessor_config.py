@@ -9,10 +9,19 @@ ISOFORM_HELPER_DICT = { "0N3R": "P10636-2",
                         "2N4R": "P10636-8",}
 #GROUPS_CSV = 'data/groups.csv'
 GROUPS_CSV = '/home/talnawa/Desktop/protein_sequencing/data/experiment/groups.csv'
-# this is the default path where the tool will safe the alignment
-# just change if you want to supply your own alignment
-# CAUTION: the alignment must match with the fasta file
-ALIGNED_FASTA_FILE = "data/uniprot_data/aligned.fasta"
+# the isoforms are aligned with the ALIGNER of the config, the alignment is written to OUTPUT_FOLDER/aligned.fasta
+# optional memory-mapped store for the sequences, shared between worker processes
+# it is rebuilt automatically if the size or mtime of the fasta files changed, set to None to keep the sequences in memory
+SEQUENCE_STORE_FILE = None
+# folder of the partial results of sharded runs (--shard I/N), shared by all machines of the run
+# None writes them to OUTPUT_FOLDER/shards
+SHARD_DIR = None
+# proteome mode (--proteome): accessions of the proteins to process, None processes every protein family of the
+# FASTA file that is referenced by the input file, and the number of families processed in parallel (None for one per core)
+PROTEINS = None
+FAMILY_WORKERS = 1
+# faidx index of FASTA_FILE for the proteome mode, built on first use, None for FASTA_FILE.fai
+FASTA_INDEX_FILE = None
 
 # Mascot
 MASCOT_INPUT_DIR = 'data/mascot/'
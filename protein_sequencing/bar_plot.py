@@ -1,8 +1,8 @@
 """Module to create bar plots for protein sequences"""
 from collections import defaultdict
-import plotly.graph_objects as go
 import pandas as pd
-from protein_sequencing import utils, sequence_plot
+from protein_sequencing import instrumentation, utils, sequence_plot
+from protein_sequencing.layout import Layout
 
 
 class BarPlotter:
@@ -44,9 +44,10 @@ class BarPlotter:
             bar_plot_width = bar_width * max(group_size_a, group_size_b)
         return bar_plot_width
 
+    @instrumentation.traced()
     def add_bar_plot(
             self,
-            fig: go.Figure,
+            fig: Layout,
             above: str,
             modification_sites_all: dict[int, list[tuple[int, str, str, str]]],
             modification_sites_relevant: dict[int, list[tuple[int, str, str, str]]],
@@ -54,8 +55,9 @@ class BarPlotter:
             group_positions: list,
             bar_plot_width: int,
             label_plot_height: int
-    ) -> go.Figure:
+    ) -> Layout:
         """Add bar plot to sequence plot."""
+        instrumentation.count(sites=len(modification_sites_relevant), groups=len(group_positions))
         group_direction = 1 if above == 'A' else -1
         bar_width = bar_plot_width // len(group_positions)
         assert bar_width >= self.config.FONT_SIZE, f"Too many bars to plot! Bar width: {bar_width} < FONT_SIZE: {self.config.FONT_SIZE}."
@@ -66,6 +68,11 @@ class BarPlotter:
         positions_visited = 0
         bar_percentages = {group: [] for group in self.plot_config.BAR_GROUPS.keys()}
 
+        # position of the lines on the sequence for every site
+        sites = [(aa_position, modification_sight[3]) for aa_position, modification_sights in modification_sites_relevant.items()
+                 for modification_sight in modification_sights]
+        line_positions = dict(zip(sites, utils.residue_pixels([site[0] for site in sites], [site[1] for site in sites])))
+
         for aa_position in sorted(modification_sites_all.keys(), reverse=True):
             for modification_sight in modification_sites_all[aa_position]:
                 if modification_sight not in modification_sites_relevant[aa_position]:
@@ -76,9 +83,7 @@ class BarPlotter:
                 label, modification_type, _, isoform = modification_sight
                 if self.config.FIGURE_ORIENTATION == 0:
                     # x position for protein sequence
-                    position = utils.get_position_with_offset(aa_position, isoform)
-                    x_0_line = position * utils.PIXELS_PER_AA + utils.SEQUENCE_OFFSET
-                    x_0_line = utils.offset_line_for_exon(x_0_line, aa_position, self.config.FIGURE_ORIENTATION)
+                    x_0_line = line_positions[aa_position, isoform]
                     # x position for bar plot
                     x_1_line = utils.get_width() - (modifications_visited * bar_width + bar_width // 2)
                     y_0_line = utils.SEQUENCE_BOUNDARIES['y1'] if above == 'A' else utils.SEQUENCE_BOUNDARIES['y0']
@@ -128,9 +133,7 @@ class BarPlotter:
                             fillcolor=self.config.MODIFICATIONS[modification_type][1]
                         )
                 else:
-                    position = utils.get_position_with_offset(aa_position, isoform)
-                    y_0_line = utils.get_height() - (position * utils.PIXELS_PER_AA + utils.SEQUENCE_OFFSET)
-                    y_0_line = utils.offset_line_for_exon(y_0_line, aa_position, self.config.FIGURE_ORIENTATION)
+                    y_0_line = line_positions[aa_position, isoform]
                     y_1_line = modifications_visited * bar_width + bar_width // 2
                     x_0_line = utils.SEQUENCE_BOUNDARIES['x1'] if above == 'A' else utils.SEQUENCE_BOUNDARIES['x0']
                     x_1_line = x_0_line + group_direction * height_offset
@@ -205,12 +208,12 @@ class BarPlotter:
                         y_trace = y_group + max_bar_height * group_direction
                     else:
                         y_trace = y_group + round(max_bar_height / 4, 1) * j * group_direction
-                    fig.add_trace(go.Scatter(x=[x_line_start, x_line_start + bar_plot_width],
-                                             y=[y_trace, y_trace],
-                                             mode='lines',
-                                             line={'color': 'lightgray', 'width': 1},
-                                             showlegend=False,
-                                             hoverinfo='none'))
+                    fig.add_scatter(x=[x_line_start, x_line_start + bar_plot_width],
+                                    y=[y_trace, y_trace],
+                                    mode='lines',
+                                    line={'color': 'lightgray', 'width': 1},
+                                    showlegend=False,
+                                    hoverinfo='none')
                 if j % 2 == 0:
                     text = str(j * 25) + '%'
                     if self.plot_config.INVERT_AXIS_GROUP_B and above == 'B':
@@ -238,12 +241,12 @@ class BarPlotter:
                         x_trace = x_group + max_bar_height * group_direction
                     else:
                         x_trace = x_group + round(max_bar_height / 4, 1) * j * group_direction
-                    fig.add_trace(go.Scatter(x=[x_trace, x_trace],
-                                             y=[y_line_start, 0],
-                                             mode='lines',
-                                             line={'color': 'lightgray', 'width': 1},
-                                             showlegend=False,
-                                             hoverinfo='none'))
+                    fig.add_scatter(x=[x_trace, x_trace],
+                                    y=[y_line_start, 0],
+                                    mode='lines',
+                                    line={'color': 'lightgray', 'width': 1},
+                                    showlegend=False,
+                                    hoverinfo='none')
                     if j % 2 == 0:
                         text = str(j * 25) + '%'
                         if self.plot_config.INVERT_AXIS_GROUP_B and above == 'B':
@@ -268,10 +271,10 @@ class BarPlotter:
     def plot_line_with_label_horizontal(self, fig, x_0, x_1, y_0, y_1, y_2, y_3, y_label, color, label,
                                         modification_type):
         """Plot single line with label in horizontal orientation."""
-        fig.add_trace(go.Scatter(x=[x_0, x_0, x_1, x_1],
-                                 y=[y_0, y_1, y_2, y_3],
-                                 mode='lines',
-                                 line={'color': color, 'width': 1}, showlegend=False, hoverinfo='none'))
+        fig.add_scatter(x=[x_0, x_0, x_1, x_1],
+                        y=[y_0, y_1, y_2, y_3],
+                        mode='lines',
+                        line={'color': color, 'width': 1}, showlegend=False, hoverinfo='none')
         fig.add_annotation(x=x_1, y=y_label,
                            text=label,
                            showarrow=False,
@@ -292,10 +295,10 @@ class BarPlotter:
     def plot_line_with_label_vertical(self, fig, x_0, x_1, x_2, x_3, x_label, y_0, y_1, color, label,
                                       modification_type):
         """Plot single line with label in vertical orientation."""
-        fig.add_trace(go.Scatter(x=[x_0, x_1, x_2, x_3],
-                                 y=[y_0, y_0, y_1, y_1],
-                                 mode='lines',
-                                 line={'color': color, 'width': 1}, showlegend=False, hoverinfo='none'))
+        fig.add_scatter(x=[x_0, x_1, x_2, x_3],
+                        y=[y_0, y_0, y_1, y_1],
+                        mode='lines',
+                        line={'color': color, 'width': 1}, showlegend=False, hoverinfo='none')
         fig.add_annotation(x=x_label, y=y_1,
                            text=label,
                            showarrow=False,
@@ -383,8 +386,8 @@ class BarPlotter:
                 present_mod_types.add(modification_sight[1])
         return present_mod_types
 
-    def create_bar_plot(self):
-        """Main function to create bar plot."""
+    def create_bar_layout(self) -> Layout:
+        """Compute the layout of the bar plot, without creating a plotly figure."""
         all_positions, relevant_positions, df = self.filter_relevant_modification_sites(self.plot_config.BAR_INPUT_FILE)
         above_all, below_all = utils.separate_by_group(all_positions)
         above_relevant, below_relevant = utils.separate_by_group(relevant_positions)
@@ -422,6 +425,11 @@ class BarPlotter:
                 bar_plot_width=bar_plot_width,
                 label_plot_height=label_plot_height
             )
+        return fig
+
+    def create_bar_plot(self):
+        """Main function to create bar plot."""
+        fig = self.create_bar_layout().to_figure(getattr(self.config, 'VALIDATE_FIGURES', False))
 
         utils.finalize_plotting(
             fig,
@@ -0,0 +1,197 @@
+"""Batch rendering of many plots, e.g. the same figures for many subsets of the groups.
+Start with python3 plots.py batch JOBS_FILE [--workers N] [--export-concurrency N] [--timeout SECONDS].
+
+The jobs file is a JSON list of render jobs (see render_server.py), each with an output_file, or an
+object with settings shared by all jobs and the list of jobs:
+    {"defaults": {"fasta": "input.fasta", "input": "result_mods.csv", "format": "svg"},
+     "jobs": [{"plot": "bar", "plot_config_overrides": {"BAR_GROUPS": {"AD": "AD"}}, "output_file": "bar_ad.svg"}]}
+
+The figures are laid out in a process pool and exported by a pool of threads. Bounded queues between
+the stages make the jobs wait for free workers instead of piling up finished figures in memory.
+A job that exceeds its timeout is reported and the batch continues with the next jobs, but a worker
+process only becomes free again once the plotter returns. The workers check the deadline of a job before
+they write its output file or add it to the cache, so a job reported as timeout leaves neither behind.
+Jobs whose figure is in the figure cache (see figure_cache.py) are copied from it, use --no-cache to render all."""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from protein_sequencing import figure_cache, render_server, uniprot_align
+
+
+def load_jobs(jobs_file: Path | str) -> list[dict]:
+    """Read the jobs of a jobs file and apply the defaults to every job."""
+    with open(jobs_file, encoding='utf-8') as f:
+        spec = json.load(f)
+    if isinstance(spec, list):
+        return spec
+    defaults = spec.get('defaults', {})
+    return [{**defaults, **job} for job in spec['jobs']]
+
+
+def start_worker(cache: figure_cache.FigureCache | None = None):
+    """Reuse the alignments in a worker process, the jobs of a batch usually share their FASTA file."""
+    uniprot_align.ALIGNMENT_CACHE = {}
+    render_server.FIGURE_CACHE = cache
+
+
+def check_deadline(deadline: float | None):
+    """Raise a TimeoutError once the deadline of a job (time.time() seconds) has passed."""
+    if deadline is not None and time.time() > deadline:
+        raise TimeoutError('The job exceeded its timeout')
+
+
+def write_output(output_file: str, data: bytes, deadline: float | None = None):
+    """Write a figure to the output file of its job, unless the deadline of the job has passed."""
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = output_file.with_name(f'.{output_file.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    tmp_file.write_bytes(data)
+    try:
+        check_deadline(deadline)
+        os.replace(tmp_file, output_file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+def layout_job(job: dict, output_format: str, config, plot_config,
+               deadline: float | None = None) -> tuple[str | None, str | None]:
+    """Create the figure of a job with the configs loaded by check_job in a worker process and return its cache key
+    and the figure as plotly JSON. If the export is already cached, it is written to the output file and no figure is returned."""
+    if render_server.FIGURE_CACHE is None:
+        return None, render_server.create_figure(job, config, plot_config).to_json()
+    key = render_server.job_key(job, config, plot_config)
+    data = render_server.FIGURE_CACHE.get(key, output_format)
+    if data is not None:
+        write_output(job['output_file'], data, deadline)
+        return key, None
+    figure_json = render_server.FIGURE_CACHE.get(key, 'json')
+    if figure_json is None:
+        figure_json = render_server.create_figure(job, config, plot_config).to_json()
+        check_deadline(deadline)
+        render_server.FIGURE_CACHE.put(key, 'json', figure_json.encode('utf-8'))
+        return key, figure_json
+    return key, figure_json.decode('utf-8')
+
+
+def export_job(figure_json: str, output_format: str, output_file: str, cache: figure_cache.FigureCache | None = None,
+               key: str | None = None, backend: str = 'auto', deadline: float | None = None):
+    """Export a figure created by layout_job, write it to the output file and add the export to the cache."""
+    if output_format == 'json':
+        data = figure_json.encode('utf-8')
+    else:
+        import plotly.io as pio
+        data = render_server.export_figure(pio.from_json(figure_json), output_format, backend)
+        check_deadline(deadline)
+        if cache is not None:
+            cache.put(key, output_format, data)
+    write_output(output_file, data, deadline)
+
+
+async def run_jobs(jobs: list[dict], workers: int = 2, export_concurrency: int = 2, queue_size: int | None = None,
+                   timeout: float | None = None, cache: figure_cache.FigureCache | None = None) -> list[dict]:
+    """Render the jobs and return the status and timing of every job in the order of the jobs."""
+    loop = asyncio.get_running_loop()
+    queue_size = queue_size or 2 * workers
+    layout_queue = asyncio.Queue(maxsize=queue_size)
+    export_queue = asyncio.Queue(maxsize=queue_size)
+    results = [{'output_file': job.get('output_file'), 'plot': job.get('plot')} for job in jobs]
+
+    # the deadlines are compared in the worker processes as well, so they are wall-clock times
+    def remaining(deadline):
+        return None if deadline is None else max(0.0, deadline - time.time())
+
+    async def produce():
+        for index, job in enumerate(jobs):
+            await layout_queue.put((index, job))
+        for _ in range(workers):
+            await layout_queue.put(None)
+
+    async def lay_out(executor):
+        while (item := await layout_queue.get()) is not None:
+            index, job = item
+            start = time.perf_counter()
+            deadline = None if timeout is None else time.time() + timeout
+            try:
+                output_format, config, plot_config = render_server.check_job(job)
+                backend = render_server.export_backend(config)
+                if 'output_file' not in job:
+                    raise render_server.RenderError(400, "Missing output_file")
+                key, figure_json = await asyncio.wait_for(loop.run_in_executor(executor, layout_job, job, output_format,
+                                                                              config, plot_config, deadline),
+                                                          remaining(deadline))
+            except (asyncio.TimeoutError, TimeoutError):
+                results[index].update(status='timeout', error=f'Layout exceeded {timeout} s')
+                continue
+            except Exception as e:
+                results[index].update(status='error', error=f'{type(e).__name__}: {e}')
+                continue
+            results[index]['layout_seconds'] = time.perf_counter() - start
+            if figure_json is None:
+                results[index].update(status='ok', cached=True)
+                continue
+            await export_queue.put((index, job, output_format, backend, figure_json, key, deadline))
+
+    async def export(executor):
+        while (item := await export_queue.get()) is not None:
+            index, job, output_format, backend, figure_json, key, deadline = item
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(loop.run_in_executor(executor, export_job, figure_json, output_format, job['output_file'],
+                                                            cache, key, backend, deadline), remaining(deadline))
+            except (asyncio.TimeoutError, TimeoutError):
+                results[index].update(status='timeout', error=f'Export exceeded the timeout of {timeout} s')
+                continue
+            except Exception as e:
+                results[index].update(status='error', error=f'{type(e).__name__}: {e}')
+                continue
+            results[index].update(status='ok', export_seconds=time.perf_counter() - start)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_worker, initargs=(cache,)) as layout_executor, \
+            ThreadPoolExecutor(max_workers=export_concurrency) as export_executor:
+        layout_tasks = [asyncio.create_task(lay_out(layout_executor)) for _ in range(workers)]
+        export_tasks = [asyncio.create_task(export(export_executor)) for _ in range(export_concurrency)]
+        await produce()
+        await asyncio.gather(*layout_tasks)
+        for _ in range(export_concurrency):
+            await export_queue.put(None)
+        await asyncio.gather(*export_tasks)
+    return results
+
+
+def main(argv=None):
+    """Main function to render a batch of plots."""
+    parser = argparse.ArgumentParser(prog='plots.py batch', description='Render a batch of protein sequencing plots.')
+    parser.add_argument('jobs', help='JSON file with the jobs.')
+    parser.add_argument('--workers', type=int, default=2, help='Processes laying out figures. Default=2')
+    parser.add_argument('--export-concurrency', type=int, default=2, help='Figures exported at the same time. Default=2')
+    parser.add_argument('--queue-size', type=int, default=None, help='Jobs waiting for each stage. Default=2*workers')
+    parser.add_argument('--timeout', type=float, default=None, help='Seconds after which a job is given up. Default=no timeout')
+    parser.add_argument('--report', default=None, help='Write the status and timing of every job as JSON to this file.')
+    figure_cache.add_cache_arguments(parser)
+    args = parser.parse_args(argv)
+
+    jobs = load_jobs(args.jobs)
+    start = time.perf_counter()
+    results = asyncio.run(run_jobs(jobs, args.workers, args.export_concurrency, args.queue_size, args.timeout,
+                                   figure_cache.cache_from_args(args)))
+    for result in results:
+        note = result.get('error', 'cached' if result.get('cached') else '')
+        print(f"{result['status']:<8}{result['plot'] or '':<10}{result['output_file'] or ''}  {note}")
+    failed = sum(result['status'] != 'ok' for result in results)
+    print(f"Rendered {len(results) - failed}/{len(results)} plots in {time.perf_counter() - start:.1f} s")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Indexed random access to large FASTA files, e.g. a proteome with all isoforms.
+The index is a samtools faidx index (<fasta>.fai): name, length, offset of the sequence, bases and bytes per line of
+every entry (see build_fasta_index for entries with lines of different lengths). It is built once with a single pass over the file and rebuilt if the size or mtime of the FASTA file changed. The FASTA file
+is memory-mapped and a sequence is read from its offset, so only the sequences that are used are ever loaded.
+The entries are grouped by accession and protein family (the accession without its isoform suffix), e.g. to load
+only the families referenced by an evidence file. The single protein FASTA files of the preprocessors and the
+alignment are read through the same index.
+Start with python -m protein_sequencing.data_preprocessing.fasta_index FASTA_FILE to build an index in advance."""
+import argparse
+import mmap
+import os
+from pathlib import Path
+
+from protein_sequencing.data_preprocessing import sequence_store
+
+
+def family_of(accession: str) -> str:
+    """Return the protein family of a UniProt accession, the accession without its isoform suffix."""
+    return accession.split('-')[0]
+
+
+def accession_of(name: str) -> str:
+    """Return the accession of a FASTA entry, e.g. P10636-2 for sp|P10636-2|TAU_HUMAN."""
+    return name.split('|')[1] if '|' in name else name
+
+
+def build_fasta_index(fasta_file: Path | str, index_file: Path | str):
+    """Write the faidx index of a FASTA file.
+    Entries whose lines (except the last) differ in length, which samtools rejects, are stored with 0 bases per line
+    and the number of bytes of their sequence lines instead, and are read as a whole."""
+    entries = []
+    name = None
+    offset = 0
+
+    def entry():
+        if ragged:
+            return name, length, sequence_offset, 0, sequence_end - sequence_offset
+        return name, length, sequence_offset, line_bases, line_width
+
+    with open(fasta_file, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    entries.append(entry())
+                name = line[1:].split(maxsplit=1)[0].decode('utf-8')
+                sequence_offset = sequence_end = offset + len(line)
+                length = line_bases = line_width = 0
+                last_line_bases = None
+                ragged = False
+            elif name is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if bases > 0:
+                    if (last_line_bases is not None and last_line_bases != line_bases) or (line_bases and bases > line_bases):
+                        ragged = True
+                    if line_bases == 0:
+                        line_bases, line_width = bases, len(line)
+                    length += bases
+                    sequence_end = offset + len(line)
+                last_line_bases = bases
+            offset += len(line)
+    if name is not None:
+        entries.append(entry())
+
+    index_file = Path(index_file)
+    # write to a temporary file first, so that processes never read a partially written index
+    tmp_file = index_file.with_suffix(index_file.suffix + f'.{os.getpid()}.tmp')
+    with tmp_file.open('w', encoding='utf-8') as f:
+        for values in entries:
+            f.write('\t'.join(map(str, values)) + '\n')
+    os.replace(tmp_file, index_file)
+
+
+class FastaIndex:
+    """Random access to the sequences of an indexed FASTA file, grouped by accession and protein family."""
+
+    def __init__(self, fasta_file: Path | str, index_file: Path | str | None = None):
+        self.fasta_file = str(fasta_file)
+        self.index_file = str(index_file or f'{fasta_file}.fai')
+        if sequence_store.is_outdated(self.index_file, self.fasta_file):
+            build_fasta_index(self.fasta_file, self.index_file)
+            sequence_store.write_stamp(self.index_file, self.fasta_file)
+
+        # name -> length, offset, bases per line and bytes per line
+        self.entries = {}
+        # family -> names of its entries in the order of the file
+        self.families = {}
+        with open(self.index_file, encoding='utf-8') as f:
+            for line in f:
+                name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+                self.entries[name] = (int(length), int(offset), int(line_bases), int(line_width))
+                self.families.setdefault(family_of(accession_of(name)), []).append(name)
+        self._buffer = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def accession_index(self) -> dict[str, str]:
+        """Map every accession and every family to its family."""
+        index = {family: family for family in self.families}
+        for family, names in self.families.items():
+            for name in names:
+                index[accession_of(name)] = family
+        return index
+
+    def buffer(self) -> mmap.mmap:
+        """Map the FASTA file on first use."""
+        if self._buffer is None:
+            with open(self.fasta_file, 'rb') as f:
+                self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._buffer
+
+    def header(self, name: str) -> str:
+        """Read the header line of an entry, without the leading >."""
+        offset = self.entries[name][1]
+        start = self.buffer().rfind(b'>', 0, offset)
+        return self._buffer[start + 1:offset].rstrip(b'\r\n').decode('utf-8')
+
+    def sequence(self, name: str) -> str:
+        """Read the sequence of an entry from the mapped FASTA file."""
+        length, offset, line_bases, line_width = self.entries[name]
+        if length == 0:
+            return ''
+        self.buffer()
+        if line_bases == 0:
+            # entry with lines of different lengths, line_width holds the bytes of its sequence lines
+            return b''.join(self._buffer[offset:offset + line_width].split()).decode('ascii')
+        end = offset + length // line_bases * line_width + length % line_bases
+        return self._buffer[offset:end].replace(b'\n', b'').replace(b'\r', b'').decode('ascii')
+
+    def records(self) -> list[tuple[str, str]]:
+        """Return the names and sequences of all entries in the order of the file."""
+        return [(name, self.sequence(name)) for name in self.entries]
+
+    def family_records(self, family: str) -> list[tuple[str, str]]:
+        """Return the names and sequences of all entries of a family."""
+        return [(name, self.sequence(name)) for name in self.families[family]]
+
+
+def write_fasta(records: list[tuple[str, str]], fasta_file: Path | str, line_length: int = 60):
+    """Write names and sequences to a FASTA file."""
+    with open(fasta_file, 'w', encoding='utf-8') as f:
+        for name, sequence in records:
+            f.write(f'>{name}\n')
+            for start in range(0, len(sequence), line_length):
+                f.write(sequence[start:start + line_length] + '\n')
+
+
+def main():
+    """Build the index of a FASTA file."""
+    parser = argparse.ArgumentParser(description='Build the faidx index of a FASTA file for the proteome mode.')
+    parser.add_argument('fasta', help='FASTA file to index.')
+    parser.add_argument('-o', '--output', required=False, help='Index file. Default=FASTA.fai')
+    args = parser.parse_args()
+    build_fasta_index(args.fasta, args.output or f'{args.fasta}.fai')
+    sequence_store.write_stamp(args.output or f'{args.fasta}.fai', args.fasta)
+    index = FastaIndex(args.fasta, args.output)
+    print(f"Indexed {len(index)} sequences of {len(index.families)} protein families")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,95 @@
 """Mascot Preprocessor Module. Extracting modifications from Mascot results and creating a CSV file with the results."""
 import os
 import csv
+import operator
 import re
 from pathlib import Path
 
 import pandas as pd
-from protein_sequencing import exon_helper, uniprot_align
-from protein_sequencing.data_preprocessing import preprocessor_helper
+from protein_sequencing import exon_helper, instrumentation, uniprot_align
+from protein_sequencing.data_preprocessing import preprocessor_helper, shards
+
+# columns of the protein hits table that are needed to extract the modifications
+MASCOT_COLUMNS = ('pep_seq', 'pep_var_mod', 'pep_var_mod_pos', 'prot_acc')
+CACHED_BUT_RELOAD_PATTERN = re.compile(r"Protein: \w{6,} has \d+ cached-but \d+ from the re-load")
+
+
+def write_mascot_results(all_mod_strings, mod_strings_for_files, output_folder, groups_df):
+    """Sort the modifications of all files and write them with the modifications per file to a CSV file."""
+    all_mod_strings = sorted(set(all_mod_strings), key=preprocessor_helper.extract_index)
+    all_mods = preprocessor_helper.sort_by_index_and_exons(all_mod_strings)
+    out_dir = Path(output_folder)
+    if not out_dir.exists():
+        out_dir.mkdir(parents=True, exist_ok=True)
+    with (out_dir / "result_mascot.csv").open('w', newline='', encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(['ID', 'Group'] + all_mods)
+        writer.writerow(['', ''] + [mod.split('(')[0] for mod in all_mods])
+        writer.writerow(['', ''] + [preprocessor_helper.extract_mod_location(mod) for mod in all_mods])
+        writer.writerow(['', ''] + [mod.split('_')[1] for mod in all_mods])
+        for file, mods in mod_strings_for_files.items():
+            row = [1 if mod in mods else 0 for mod in all_mods]
+            if file not in groups_df['file_name'].values:
+                raise KeyError(f"File {file} not found in groups CSV")
+            group = groups_df.loc[groups_df['file_name'] == file]['group_name'].values[0]
+            writer.writerow([file, group] + row)
+
+
+def read_mascot_rows(f):
+    """Stream the relevant sections of a Mascot CSV export.
+    A comma followed by a space is part of a field, e.g. of an unquoted protein description, and is replaced
+    by '-' before the fields are split.
+    Yields ('variable_mod', (identifier, mod)) for the variable modifications section and
+    ('peptide', (pep_seq, pep_var_mod, pep_var_mod_pos, prot_acc)) for every row of the protein hits table."""
+    section = None
+    header_length = -1
+    project = None
+    reader = csv.reader(line.replace(', ', '-') for line in f)
+    for row in reader:
+        if len(row) == 0:
+            continue
+        if len(row) > 1 and row[1].startswith('--------------------------------------------------------'):
+            section = row[0]
+            continue
+        if section == 'Variable modifications':
+            if row[0] == 'Identifier':
+                continue
+            yield 'variable_mod', (int(row[0]), row[1].split(' ')[0])
+        elif section == 'Protein hits':
+            if row[0] == 'prot_hit_num':
+                header_length = len(row)
+                project = operator.itemgetter(*(row.index(column) for column in MASCOT_COLUMNS))
+                continue
+            if len(row) != header_length:
+                # rows of proteins that were reloaded by Mascot are interrupted by a message and continue in the next line
+                message_start = next((i for i, field in enumerate(row) if field.startswith('Protein: ')), None)
+                if message_start is None or not CACHED_BUT_RELOAD_PATTERN.fullmatch(','.join(row[message_start:]).strip()):
+                    print(f"Error with line: {','.join(row)}")
+                    continue
+                row = row[:message_start] + next(reader, [])
+                if len(row) != header_length:
+                    print(f"Failed automatically fixing line: {','.join(row)}")
+                    continue
+            yield 'peptide', project(row)
+
 
 class MascotPreprocessor:
     """Mascot Preprocessor Class."""
 
-    def __init__(self, config, preprocessor_config) -> None:
+    def __init__(self, config, preprocessor_config, shard: tuple[int, int] | None = None) -> None:
         self.CONFIG = config
         self.PREPROCESSOR_CONFIG = preprocessor_config
+        # shard I/N of a sharded run (see shards.py), None processes all files
+        self.shard = shard
 
         self.fasta_file = self.PREPROCESSOR_CONFIG.FASTA_FILE
-        self.aligned_fasta_file = self.PREPROCESSOR_CONFIG.ALIGNED_FASTA_FILE
         self.input_dir = self.PREPROCESSOR_CONFIG.MASCOT_INPUT_DIR
+        self.out_dir = config.OUTPUT_FOLDER
 
-        uniprot_align.get_alignment(self.fasta_file)
-        self.fasta_headers = preprocessor_helper.process_tau_file(self.fasta_file, self.aligned_fasta_file)
+        # the isoforms are aligned once, the sites are mapped onto the alignment the exon is detected in
+        self.alignment = uniprot_align.get_alignment(Path(self.fasta_file), Path(self.out_dir), getattr(self.CONFIG, "ALIGNER", "auto"), getattr(self.CONFIG, "ALIGNMENT_WORKERS", 1))
+        self.aligned_fasta_file = str(Path(self.out_dir) / uniprot_align.ALIGNED_FASTA_NAME)
+        self.fasta_headers = preprocessor_helper.load_isoform_headers(self.fasta_file, self.aligned_fasta_file, getattr(self.PREPROCESSOR_CONFIG, "SEQUENCE_STORE_FILE", None))
 
         self.groups_df = pd.read_csv(self.PREPROCESSOR_CONFIG.GROUPS_CSV)
         (
@@ -34,7 +103,11 @@ class MascotPreprocessor:
             self.exon_2_length,
             self.exon_none_isoforms,
             self.max_sequence_length
-        ) = exon_helper.retrieve_exon(self.fasta_file, self.CONFIG.MIN_EXON_LENGTH)
+        ) = exon_helper.retrieve_exon(Path(self.fasta_file), self.CONFIG.MIN_EXON_LENGTH, Path(self.out_dir), getattr(self.CONFIG, "ALIGNER", "auto"), getattr(self.CONFIG, "ALIGNMENT_WORKERS", 1), self.alignment)
+
+        # peptide forms are shared between files, so every form is mapped to sites only once
+        self.peptide_locations = {}
+        self.mods_for_form = {}
 
         self.process_mascot_dir()
 
@@ -64,135 +137,67 @@ class MascotPreprocessor:
                 modstrings.append(modstring)
         return modstrings
 
-    def process_mascot_file(self, file, fasta_dict):
+    def get_known_accessions(self, fasta_dict) -> set:
+        """Precompute all accessions that match an isoform header, i.e. all substrings of the isoform ids."""
+        known_accessions = set()
+        for fasta_header in fasta_dict:
+            isoform = fasta_header[0]
+            for i in range(len(isoform) + 1):
+                for j in range(i, len(isoform) + 1):
+                    known_accessions.add(isoform[i:j])
+        return known_accessions
+
+    @instrumentation.traced()
+    def process_mascot_file(self, file, fasta_dict, known_accessions):
         """Process a Mascot file and extract the modifications."""
-        def replace_comma_in_quotes(line):
-            pattern = r'\"(.*?)\"'
-            def replace_comma(match):
-                return match.group(0).replace(',', '-')
-            modified_line = re.sub(pattern, replace_comma, line)
-            return modified_line
-
-        pep_seq_idx = -1
-        pep_var_mod_idx = -1
-        pep_var_mod_pos_idx = -1
-        pep_accession_idx = -1
-
-        header_length = -1
-
-        varmods = False
-        table = False
-        emptyrowpars = False
-
         variable_mods = {}
         all_mod_strings = []
-        with open(self.input_dir + file, 'r', encoding="utf-8") as f:
-            while line := f.readline():
-                if line.startswith('\"Variable modifications'):
-                    varmods = True
-                elif line.startswith('\"Protein hits'):
-                    table = True
-                elif varmods and line == '\n':
-                    emptyrowpars = True
-                elif table and line == '\n':
-                    emptyrowpars = True
-                elif '--------------------------------------------------------' in line:
-                    varmods = False
-                    table = False
-                    emptyrowpars = False
-                elif varmods and emptyrowpars:
-                    if not line.startswith('\"Identifier') and line != '\n':
-                        mod_string = line.split(',')[1]
-                        mod = mod_string.split(' ')[0][1:]
-                        variable_mods[int(line[0])] = mod
-                elif table and emptyrowpars:
-                    if line.startswith('prot_hit_num'):
-                        headers = line.split(',')
-                        header_length = len(headers)
-                        for i, header in enumerate(headers):
-                            if header == 'pep_seq':
-                                pep_seq_idx = i
-                            elif header == 'pep_var_mod':
-                                pep_var_mod_idx = i
-                            elif header == 'pep_var_mod_pos':
-                                pep_var_mod_pos_idx = i
-                            elif header == 'prot_acc':
-                                pep_accession_idx = i
-                    else:
-                        line = line.replace(', ', '-')
-                        line = replace_comma_in_quotes(line)
-                        row = line.split(',')
-                        header_found = False
-                        search_header = row[pep_accession_idx].strip('"\'')
-                        if search_header in self.PREPROCESSOR_CONFIG.ISOFORM_HELPER_DICT:
-                            search_header = self.PREPROCESSOR_CONFIG.ISOFORM_HELPER_DICT[search_header]
-                        for fasta_header in fasta_dict:
-                            if search_header in fasta_header[0]:
-                                header_found = True
-                                break
-                        if not header_found:
-                            continue
-                        if len(row) != header_length:
-                            pattern = r"Protein: \w{6,} has \d+ cached-but \d+ from the re-load*"
-                            if re.search(pattern, line):
-                                next_line = f.readline()
-                                line = re.sub(pattern, '', line).strip()
-                                line = line + next_line
-                                try:
-                                    assert len(line.split(',')) == header_length
-                                except AssertionError:
-                                    print(f"Failed automatically fixing line: {line}")
-                                    continue
-                                row = line.split(',')
-                            else:
-                                print(f"Error with line: {line}")
-                                continue
-                        if row[pep_var_mod_idx] == '""':
-                            continue
-                        isoform = None
-                        sequence = None
-                        aligned_sequence = None
-                        for fasta_header in fasta_dict:
-                            if row[pep_seq_idx] in fasta_header[1]:
-                                isoform = fasta_header[0]
-                                sequence = fasta_header[1]
-                                aligned_sequence = fasta_header[2]
-                                break
-                        if isoform is None:
-                            continue
-                        reform_mod_strings = self.reformmods(row[pep_var_mod_pos_idx], row[pep_seq_idx], variable_mods, isoform, sequence, aligned_sequence)
-                        all_mod_strings.extend(reform_mod_strings)
+        peptide_forms = {}
+        with open(self.input_dir + file, 'r', encoding="utf-8", newline='') as f:
+            for kind, values in read_mascot_rows(f):
+                if kind == 'variable_mod':
+                    identifier, mod = values
+                    variable_mods[identifier] = mod
+                    continue
+                peptide, var_mod, var_mod_pos, accession = values
+                accession = accession.strip('"\'')
+                accession = self.PREPROCESSOR_CONFIG.ISOFORM_HELPER_DICT.get(accession, accession)
+                if accession not in known_accessions:
+                    continue
+                if var_mod == '':
+                    continue
+                if preprocessor_helper.locate_peptide(peptide, fasta_dict, self.peptide_locations) is None:
+                    continue
+                peptide_forms[(peptide, var_mod_pos)] = True
+        instrumentation.count(peptide_forms=len(peptide_forms))
+
+        for peptide, mod_positions in peptide_forms:
+            form = (peptide, mod_positions, tuple(sorted(variable_mods.items())))
+            if form not in self.mods_for_form:
+                isoform, sequence, _, aligned_sequence = self.peptide_locations[peptide]
+                self.mods_for_form[form] = self.reformmods(mod_positions, peptide, variable_mods, isoform, sequence, aligned_sequence)
+            all_mod_strings.extend(self.mods_for_form[form])
         return all_mod_strings
 
+    @instrumentation.traced('write_results')
     def process_results(self, all_mod_strings, mod_strings_for_files):
         """Process the results and write it to a CSV file."""
-        all_mod_strings = sorted(set(all_mod_strings), key=preprocessor_helper.extract_index)
-        all_mods = preprocessor_helper.sort_by_index_and_exons(all_mod_strings)
-        out_dir = Path(self.CONFIG.OUTPUT_FOLDER)
-        if not out_dir.exists():
-            out_dir.mkdir(parents=True, exist_ok=True)
-        with (out_dir / "result_mascot.csv").open('w', newline='', encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(['ID', 'Group'] + all_mods)
-            writer.writerow(['', ''] + [mod.split('(')[0] for mod in all_mods])
-            writer.writerow(['', ''] + [preprocessor_helper.extract_mod_location(mod) for mod in all_mods])
-            writer.writerow(['', ''] + [mod.split('_')[1] for mod in all_mods])
-            for file, mods in mod_strings_for_files.items():
-                row = [1 if mod in mods else 0 for mod in all_mods]
-                if file not in self.groups_df['file_name'].values:
-                    raise KeyError(f"File {file} not found in groups CSV")
-                group = self.groups_df.loc[self.groups_df['file_name'] == file]['group_name'].values[0]
-                writer.writerow([file, group] + row)
-
+        write_mascot_results(all_mod_strings, mod_strings_for_files, self.CONFIG.OUTPUT_FOLDER, self.groups_df)
 
     def process_mascot_dir(self):
         """Process all Mascot files in a directory."""
-        files = os.listdir(self.input_dir)
+        # sorted, so that the shards process contiguous blocks and the merged rows keep the order of a single run
+        files = shards.shard_block(sorted(os.listdir(self.input_dir)), self.shard)
+        known_accessions = self.get_known_accessions(self.fasta_headers)
         all_mod_strings = []
         mod_strings_for_files = {}
         for file in files:
-            result= self.process_mascot_file(file, self.fasta_headers)
+            result= self.process_mascot_file(file, self.fasta_headers, known_accessions)
             all_mod_strings.extend(result)
             mod_strings_for_files[file] = result
 
+        if self.shard is not None:
+            shards.write_shard(shards.shard_dir(self.CONFIG, self.PREPROCESSOR_CONFIG), 'result_mascot', self.shard,
+                               all_mod_strings, mod_strings_for_files)
+            return
         self.process_results(all_mod_strings, mod_strings_for_files)
@@ -3,24 +3,57 @@ import re
 from pathlib import Path
 
 import pandas as pd
-from protein_sequencing import exon_helper, uniprot_align
-from protein_sequencing.data_preprocessing import preprocessor_helper
+from protein_sequencing import exon_helper, instrumentation, uniprot_align
+from protein_sequencing.data_preprocessing import preprocessor_helper, shards
+
+
+def read_max_quant_file(evidence_file: str):
+    """Yield the accession, peptide, modified peptide, modifications, experiment and PEP of every row of an evidence file."""
+    pep_seq_idx = -1
+    pep_mod_seq_idx = -1
+    prot_accession_idx = -1
+    mods_idx = -1
+    exp_idx = -1
+    pep_score_idx = -1
+    with open(evidence_file, 'r', encoding="utf-8") as f:
+        while line := f.readline():
+            if line.startswith("Sequence"):
+                header = line.split("\t")
+                for i, field in enumerate(header):
+                    if field == "Sequence":
+                        pep_seq_idx = i
+                    elif field == "Modified sequence":
+                        pep_mod_seq_idx = i
+                    elif field == "Modifications":
+                        mods_idx = i
+                    elif field == "Proteins":
+                        prot_accession_idx = i
+                    elif field == "PEP":
+                        pep_score_idx = i
+                    elif field.startswith("Experiment"):
+                        exp_idx = i
+            else:
+                fields = line.split("\t")
+                yield fields[prot_accession_idx], fields[pep_seq_idx], fields[pep_mod_seq_idx], fields[mods_idx], fields[exp_idx], fields[pep_score_idx]
 
 
 class MaxQuantPreprocessor:
     """MaxQuant Preprocessor."""
 
-    def __init__(self, config, preprocessor_config) -> None:
+    def __init__(self, config, preprocessor_config, shard: tuple[int, int] | None = None, rows: list | None = None) -> None:
         self.CONFIG = config
         self.PREPROCESSOR_CONFIG = preprocessor_config
+        # shard I/N of a sharded run (see shards.py), None processes all experiments
+        self.shard = shard
 
         self.fasta_file = self.PREPROCESSOR_CONFIG.FASTA_FILE
-        self.aligned_fasta_file = self.PREPROCESSOR_CONFIG.ALIGNED_FASTA_FILE
         self.input_file = self.PREPROCESSOR_CONFIG.MAX_QUANT_FILE
         self.out_dir = config.OUTPUT_FOLDER
 
-        uniprot_align.get_alignment(Path(self.fasta_file), Path(self.out_dir))
-        self.sorted_isoform_headers = preprocessor_helper.process_tau_file(self.fasta_file, self.aligned_fasta_file)
+        # the isoforms are aligned once, the sites are mapped onto the alignment the exon is detected in
+        self.alignment = uniprot_align.get_alignment(Path(self.fasta_file), Path(self.out_dir), getattr(self.CONFIG, "ALIGNER", "auto"), getattr(self.CONFIG, "ALIGNMENT_WORKERS", 1))
+        self.aligned_fasta_file = str(Path(self.out_dir) / uniprot_align.ALIGNED_FASTA_NAME)
+        self.sorted_isoform_headers = preprocessor_helper.load_isoform_headers(self.fasta_file, self.aligned_fasta_file, getattr(self.PREPROCESSOR_CONFIG, "SEQUENCE_STORE_FILE", None))
 
         self.groups_df = pd.read_csv(self.PREPROCESSOR_CONFIG.GROUPS_CSV)
         (
@@ -34,9 +67,9 @@ class MaxQuantPreprocessor:
             self.exon_2_length,
             self.exon_none_isoforms,
             self.max_sequence_leng
-        ) = exon_helper.retrieve_exon(Path(self.fasta_file), self.CONFIG.MIN_EXON_LENGTH, Path(self.out_dir))
+        ) = exon_helper.retrieve_exon(Path(self.fasta_file), self.CONFIG.MIN_EXON_LENGTH, Path(self.out_dir), getattr(self.CONFIG, "ALIGNER", "auto"), getattr(self.CONFIG, "ALIGNMENT_WORKERS", 1), self.alignment)
 
-        self.process_max_quant_file(self.input_file)
+        self.process_max_quant_file(self.input_file, rows)
 
     def get_exact_indexes(self, mod_sequence: str) -> list:
         """Get exact indexes of the modifications in the sequence."""
@@ -117,83 +150,71 @@ class MaxQuantPreprocessor:
             counter += 1
         return mod_strings
 
-    def process_max_quant_file(self, evidence_file: str):
-        """Process MaxQuant file."""
-        pep_seq_idx = -1
-        pep_mod_seq_idx = -1
-        prot_accession_idx = -1
-        mods_idx = -1
-        exp_idx = -1
-        pep_score_idx = -1
-
-        all_mods = []
+    @instrumentation.traced()
+    def process_max_quant_file(self, evidence_file: str, rows: list | None = None):
+        """Process MaxQuant file. Rows already read with read_max_quant_file, e.g. the rows of one protein family,
+        are processed instead of the file."""
         mods_for_exp = {}
-        all_cleavages = []
         cleavages_for_exp = {}
 
-        for key in self.groups_df['file_name']:
-            mods_for_exp[key] = []
-            cleavages_for_exp[key] = []
-
-        with open(evidence_file, 'r', encoding="utf-8") as f:
-            while line := f.readline():
-                if line.startswith("Sequence"):
-                    header = line.split("\t")
-                    for i, field in enumerate(header):
-                        if field == "Sequence":
-                            pep_seq_idx = i
-                        elif field == "Modified sequence":
-                            pep_mod_seq_idx = i
-                        elif field == "Modifications":
-                            mods_idx = i
-                        elif field == "Proteins":
-                            prot_accession_idx = i
-                        elif field == "PEP":
-                            pep_score_idx = i
-                        elif field.startswith("Experiment"):
-                            exp_idx = i
-                else:
-                    fields = line.split("\t")
-                    if fields[prot_accession_idx] in self.PREPROCESSOR_CONFIG.ISOFORM_HELPER_DICT:
-                        fields[prot_accession_idx] = self.PREPROCESSOR_CONFIG.ISOFORM_HELPER_DICT[fields[prot_accession_idx]]
-                    try:
-                        isoform, sequence, peptide_offset, aligned_sequence = preprocessor_helper.get_accession(fields[prot_accession_idx], fields[pep_seq_idx], self.sorted_isoform_headers)
-                    except ValueError:
-                        continue
-
-                    cleavage = preprocessor_helper.check_N_term_cleavage(fields[pep_seq_idx], fields[prot_accession_idx], self.sorted_isoform_headers, self.exon_found, self.exon_start_index, self.exon_end_index, self.exon_1_isoforms, self.exon_2_isoforms, self.exon_1_length, self.exon_2_length, self.exon_length)
-                    if cleavage != "":
-                        all_cleavages.append(cleavage)
-                        if fields[exp_idx] not in cleavages_for_exp:
-                            cleavages_for_exp[fields[exp_idx]] = []
-                        cleavages_for_exp[fields[exp_idx]].append(cleavage)
-                    cleavage = preprocessor_helper.check_C_term_cleavage(fields[pep_seq_idx], fields[prot_accession_idx], self.sorted_isoform_headers, self.exon_found, self.exon_start_index, self.exon_end_index, self.exon_1_isoforms, self.exon_2_isoforms, self.exon_1_length, self.exon_2_length, self.exon_length)
-                    if cleavage != "":
-                        all_cleavages.append(cleavage)
-                        if fields[exp_idx] not in cleavages_for_exp:
-                            cleavages_for_exp[fields[exp_idx]] = []
-                        cleavages_for_exp[fields[exp_idx]].append(cleavage)
-
-                    if float(fields[pep_score_idx]) < self.PREPROCESSOR_CONFIG.THRESHOLD:
-                        if fields[mods_idx] != "Unmodified":
-                            mods = self.reformat_mod(fields[pep_mod_seq_idx], fields[pep_seq_idx], peptide_offset, sequence, isoform, aligned_sequence)
-                            all_mods.extend(mods)
-                            if fields[exp_idx] in mods_for_exp:
-                                mods_for_exp[fields[exp_idx]].extend(mods)
-
-        all_mods = sorted(set(all_mods), key=preprocessor_helper.extract_index)
-        all_mods = preprocessor_helper.sort_by_index_and_exons(all_mods)
-        for key in mods_for_exp:
-            mods_for_exp[key] = sorted(set(mods_for_exp[key]), key=preprocessor_helper.extract_index)
-            mods_for_exp[key] = preprocessor_helper.sort_by_index_and_exons(mods_for_exp[key])
-
-        all_cleavages = sorted(set(all_cleavages), key=preprocessor_helper.extract_cleavage_location)
-        all_cleavages = preprocessor_helper.sort_by_index_and_exons(all_cleavages)
-        cleavages_with_ranges = preprocessor_helper.extract_cleavages_ranges(all_cleavages)
-        preprocessor_helper.write_results(
+        experiments = shards.shard_block(list(self.groups_df['file_name']), self.shard)
+        for key in experiments:
+            mods_for_exp[key] = set()
+            cleavages_for_exp[key] = set()
+        # experiments of the other shards, experiments missing in the groups file are kept by every shard
+        other_experiments = set(self.groups_df['file_name']).difference(experiments)
+
+        # identical peptide forms are collapsed here and mapped to sites only once below
+        peptide_forms = {}
+        modified_peptide_forms = {}
+        peptide_locations = {}
+
+        if rows is None:
+            rows = read_max_quant_file(evidence_file)
+        for accession, peptide, modified_peptide, modifications, experiment, pep_score in rows:
+            if experiment in other_experiments:
+                continue
+            accession = self.PREPROCESSOR_CONFIG.ISOFORM_HELPER_DICT.get(accession, accession)
+            if preprocessor_helper.locate_peptide(peptide, self.sorted_isoform_headers, peptide_locations) is None:
+                continue
+
+            preprocessor_helper.add_peptide_form(peptide_forms, (accession, peptide), experiment)
+            if float(pep_score) < self.PREPROCESSOR_CONFIG.THRESHOLD:
+                if modifications != "Unmodified":
+                    preprocessor_helper.add_peptide_form(modified_peptide_forms, (peptide, modified_peptide), experiment)
+        instrumentation.count(peptide_forms=len(peptide_forms), modified_peptide_forms=len(modified_peptide_forms))
+
+        all_cleavages = []
+        cleavages_for_form = {}
+        for accession, peptide in peptide_forms:
+            cleavages = set()
+            cleavage = preprocessor_helper.check_N_term_cleavage(peptide, accession, self.sorted_isoform_headers, self.exon_found, self.exon_start_index, self.exon_end_index, self.exon_1_isoforms, self.exon_2_isoforms, self.exon_1_length, self.exon_2_length, self.exon_length)
+            if cleavage != "":
+                cleavages.add(cleavage)
+            cleavage = preprocessor_helper.check_C_term_cleavage(peptide, accession, self.sorted_isoform_headers, self.exon_found, self.exon_start_index, self.exon_end_index, self.exon_1_isoforms, self.exon_2_isoforms, self.exon_1_length, self.exon_2_length, self.exon_length)
+            if cleavage != "":
+                cleavages.add(cleavage)
+            all_cleavages.extend(cleavages)
+            cleavages_for_form[(accession, peptide)] = cleavages
+        preprocessor_helper.fan_out_sites(peptide_forms, cleavages_for_form, cleavages_for_exp)
+
+        all_mods = []
+        mods_for_form = {}
+        for peptide, modified_peptide in modified_peptide_forms:
+            isoform, sequence, peptide_offset, aligned_sequence = peptide_locations[peptide]
+            mods = self.reformat_mod(modified_peptide, peptide, peptide_offset, sequence, isoform, aligned_sequence)
+            all_mods.extend(mods)
+            mods_for_form[(peptide, modified_peptide)] = mods
+        preprocessor_helper.fan_out_sites(modified_peptide_forms, mods_for_form, mods_for_exp, add_missing_experiments=False)
+
+        if self.shard is not None:
+            shards.write_shard(shards.shard_dir(self.CONFIG, self.PREPROCESSOR_CONFIG), 'result_max_quant', self.shard,
+                               all_mods, mods_for_exp, all_cleavages, cleavages_for_exp)
+            return
+        preprocessor_helper.sort_and_write_results(
             all_mods,
             mods_for_exp,
-            cleavages_with_ranges,
+            all_cleavages,
             cleavages_for_exp,
             f"{self.CONFIG.OUTPUT_FOLDER}/result_max_quant",
             self.groups_df
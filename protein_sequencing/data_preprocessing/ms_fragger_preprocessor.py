@@ -1,22 +1,49 @@
 """MS Fragger Preprocessor Module. Extracts modifications and cleavages from MS Fragger output file."""
 import re
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
-from protein_sequencing import exon_helper, uniprot_align
-from protein_sequencing.data_preprocessing import preprocessor_helper
+from protein_sequencing import exon_helper, instrumentation, uniprot_align
+from protein_sequencing.data_preprocessing import preprocessor_helper, shards
+
+
+def read_ms_fragger_file(file: str, isoform_helper_dict: dict) -> pd.DataFrame:
+    """Read the peptide forms of an MS Fragger output file together with the experiments they were observed in.
+    Returns one row per unique (protein, peptide, modified peptide) and one boolean column per experiment."""
+    header = pd.read_csv(file, sep='\t', nrows=0).columns
+    intensity_columns = [field for field in header if "Intensity" in field and not "MaxLFQ Intensity" in field]
+    form_columns = ["Protein ID", "Peptide Sequence", "Modified Sequence"]
+
+    df = pd.read_csv(file, sep='\t', usecols=form_columns + intensity_columns,
+                     dtype={**{column: str for column in form_columns}, **{column: np.float32 for column in intensity_columns}})
+    forms = df[form_columns].fillna('').apply(lambda column: column.str.strip())
+    forms["Protein ID"] = forms["Protein ID"].replace(isoform_helper_dict)
+
+    # a peptide counts as observed in an experiment for every intensity other than 0
+    intensities = df[intensity_columns].to_numpy(dtype=np.float32)
+    observed = pd.DataFrame(intensities != 0, columns=[column.replace(" Intensity", "").strip() for column in intensity_columns])
+    return observed.groupby([forms[column] for column in form_columns], sort=False, dropna=False).any()
+
 
 class MSFraggerPreprocessor:
     """MS Fragger Preprocessor."""
 
-    def __init__(self, config, preprocessor_config) -> None:
+    def __init__(self, config, preprocessor_config, shard: tuple[int, int] | None = None, rows: pd.DataFrame | None = None) -> None:
         self.CONFIG = config
         self.PREPROCESSOR_CONFIG = preprocessor_config
+        # shard I/N of a sharded run (see shards.py), None processes all experiments
+        self.shard = shard
 
         self.fasta_file = self.PREPROCESSOR_CONFIG.FASTA_FILE
-        self.aligned_fasta_file = self.PREPROCESSOR_CONFIG.ALIGNED_FASTA_FILE
         self.input_file = self.PREPROCESSOR_CONFIG.MS_FRAGGER_FILE
 
-        uniprot_align.get_alignment(self.fasta_file)
-        self.sorted_isoform_headers = preprocessor_helper.process_tau_file(self.fasta_file, self.aligned_fasta_file)
+        self.out_dir = config.OUTPUT_FOLDER
+
+        # the isoforms are aligned once, the sites are mapped onto the alignment the exon is detected in
+        self.alignment = uniprot_align.get_alignment(Path(self.fasta_file), Path(self.out_dir), getattr(self.CONFIG, "ALIGNER", "auto"), getattr(self.CONFIG, "ALIGNMENT_WORKERS", 1))
+        self.aligned_fasta_file = str(Path(self.out_dir) / uniprot_align.ALIGNED_FASTA_NAME)
+        self.sorted_isoform_headers = preprocessor_helper.load_isoform_headers(self.fasta_file, self.aligned_fasta_file, getattr(self.PREPROCESSOR_CONFIG, "SEQUENCE_STORE_FILE", None))
 
         self.groups_df = pd.read_csv(self.PREPROCESSOR_CONFIG.GROUPS_CSV)
         self.exon_found, \
@@ -28,9 +55,9 @@ class MSFraggerPreprocessor:
 		self.exon_2_isoforms, \
 		self.exon_2_length, \
 		self.exon_none_isoforms, \
-		self.max_sequence_length = exon_helper.retrieve_exon(self.fasta_file, self.CONFIG.MIN_EXON_LENGTH)
+		self.max_sequence_length = exon_helper.retrieve_exon(Path(self.fasta_file), self.CONFIG.MIN_EXON_LENGTH, Path(self.out_dir), getattr(self.CONFIG, "ALIGNER", "auto"), getattr(self.CONFIG, "ALIGNMENT_WORKERS", 1), self.alignment)
 
-        self.process_ms_fragger_file(self.input_file)
+        self.process_ms_fragger_file(self.input_file, rows)
 
     def check_modification_present(self, mod_sequence: str) -> bool:
         """Check if relevant modification is present in the sequence."""
@@ -90,84 +117,72 @@ class MSFraggerPreprocessor:
                 all_mods.append(mod_string)
         return all_mods
 
-    def process_ms_fragger_file(self, file: str):
-        """Process MS Fragger output file."""
-        pep_seq_idx = -1
-        pep_mod_seq_idx = -1
-        prot_accession_idx = -1
-
-        exp_idx = []
-        exp_names = []
+    @instrumentation.traced()
+    def process_ms_fragger_file(self, file: str, rows: pd.DataFrame | None = None):
+        """Process MS Fragger output file. Peptide forms already read with read_ms_fragger_file, e.g. the forms of
+        one protein family, are processed instead of the file."""
+        mods_for_exp = {}
+        cleavages_for_exp = {}
+        experiments = shards.shard_block(list(self.groups_df['file_name']), self.shard)
+        for key in experiments:
+            mods_for_exp[key] = set()
+            cleavages_for_exp[key] = set()
+
+        # identical peptide forms are collapsed here and mapped to sites only once below
+        observed_per_form = read_ms_fragger_file(file, self.PREPROCESSOR_CONFIG.ISOFORM_HELPER_DICT) if rows is None else rows
+        # experiments of the other shards are dropped, experiments missing in the groups file are kept by every shard
+        other_experiments = set(self.groups_df['file_name']).difference(experiments)
+        other_experiments = [column for column in observed_per_form.columns if column in other_experiments]
+        if other_experiments:
+            in_shard = observed_per_form.drop(columns=other_experiments)
+            # forms observed in no experiment at all still add their sites to the catalogue, as in a single run
+            observed_per_form = in_shard[in_shard.any(axis=1) | ~observed_per_form.any(axis=1)]
+        exp_names = observed_per_form.columns.to_numpy()
+        peptide_forms = {}
+        peptide_locations = {}
+        for form, observed in zip(observed_per_form.index, observed_per_form.to_numpy()):
+            if preprocessor_helper.locate_peptide(form[1], self.sorted_isoform_headers, peptide_locations) is None:
+                continue
+            peptide_forms[form] = set(exp_names[observed])
+        instrumentation.count(peptide_forms=len(peptide_forms))
 
         all_mods = []
-        mods_for_exp = {}
         all_cleavages = []
-        cleavages_for_exp = {}
-        for key in self.groups_df['file_name']:
-            mods_for_exp[key] = []
-            cleavages_for_exp[key] = []
-
-        with open(file, 'r', encoding="utf-8") as f:
-            while line := f.readline():
-                if line.startswith('Peptide Sequence'):
-                    row = line.split('\t')
-                    for i, field in enumerate(row):
-                        if field == "Protein ID":
-                            prot_accession_idx = i
-                        elif field == "Peptide Sequence":
-                            pep_seq_idx = i
-                        elif field == "Modified Sequence":
-                            pep_mod_seq_idx = i
-                        elif "Intensity" in field:
-                            if not "MaxLFQ Intensity" in field:
-                                exp_idx.append(i)
-                                exp_names.append(field.replace(" Intensity", "").strip())
-                else:
-                    row = line.split('\t')
-                    row = [field.strip() for field in row]
-                    nterm_cleav = ""
-                    cterm_cleav = ""
-
-                    if len(row) > 0:
-                        if row[prot_accession_idx] in self.PREPROCESSOR_CONFIG.ISOFORM_HELPER_DICT:
-                            row[prot_accession_idx] = self.PREPROCESSOR_CONFIG.ISOFORM_HELPER_DICT[row[prot_accession_idx]]
-                        try:
-                            isoform, sequence, offset, aligned_sequence = preprocessor_helper.get_accession(row[prot_accession_idx], row[pep_seq_idx], self.sorted_isoform_headers)
-                        except ValueError:
-                            continue
-
-                        nterm_cleav = preprocessor_helper.check_N_term_cleavage(row[pep_seq_idx], row[prot_accession_idx], self.sorted_isoform_headers, self.exon_found, self.exon_start_index, self.exon_end_index, self.exon_1_isoforms, self.exon_2_isoforms, self.exon_1_length, self.exon_2_length, self.exon_length)
-                        cterm_cleav = preprocessor_helper.check_C_term_cleavage(row[pep_seq_idx], row[prot_accession_idx], self.sorted_isoform_headers, self.exon_found, self.exon_start_index, self.exon_end_index, self.exon_1_isoforms, self.exon_2_isoforms, self.exon_1_length, self.exon_2_length, self.exon_length)
-                        cleavage = ""
-                        if nterm_cleav != "" and cterm_cleav != "":
-                            all_cleavages.append(nterm_cleav)
-                            all_cleavages.append(cterm_cleav)
-                            cleavage = nterm_cleav + "; " + cterm_cleav
-                        elif nterm_cleav != "":
-                            all_cleavages.append(nterm_cleav)
-                            cleavage = nterm_cleav
-                        elif cterm_cleav != "":
-                            all_cleavages.append(cterm_cleav)
-                            cleavage = cterm_cleav
-
-                        if self.check_modification_present(row[pep_mod_seq_idx]):
-                            mods_for_peptide = self.process_modifications(row[pep_mod_seq_idx], offset, isoform, sequence, aligned_sequence)
-                            all_mods.extend(mods_for_peptide)
-                            for i, idx in enumerate(exp_idx):
-                                if row[idx] != "0.0":
-                                    if exp_names[i] not in mods_for_exp:
-                                        raise KeyError(f"Experiment {exp_names[i]} not found in groups.csv")
-                                    mods_for_exp[exp_names[i]].extend(mods_for_peptide)
-
-                                    if cleavage != "":
-                                        cleavages_for_exp[exp_names[i]].append(cleavage)
-
-        all_mods = sorted(set(all_mods), key=preprocessor_helper.extract_index)
-        all_mods = preprocessor_helper.sort_by_index_and_exons(all_mods)
-        for key in mods_for_exp:
-            mods_for_exp[key] = sorted(set(mods_for_exp[key]), key=preprocessor_helper.extract_index)
-
-        all_cleavages = sorted(set(all_cleavages), key=preprocessor_helper.extract_cleavage_location)
-        all_cleavages = preprocessor_helper.sort_by_index_and_exons(all_cleavages)
-        cleavages_with_ranges = preprocessor_helper.extract_cleavages_ranges(all_cleavages)
-        preprocessor_helper.write_results(all_mods, mods_for_exp, cleavages_with_ranges, cleavages_for_exp, f"{self.CONFIG.OUTPUT_FOLDER}/result_ms_fragger", self.groups_df)
+        mods_for_form = {}
+        cleavages_for_form = {}
+        for form, experiments in peptide_forms.items():
+            accession, peptide, mod_sequence = form
+            isoform, sequence, offset, aligned_sequence = peptide_locations[peptide]
+
+            nterm_cleav = preprocessor_helper.check_N_term_cleavage(peptide, accession, self.sorted_isoform_headers, self.exon_found, self.exon_start_index, self.exon_end_index, self.exon_1_isoforms, self.exon_2_isoforms, self.exon_1_length, self.exon_2_length, self.exon_length)
+            cterm_cleav = preprocessor_helper.check_C_term_cleavage(peptide, accession, self.sorted_isoform_headers, self.exon_found, self.exon_start_index, self.exon_end_index, self.exon_1_isoforms, self.exon_2_isoforms, self.exon_1_length, self.exon_2_length, self.exon_length)
+            cleavage = ""
+            if nterm_cleav != "" and cterm_cleav != "":
+                all_cleavages.append(nterm_cleav)
+                all_cleavages.append(cterm_cleav)
+                cleavage = nterm_cleav + "; " + cterm_cleav
+            elif nterm_cleav != "":
+                all_cleavages.append(nterm_cleav)
+                cleavage = nterm_cleav
+            elif cterm_cleav != "":
+                all_cleavages.append(cterm_cleav)
+                cleavage = cterm_cleav
+
+            if self.check_modification_present(mod_sequence):
+                mods_for_peptide = self.process_modifications(mod_sequence, offset, isoform, sequence, aligned_sequence)
+                all_mods.extend(mods_for_peptide)
+                for experiment in experiments:
+                    if experiment not in mods_for_exp:
+                        raise KeyError(f"Experiment {experiment} not found in groups.csv")
+                mods_for_form[form] = mods_for_peptide
+                if cleavage != "":
+                    cleavages_for_form[form] = [cleavage]
+
+        preprocessor_helper.fan_out_sites(peptide_forms, mods_for_form, mods_for_exp)
+        preprocessor_helper.fan_out_sites(peptide_forms, cleavages_for_form, cleavages_for_exp)
+
+        if self.shard is not None:
+            shards.write_shard(shards.shard_dir(self.CONFIG, self.PREPROCESSOR_CONFIG), 'result_ms_fragger', self.shard,
+                               all_mods, mods_for_exp, all_cleavages, cleavages_for_exp)
+            return
+        preprocessor_helper.sort_and_write_results(all_mods, mods_for_exp, all_cleavages, cleavages_for_exp, f"{self.CONFIG.OUTPUT_FOLDER}/result_ms_fragger", self.groups_df)
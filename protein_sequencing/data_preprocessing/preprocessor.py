@@ -1,30 +1,75 @@
-"""Common interface to execute preprocessors."""
+"""Common interface to execute preprocessors.
+The preprocessors are imported when they are run, so a run only loads the libraries of the selected preprocessor."""
 import argparse
 import importlib
-from protein_sequencing.data_preprocessing.protein_pilot_preprocessor import ProteinPilotPreprocessor
-from protein_sequencing.data_preprocessing.mascot_preprocessor import MascotPreprocessor
-from protein_sequencing.data_preprocessing.ms_fragger_preprocessor import MSFraggerPreprocessor
-from protein_sequencing.data_preprocessing.max_quant_preprocessor import MaxQuantPreprocessor
+import sys
+from protein_sequencing import instrumentation, profiling
+from protein_sequencing.data_preprocessing import shards
 
 
-def mascot(config, pre_config):
+def mascot(config, pre_config, shard=None):
     """Mascot preprocessor."""
-    MascotPreprocessor(importlib.import_module(config, 'configs'), importlib.import_module(pre_config, 'configs'))
+    from protein_sequencing.data_preprocessing.mascot_preprocessor import MascotPreprocessor
+    MascotPreprocessor(importlib.import_module(config, 'configs'), importlib.import_module(pre_config, 'configs'), shard)
 
 
-def protein_pilot(config, pre_config):
+def protein_pilot(config, pre_config, shard=None):
     """Protein Pilot preprocessor."""
-    ProteinPilotPreprocessor(importlib.import_module(config, 'configs'), importlib.import_module(pre_config, 'configs'))
+    from protein_sequencing.data_preprocessing.protein_pilot_preprocessor import ProteinPilotPreprocessor
+    ProteinPilotPreprocessor(importlib.import_module(config, 'configs'), importlib.import_module(pre_config, 'configs'), shard)
 
 
-def ms_fragger(config, pre_config):
+def ms_fragger(config, pre_config, shard=None):
     """MS Fragger preprocessor."""
-    MSFraggerPreprocessor(importlib.import_module(config, 'configs'), importlib.import_module(pre_config, 'configs'))
+    from protein_sequencing.data_preprocessing.ms_fragger_preprocessor import MSFraggerPreprocessor
+    MSFraggerPreprocessor(importlib.import_module(config, 'configs'), importlib.import_module(pre_config, 'configs'), shard)
 
 
-def max_quant(config, pre_config):
+def max_quant(config, pre_config, shard=None):
     """MaxQuant preprocessor."""
-    MaxQuantPreprocessor(importlib.import_module(config, 'configs'), importlib.import_module(pre_config, 'configs'))
+    from protein_sequencing.data_preprocessing.max_quant_preprocessor import MaxQuantPreprocessor
+    MaxQuantPreprocessor(importlib.import_module(config, 'configs'), importlib.import_module(pre_config, 'configs'), shard)
+
+
+# name of the result files of each preprocessor, also used for the files of its shards
+RESULT_NAMES = {
+    'ma': 'result_mascot',
+    'pp': 'result_protein_pilot',
+    'mq': 'result_max_quant',
+    'ms': 'result_ms_fragger',
+}
+
+
+def merge(preprocessor, config, pre_config):
+    """Merge the partial results of all shards of a preprocessor into the result files of a single run."""
+    import pandas as pd
+    from protein_sequencing.data_preprocessing import preprocessor_helper
+    config = importlib.import_module(config, 'configs')
+    pre_config = importlib.import_module(pre_config, 'configs')
+    groups_df = pd.read_csv(pre_config.GROUPS_CSV)
+    result_name = RESULT_NAMES[preprocessor]
+    all_mods, mods_for_exp, all_cleavages, cleavages_for_exp = shards.read_shards(shards.shard_dir(config, pre_config), result_name)
+    with instrumentation.span('merge_shards', experiments=len(mods_for_exp)):
+        if preprocessor == 'ma':
+            from protein_sequencing.data_preprocessing.mascot_preprocessor import write_mascot_results
+            write_mascot_results(all_mods, mods_for_exp, config.OUTPUT_FOLDER, groups_df)
+        elif preprocessor == 'pp':
+            from protein_sequencing.data_preprocessing.protein_pilot_preprocessor import write_protein_pilot_results
+            write_protein_pilot_results(all_mods, mods_for_exp, all_cleavages, cleavages_for_exp, config.OUTPUT_FOLDER, groups_df)
+        else:
+            preprocessor_helper.sort_and_write_results(all_mods, mods_for_exp, all_cleavages, cleavages_for_exp,
+                                                       f"{config.OUTPUT_FOLDER}/{result_name}", groups_df)
+
+
+def proteome(preprocessor, config, pre_config):
+    """Process all protein families of the input file in one run and print the status of every family."""
+    from protein_sequencing.data_preprocessing import proteome as proteome_run
+    results = proteome_run.run_proteome(preprocessor, importlib.import_module(config, 'configs'), importlib.import_module(pre_config, 'configs'))
+    for result in results:
+        print(f"{result['status']:<8}{result['family']:<12}{result.get('isoforms', 0):>4} isoforms{result.get('rows', 0):>9} rows  {result.get('error', '')}")
+    failed = sum(result['status'] == 'error' for result in results)
+    print(f"Processed {len(results) - failed}/{len(results)} protein families")
+    return results
 
 
 DEFAULT_CONFIGS = {
@@ -54,16 +99,74 @@ def main():
                         required=False,
                         default=DEFAULT_CONFIGS['config'],
                         help='Path to configuration file. Default=configs.default_config')
+    parser.add_argument('--trace',
+                        required=False,
+                        help='Record the time, CPU time, peak RSS and item counts of every stage and write them to this file.')
+    parser.add_argument('--trace-format',
+                        required=False,
+                        default='jsonl',
+                        choices=instrumentation.TRACE_FORMATS,
+                        help='Format of the trace file, JSON lines or Chrome trace (chrome://tracing, Perfetto). Default=jsonl')
+    parser.add_argument('--profile',
+                        required=False,
+                        nargs='?',
+                        const='cprofile',
+                        choices=profiling.PROFILERS,
+                        help='Profile the run and write the profile and collapsed stacks to the output folder. Default profiler=cprofile')
+    parser.add_argument('--profile-aggregate',
+                        required=False,
+                        help='Add the per-function totals of the profiled run to this .prof file (cprofile only).')
+    parser.add_argument('--shard',
+                        required=False,
+                        type=shards.parse_shard,
+                        help='Process only shard I/N (I from 0 to N-1) of the experiments and write a partial result to SHARD_DIR of the preprocessor config (default OUTPUT_FOLDER/shards).')
+    parser.add_argument('--merge',
+                        required=False,
+                        action='store_true',
+                        help='Merge the partial results of all shards into the result files, once every shard is written.')
+    parser.add_argument('--proteome',
+                        required=False,
+                        action='store_true',
+                        help='Process every protein family of the FASTA file referenced by the input file (or PROTEINS of the preprocessor config) and write the results of each family to OUTPUT_FOLDER/<family> (mq and ms only).')
     args = parser.parse_args()
-
+    if args.shard and args.merge:
+        parser.error('--shard and --merge cannot be combined')
+    if args.proteome and (args.shard or args.merge):
+        parser.error('--proteome cannot be combined with --shard or --merge')
+    if args.proteome and args.preprocessor not in ('mq', 'ms'):
+        parser.error('--proteome is only supported by the preprocessors mq and ms')
+
+    if args.trace:
+        instrumentation.enable()
+    try:
+        with instrumentation.span(f'preprocessor_{args.preprocessor}'):
+            if args.profile:
+                output_folder = importlib.import_module(args.config, 'configs').OUTPUT_FOLDER
+                profiling.run_profiled(lambda: run_preprocessor(args), output_folder, f'profile_{args.preprocessor}',
+                                       args.profile, args.profile_aggregate)
+            else:
+                run_preprocessor(args)
+    finally:
+        instrumentation.write(args.trace, args.trace_format)
+
+
+def run_preprocessor(args):
+    """Run the preprocessor selected on the command line."""
+    if args.merge:
+        merge(args.preprocessor, args.config, args.preprocessor_config)
+        return
+    if args.proteome:
+        if any(result['status'] == 'error' for result in proteome(args.preprocessor, args.config, args.preprocessor_config)):
+            sys.exit(1)
+        return
     if args.preprocessor == 'ma':
-        mascot(args.config, args.preprocessor_config)
+        mascot(args.config, args.preprocessor_config, args.shard)
     elif args.preprocessor == 'pp':
-        protein_pilot(args.config, args.preprocessor_config)
+        protein_pilot(args.config, args.preprocessor_config, args.shard)
     elif args.preprocessor == 'mq':
-        max_quant(args.config, args.preprocessor_config)
+        max_quant(args.config, args.preprocessor_config, args.shard)
     elif args.preprocessor == 'ms':
-        ms_fragger(args.config, args.preprocessor_config)
+        ms_fragger(args.config, args.preprocessor_config, args.shard)
     else:
         print(
             f"Unknown preprocessor type: {args.preprocessor}. Currently supported preprocessors are: ma (Mascot), pp (ProteinPilot), mq (MaxQuant), ms (MS Fragger).")
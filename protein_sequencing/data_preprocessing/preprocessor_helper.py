@@ -2,45 +2,49 @@
 from typing import Tuple
 import csv
 
-def process_tau_file(fasta_file, aligned_fasta_file):
-    # TODO: naming sucks or does it really only work for tau?
-    """Extracts the sequences from the fasta file and the aligned fasta file
-    and returns them as a list of tuples sorted by the sequence length."""
-    headers = []
-    aligned_sequences = {}
-    with open(aligned_fasta_file, 'r', encoding="utf-8") as file:
-        lines = file.readlines()
-        header = ''
-        aligned_seq = ''
-        for line in lines:
-            if line.startswith('>'):
-                if header != '':
-                    aligned_sequences[header] = aligned_seq
-                header = line.split('|')[1]
-                aligned_seq = ''
-            else:
-                aligned_seq += line.strip()
-        if header:
-            aligned_sequences[header] = aligned_seq
+from protein_sequencing import instrumentation
+from protein_sequencing.data_preprocessing import fasta_index, sequence_store
+
 
+def read_fasta_entries(fasta_file):
+    """Yield the accession in the header and the sequence of every entry of a FASTA file, reading it line by line."""
+    header = ''
+    lines = []
     with open(fasta_file, 'r', encoding="utf-8") as file:
-        lines = file.readlines()
-        seq = ''
-        header = ''
-        for line in lines:
-            if line[0] == '>':
+        for line in file:
+            if line.startswith('>'):
                 if header != '':
-                    headers.append((header, seq, aligned_sequences[header]))
-                    seq = ''
-                    header = ''
+                    yield header, ''.join(lines)
                 header = line.split('|')[1]
+                lines = []
             else:
-                seq += line.strip()
-        headers.append((header, seq, aligned_sequences[header]))
+                lines.append(line.strip())
+    if header != '':
+        yield header, ''.join(lines)
+
+
+def process_tau_file(fasta_file, aligned_fasta_file):
+    # TODO: naming sucks or does it really only work for tau?
+    """Extracts the sequences from the fasta file (through its faidx index) and the aligned fasta file
+    and returns them as a list of tuples sorted by the sequence length."""
+    aligned_sequences = dict(read_fasta_entries(aligned_fasta_file))
+    headers = [(fasta_index.accession_of(name), seq, aligned_sequences[fasta_index.accession_of(name)])
+               for name, seq in fasta_index.FastaIndex(fasta_file).records()]
     sorted_headers = sorted(headers, key=lambda x: -len(x[1]))
     return sorted_headers
 
 
+def load_isoform_headers(fasta_file, aligned_fasta_file, store_file=None):
+    """Return the isoform headers like process_tau_file.
+    If a store file is given, the sequences are served from a shared memory-mapped store instead of Python strings."""
+    if store_file is None:
+        return process_tau_file(fasta_file, aligned_fasta_file)
+    if sequence_store.is_outdated(store_file, fasta_file, aligned_fasta_file):
+        sequence_store.write_sequence_store(process_tau_file(fasta_file, aligned_fasta_file), store_file)
+        sequence_store.write_stamp(store_file, fasta_file, aligned_fasta_file)
+    return sequence_store.read_sequence_store(store_file)
+
+
 def extract_index(string):
     """Extracts the index from a string."""
     return int(string.split('@')[1].split('_')[0])
@@ -116,6 +120,34 @@ def get_accession(accession: str, peptide: str, sorted_isoform_headers) -> Tuple
         return isoform, sequence, offset, aligned_sequence
     raise ValueError(f"Peptide {peptide} with accession {accession} not found in fasta file")
 
+def locate_peptide(peptide: str, sorted_isoform_headers, peptide_locations: dict) -> Tuple[str, str, int, str] | None:
+    """Cached variant of get_accession. Returns None if the peptide is not part of any isoform."""
+    if peptide not in peptide_locations:
+        try:
+            peptide_locations[peptide] = get_accession('', peptide, sorted_isoform_headers)
+        except ValueError:
+            peptide_locations[peptide] = None
+    return peptide_locations[peptide]
+
+def add_peptide_form(peptide_forms: dict, form: tuple, experiment: str):
+    """Register that a peptide form (e.g. accession, peptide and modified peptide) was observed in an experiment."""
+    if form not in peptide_forms:
+        peptide_forms[form] = set()
+    peptide_forms[form].add(experiment)
+
+def fan_out_sites(peptide_forms: dict, sites_for_form: dict, sites_for_exp: dict, add_missing_experiments: bool = True):
+    """Assign the sites mapped once per unique peptide form to all experiments the form was observed in."""
+    for form, experiments in peptide_forms.items():
+        sites = sites_for_form.get(form)
+        if not sites:
+            continue
+        for experiment in experiments:
+            if experiment not in sites_for_exp:
+                if not add_missing_experiments:
+                    continue
+                sites_for_exp[experiment] = set()
+            sites_for_exp[experiment].update(sites)
+
 def count_missing_amino_acids(peptide: str, aligned_sequence: str, peptide_offset: int, exon_start_index: int, exon_end_index: int) -> int:
     """Count the missing amino acids in the aligned sequence."""
     missing = 0
@@ -140,8 +172,10 @@ def count_missing_amino_acids(peptide: str, aligned_sequence: str, peptide_offse
                 break
     return missing
 
+@instrumentation.traced()
 def write_results(all_mods, mods_for_exp, cleavages_with_ranges, cleavages_for_exp, output_folder, groups_df):
     """Write modification and cleavage strings to csv files."""
+    instrumentation.count(mods=len(all_mods), cleavages=len(cleavages_with_ranges), experiments=len(mods_for_exp))
     with open(f"{output_folder}_mods.csv", 'w', newline='', encoding="utf-8") as f:
         writer = csv.writer(f)
         writer.writerow(['ID', 'Group'] + all_mods)
@@ -170,6 +204,15 @@ def write_results(all_mods, mods_for_exp, cleavages_with_ranges, cleavages_for_e
             group = groups_df.loc[groups_df['file_name'] == key]['group_name'].values[0]
             writer.writerow([key, group] + row)
 
+def sort_and_write_results(all_mods, mods_for_exp, all_cleavages, cleavages_for_exp, output_folder, groups_df):
+    """Sort the catalogues of modifications and cleavages once and write them with the sites per experiment to csv files."""
+    all_mods = sorted(set(all_mods), key=extract_index)
+    all_mods = sort_by_index_and_exons(all_mods)
+    all_cleavages = sorted(set(all_cleavages), key=extract_cleavage_location)
+    all_cleavages = sort_by_index_and_exons(all_cleavages)
+    cleavages_with_ranges = extract_cleavages_ranges(all_cleavages)
+    write_results(all_mods, mods_for_exp, cleavages_with_ranges, cleavages_for_exp, output_folder, groups_df)
+
 def calculate_exon_offset(offset: int, isoform: str, exon_found: bool, exon_end_index: int, exon_1_isoforms: list, exon_2_isoforms: list, exon_1_length: int, exon_2_length: int, exon_length: int) -> int:
     """Calculate the exon offset. Starting index is 1."""
     if exon_found:
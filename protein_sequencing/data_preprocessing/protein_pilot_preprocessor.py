@@ -3,23 +3,28 @@ ProteinPilotTM output files and creates a CSV file with the results."""
 import importlib
 import os
 import csv
+from pathlib import Path
 from typing import Tuple
 import pandas as pd
 from python_calamine import CalamineWorkbook
-from protein_sequencing import exon_helper, uniprot_align
-from protein_sequencing.data_preprocessing import preprocessor_helper
+from protein_sequencing import exon_helper, instrumentation, uniprot_align
+from protein_sequencing.data_preprocessing import preprocessor_helper, shards
 
 class ProteinPilotPreprocessor:
-    def __init__(self, config, preprocessor_config):
+    def __init__(self, config, preprocessor_config, shard: tuple[int, int] | None = None):
         self.CONFIG = config
         self.PREPROCESSOR_CONFIG = preprocessor_config
+        # shard I/N of a sharded run (see shards.py), None processes all files
+        self.shard = shard
 
         self.fasta_file = self.PREPROCESSOR_CONFIG.FASTA_FILE
-        self.aligned_fasta_file = self.PREPROCESSOR_CONFIG.ALIGNED_FASTA_FILE
         self.input_dir = self.PREPROCESSOR_CONFIG.PROTEIN_PILOT_INPUT_DIR
+        self.out_dir = config.OUTPUT_FOLDER
 
-        uniprot_align.get_alignment(self.fasta_file)
-        self.sorted_isoform_headers = preprocessor_helper.process_tau_file(self.fasta_file, self.aligned_fasta_file)
+        # the isoforms are aligned once, the sites are mapped onto the alignment the exon is detected in
+        self.alignment = uniprot_align.get_alignment(Path(self.fasta_file), Path(self.out_dir), getattr(self.CONFIG, "ALIGNER", "auto"), getattr(self.CONFIG, "ALIGNMENT_WORKERS", 1))
+        self.aligned_fasta_file = str(Path(self.out_dir) / uniprot_align.ALIGNED_FASTA_NAME)
+        self.sorted_isoform_headers = preprocessor_helper.load_isoform_headers(self.fasta_file, self.aligned_fasta_file, getattr(self.PREPROCESSOR_CONFIG, "SEQUENCE_STORE_FILE", None))
 
         self.groups_df = pd.read_csv(self.PREPROCESSOR_CONFIG.GROUPS_CSV)
         self.exon_found, \
@@ -31,7 +36,10 @@ class ProteinPilotPreprocessor:
         self.exon_2_isoforms, \
         self.exon_2_length, \
         self.exon_none_isoforms, \
-        self.max_sequence_length = exon_helper.retrieve_exon(self.fasta_file, self.CONFIG.MIN_EXON_LENGTH)
+        self.max_sequence_length = exon_helper.retrieve_exon(Path(self.fasta_file), self.CONFIG.MIN_EXON_LENGTH, Path(self.out_dir), getattr(self.CONFIG, "ALIGNER", "auto"), getattr(self.CONFIG, "ALIGNMENT_WORKERS", 1), self.alignment)
+
+        # peptide forms are shared between files, so every form is mapped to sites only once
+        self.mods_for_form = {}
 
         self.process_protein_pilot_dir()
 
@@ -104,42 +112,52 @@ class ProteinPilotPreprocessor:
         """Extract modification strings from rows"""
         mods = []
         for row in rows:
-            isoform, sequence, peptide_offset, aligned_sequence = self.get_accession(row, accession_index, seq_index)
-            if isoform is None or sequence is None or aligned_sequence is None or peptide_offset is None:
-                continue
-            if peptide_offset is None:
-                print(f"Error: sequence {row[seq_index]} with assumed accession: {row[accession_index]} not found in fasta file.")
+            form = (row[accession_index], row[seq_index], row[protein_mod_index], row[mod_index])
+            if form not in self.mods_for_form:
+                self.mods_for_form[form] = self.extract_mods_from_row(row, protein_mod_index, mod_index, seq_index, accession_index)
+            mods.extend(self.mods_for_form[form])
+
+        return mods
+
+    def extract_mods_from_row(self, row, protein_mod_index, mod_index, seq_index, accession_index) -> list:
+        """Extract modification strings from a single row"""
+        mods = []
+        isoform, sequence, peptide_offset, aligned_sequence = self.get_accession(row, accession_index, seq_index)
+        if isoform is None or sequence is None or aligned_sequence is None or peptide_offset is None:
+            return mods
+        if peptide_offset is None:
+            print(f"Error: sequence {row[seq_index]} with assumed accession: {row[accession_index]} not found in fasta file.")
+            return mods
+        relevant_mods = row[protein_mod_index].split(';')
+        all_mods = row[mod_index].split(';')
+        peptide = row[seq_index]
+        for rel_mod in relevant_mods:
+            matched_mod = None
+            rel_mod_name, rel_amino_acid, _ = self.split_mod(rel_mod, peptide)
+            if rel_mod_name not in self.CONFIG.INCLUDED_MODIFICATIONS:
                 continue
-            relevant_mods = row[protein_mod_index].split(';')
-            all_mods = row[mod_index].split(';')
-            peptide = row[seq_index]
-            for rel_mod in relevant_mods:
-                matched_mod = None
-                rel_mod_name, rel_amino_acid, _ = self.split_mod(rel_mod, peptide)
-                if rel_mod_name not in self.CONFIG.INCLUDED_MODIFICATIONS:
-                    continue
-                for mod in all_mods:
-                    mod_name, amino_acid, mod_pos = self.split_mod(mod, peptide)
-                    if rel_mod_name == mod_name and rel_amino_acid == amino_acid:
-                        matched_mod = mod
-                        break
-                if matched_mod is not None:
-                    mod_name, amino_acid, mod_pos = self.split_mod(matched_mod, peptide)
-                    if self.CONFIG.INCLUDED_MODIFICATIONS.get(mod_name):
-                        if amino_acid not in self.CONFIG.INCLUDED_MODIFICATIONS[mod_name]:
-                            continue
-                        if amino_acid == 'R' and mod_name == 'Deamidated':
-                            mod_name = 'Citrullination'
-                    missing_aa = 0
-                    if len(sequence) != len(aligned_sequence):
-                        missing_aa = preprocessor_helper.count_missing_amino_acids(peptide[:mod_pos], aligned_sequence, peptide_offset, self.exon_start_index, self.exon_end_index)
-                    offset = preprocessor_helper.calculate_exon_offset(mod_pos+peptide_offset+missing_aa, isoform, self.exon_found, self.exon_end_index, self.exon_1_isoforms, self.exon_2_isoforms, self.exon_1_length, self.exon_2_length, self.exon_length)
-                    aligned_offset = offset-1+preprocessor_helper.count_missing_aa_in_exon(aligned_sequence, self.exon_start_index, self.exon_end_index, offset)
-                    if aligned_sequence[aligned_offset] != amino_acid:
-                        raise ValueError(f"AA don't match for {amino_acid} for peptide {peptide} in sequence {aligned_sequence} with offset {aligned_offset}")
-                    iso = preprocessor_helper.get_isoform_for_offset(isoform, offset, self.exon_start_index, self.exon_1_isoforms, self.exon_1_length, self.exon_2_isoforms, self.exon_2_length)
-                    modstring = f"{mod_name}({amino_acid})@{offset}_{iso}"
-                    mods.append(modstring)
+            for mod in all_mods:
+                mod_name, amino_acid, mod_pos = self.split_mod(mod, peptide)
+                if rel_mod_name == mod_name and rel_amino_acid == amino_acid:
+                    matched_mod = mod
+                    break
+            if matched_mod is not None:
+                mod_name, amino_acid, mod_pos = self.split_mod(matched_mod, peptide)
+                if self.CONFIG.INCLUDED_MODIFICATIONS.get(mod_name):
+                    if amino_acid not in self.CONFIG.INCLUDED_MODIFICATIONS[mod_name]:
+                        continue
+                    if amino_acid == 'R' and mod_name == 'Deamidated':
+                        mod_name = 'Citrullination'
+                missing_aa = 0
+                if len(sequence) != len(aligned_sequence):
+                    missing_aa = preprocessor_helper.count_missing_amino_acids(peptide[:mod_pos], aligned_sequence, peptide_offset, self.exon_start_index, self.exon_end_index)
+                offset = preprocessor_helper.calculate_exon_offset(mod_pos+peptide_offset+missing_aa, isoform, self.exon_found, self.exon_end_index, self.exon_1_isoforms, self.exon_2_isoforms, self.exon_1_length, self.exon_2_length, self.exon_length)
+                aligned_offset = offset-1+preprocessor_helper.count_missing_aa_in_exon(aligned_sequence, self.exon_start_index, self.exon_end_index, offset)
+                if aligned_sequence[aligned_offset] != amino_acid:
+                    raise ValueError(f"AA don't match for {amino_acid} for peptide {peptide} in sequence {aligned_sequence} with offset {aligned_offset}")
+                iso = preprocessor_helper.get_isoform_for_offset(isoform, offset, self.exon_start_index, self.exon_1_isoforms, self.exon_1_length, self.exon_2_isoforms, self.exon_2_length)
+                modstring = f"{mod_name}({amino_acid})@{offset}_{iso}"
+                mods.append(modstring)
 
         return mods
 
@@ -200,6 +218,7 @@ class ProteinPilotPreprocessor:
 
         return mods, cleavages
 
+    @instrumentation.traced()
     def process_protein_pilot_xlsx_file(self, file) -> Tuple[list, list]:
         """Process ProteinPilot output file and extract modifications and cleavages."""
         workbook = CalamineWorkbook.from_path(file)
@@ -209,6 +228,7 @@ class ProteinPilotPreprocessor:
 
         peptide_summary = workbook.get_sheet_by_name('Peptide Summary')
         mods, cleavages = self.extract_data_with_threshold(peptide_summary, fdr_threshold)
+        instrumentation.count(mods=len(mods), cleavages=len(cleavages))
 
         return mods, cleavages
 
@@ -219,55 +239,67 @@ class ProteinPilotPreprocessor:
         mods_per_file = {}
         cleavages_per_file = {}
 
-        xlsx_count = len([file for file in os.listdir(self.input_dir) if file.endswith('.xlsx')])
+        # sorted, so that the shards process contiguous blocks and the merged rows keep the order of a single run
+        files = shards.shard_block(sorted(file for file in os.listdir(self.input_dir) if file.endswith('.xlsx')), self.shard)
+        xlsx_count = len(files)
         file_counter = 0
-        for file in os.listdir(self.input_dir):
-            if file.endswith('.xlsx'):
-                mods_for_file, cleavages_for_file = self.process_protein_pilot_xlsx_file(self.input_dir+file)
-                mods_for_file = set(mods_for_file)
-                cleavages_for_file = set(cleavages_for_file)
-                all_mods.extend(mods_for_file)
-                all_cleavages.extend(cleavages_for_file)
-                mods_per_file[file] = mods_for_file
-                cleavages_per_file[file] = cleavages_for_file
-                file_counter += 1
-                print(f"Processed file {file} ({file_counter}/{xlsx_count})")
-
-        for _, row in self.groups_df.iterrows():
-            if pd.notna(row['replicate']):
-                mods_per_file[row['file_name']] = mods_per_file[row['file_name']].union(mods_per_file[row['replicate']])
-                cleavages_per_file[row['file_name']] = cleavages_per_file[row['file_name']].union(cleavages_per_file[row['replicate']])
-                del mods_per_file[row['replicate']]
-
-        all_mods = sorted(set(all_mods), key=preprocessor_helper.extract_index)
-        all_mods = preprocessor_helper.sort_by_index_and_exons(all_mods)
-
-        all_cleavages = sorted(set(all_cleavages), key=preprocessor_helper.extract_index)
-        all_cleavages = preprocessor_helper.sort_by_index_and_exons(all_cleavages)
-        cleavages_with_ranges = preprocessor_helper.extract_cleavages_ranges(all_cleavages)
-
-        with open(f"{self.CONFIG.OUTPUT_FOLDER}/result_protein_pilot_mods.csv", 'w', newline='', encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(['ID', 'Group'] + all_mods)
-            writer.writerow(['', ''] + [mod.split('(')[0] for mod in all_mods])
-            writer.writerow(['', ''] + [preprocessor_helper.extract_mod_location(mod) for mod in all_mods])
-            writer.writerow(['', ''] + [mod.split('_')[1] for mod in all_mods])
-            for file, mods in mods_per_file.items():
-                row = [1 if mod in mods else 0 for mod in all_mods]
-                group = self.groups_df.loc[self.groups_df['file_name'] == file]['group_name'].values[0]
-                writer.writerow([file[:-10], group] + row)
-
-        with open(f"{self.CONFIG.OUTPUT_FOLDER}/result_protein_pilot_cleavages.csv", 'w', newline='', encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(['ID', 'Group'] + cleavages_with_ranges)
-            writer.writerow(['', ''] + ['Non-Tryptic' for _ in cleavages_with_ranges])
-            writer.writerow(['', ''] + [cleavage.split('_')[0] for cleavage in cleavages_with_ranges])
-            writer.writerow(['', ''] + [cleavage.split('_')[1] for cleavage in cleavages_with_ranges])
-            ranges = preprocessor_helper.parse_ranges(cleavages_with_ranges)
-            for file, cleavages in cleavages_per_file.items():
-                indexes = [preprocessor_helper.extract_index(cleavage) for cleavage in cleavages]
-                row = preprocessor_helper.cleavage_score(ranges, indexes)
-                group = self.groups_df.loc[self.groups_df['file_name'] == file]['group_name'].values[0]
-                writer.writerow([file[:-10], group] + row)
-
-        return all_mods, all_cleavages
+        for file in files:
+            mods_for_file, cleavages_for_file = self.process_protein_pilot_xlsx_file(self.input_dir+file)
+            mods_for_file = set(mods_for_file)
+            cleavages_for_file = set(cleavages_for_file)
+            all_mods.extend(mods_for_file)
+            all_cleavages.extend(cleavages_for_file)
+            mods_per_file[file] = mods_for_file
+            cleavages_per_file[file] = cleavages_for_file
+            file_counter += 1
+            print(f"Processed file {file} ({file_counter}/{xlsx_count})")
+
+        if self.shard is not None:
+            shards.write_shard(shards.shard_dir(self.CONFIG, self.PREPROCESSOR_CONFIG), 'result_protein_pilot', self.shard,
+                               all_mods, mods_per_file, all_cleavages, cleavages_per_file)
+            return all_mods, all_cleavages
+        return write_protein_pilot_results(all_mods, mods_per_file, all_cleavages, cleavages_per_file, self.CONFIG.OUTPUT_FOLDER, self.groups_df)
+
+
+def write_protein_pilot_results(all_mods, mods_per_file, all_cleavages, cleavages_per_file, output_folder, groups_df):
+    """Merge the replicates, sort the modifications and cleavages of all files and write them to CSV files."""
+    for _, row in groups_df.iterrows():
+        if pd.notna(row['replicate']):
+            mods_per_file[row['file_name']] = mods_per_file[row['file_name']].union(mods_per_file[row['replicate']])
+            cleavages_per_file[row['file_name']] = cleavages_per_file[row['file_name']].union(cleavages_per_file[row['replicate']])
+            del mods_per_file[row['replicate']]
+
+    all_mods = sorted(set(all_mods), key=preprocessor_helper.extract_index)
+    all_mods = preprocessor_helper.sort_by_index_and_exons(all_mods)
+
+    all_cleavages = sorted(set(all_cleavages), key=preprocessor_helper.extract_index)
+    all_cleavages = preprocessor_helper.sort_by_index_and_exons(all_cleavages)
+    cleavages_with_ranges = preprocessor_helper.extract_cleavages_ranges(all_cleavages)
+
+    with instrumentation.span('write_results', mods=len(all_mods), experiments=len(mods_per_file)), \
+            open(f"{output_folder}/result_protein_pilot_mods.csv", 'w', newline='', encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(['ID', 'Group'] + all_mods)
+        writer.writerow(['', ''] + [mod.split('(')[0] for mod in all_mods])
+        writer.writerow(['', ''] + [preprocessor_helper.extract_mod_location(mod) for mod in all_mods])
+        writer.writerow(['', ''] + [mod.split('_')[1] for mod in all_mods])
+        for file, mods in mods_per_file.items():
+            row = [1 if mod in mods else 0 for mod in all_mods]
+            group = groups_df.loc[groups_df['file_name'] == file]['group_name'].values[0]
+            writer.writerow([file[:-10], group] + row)
+
+    with instrumentation.span('write_results', cleavages=len(cleavages_with_ranges), experiments=len(cleavages_per_file)), \
+            open(f"{output_folder}/result_protein_pilot_cleavages.csv", 'w', newline='', encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(['ID', 'Group'] + cleavages_with_ranges)
+        writer.writerow(['', ''] + ['Non-Tryptic' for _ in cleavages_with_ranges])
+        writer.writerow(['', ''] + [cleavage.split('_')[0] for cleavage in cleavages_with_ranges])
+        writer.writerow(['', ''] + [cleavage.split('_')[1] for cleavage in cleavages_with_ranges])
+        ranges = preprocessor_helper.parse_ranges(cleavages_with_ranges)
+        for file, cleavages in cleavages_per_file.items():
+            indexes = [preprocessor_helper.extract_index(cleavage) for cleavage in cleavages]
+            row = preprocessor_helper.cleavage_score(ranges, indexes)
+            group = groups_df.loc[groups_df['file_name'] == file]['group_name'].values[0]
+            writer.writerow([file[:-10], group] + row)
+
+    return all_mods, all_cleavages
@@ -0,0 +1,138 @@
+"""Proteome-wide preprocessing of many proteins in one run.
+The evidence file is read once and its rows are partitioned into protein families with the index of the accessions in
+the FASTA file (see fasta_index.py), e.g. the rows of P10636-2 and P10636-8 belong to the family P10636. Every family referenced by the
+evidence (or the families of PROTEINS in the preprocessor config) is aligned, its exon detected and its rows processed
+like a single-protein run, in parallel processes (FAMILY_WORKERS). The FASTA file, the alignment and the result files
+of a family are written to OUTPUT_FOLDER/<family>/, so every folder can be plotted like the output of a single run."""
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+from protein_sequencing import instrumentation, utils
+from protein_sequencing.data_preprocessing import fasta_index
+
+PROTEOME_PREPROCESSORS = ('mq', 'ms')
+
+
+def find_families(accessions: str, index: dict[str, str], isoform_helper_dict: dict) -> set[str]:
+    """Return the families of the accessions of a row, separated by ; if a peptide is shared between proteins.
+    Isoforms missing in the FASTA file belong to the family of their accession."""
+    found = set()
+    for accession in accessions.split(';'):
+        accession = accession.strip()
+        accession = isoform_helper_dict.get(accession, accession)
+        family = index.get(accession, index.get(fasta_index.family_of(accession)))
+        if family is not None:
+            found.add(family)
+    return found
+
+
+def partition_max_quant_rows(evidence_file: str, index: dict[str, str], isoform_helper_dict: dict) -> dict[str, list]:
+    """Read a MaxQuant evidence file once and return its rows per family."""
+    from protein_sequencing.data_preprocessing.max_quant_preprocessor import read_max_quant_file
+    rows_for_family = {}
+    families_for_accessions = {}
+    for row in read_max_quant_file(evidence_file):
+        if row[0] not in families_for_accessions:
+            families_for_accessions[row[0]] = find_families(row[0], index, isoform_helper_dict)
+        for family in families_for_accessions[row[0]]:
+            rows_for_family.setdefault(family, []).append(row)
+    return rows_for_family
+
+
+def partition_ms_fragger_rows(ms_fragger_file: str, index: dict[str, str], isoform_helper_dict: dict) -> dict:
+    """Read an MS Fragger file once and return its peptide forms per family."""
+    from protein_sequencing.data_preprocessing.ms_fragger_preprocessor import read_ms_fragger_file
+    observed_per_form = read_ms_fragger_file(ms_fragger_file, isoform_helper_dict)
+    positions_for_family = {}
+    families_for_accessions = {}
+    for position, accessions in enumerate(observed_per_form.index.get_level_values(0)):
+        if accessions not in families_for_accessions:
+            families_for_accessions[accessions] = find_families(accessions, index, {})
+        for family in families_for_accessions[accessions]:
+            positions_for_family.setdefault(family, []).append(position)
+    return {family: observed_per_form.iloc[positions] for family, positions in positions_for_family.items()}
+
+
+def config_values(config) -> dict:
+    """Return the settings of a config module, which unlike the module can be sent to worker processes."""
+    return {name: value for name, value in vars(config).items() if name.isupper()}
+
+
+def run_family(preprocessor: str, family: str, records: list[tuple[str, str]], config: dict, preprocessor_config: dict, rows) -> dict:
+    """Align a family, detect its exon and process its rows like a single-protein run.
+    The records are the names and sequences of the isoforms of the family.
+    Returns the status of the family, errors of a family do not stop the other families."""
+    start = time.perf_counter()
+    family_dir = Path(config['OUTPUT_FOLDER']) / family
+    family_dir.mkdir(parents=True, exist_ok=True)
+    fasta_file = family_dir / f'{family}.fasta'
+    fasta_index.write_fasta(records, fasta_file)
+    store_file = preprocessor_config.get('SEQUENCE_STORE_FILE')
+    config = SimpleNamespace(**{**config, 'OUTPUT_FOLDER': str(family_dir)})
+    preprocessor_config = SimpleNamespace(**{
+        **preprocessor_config,
+        'FASTA_FILE': str(fasta_file),
+        'SEQUENCE_STORE_FILE': None if store_file is None else str(family_dir / Path(store_file).name),
+    })
+    # the exon detection records the isoforms of the family in the layout
+    utils.reset_layout()
+    result = {'family': family, 'isoforms': len(records), 'rows': len(rows)}
+    try:
+        if preprocessor == 'mq':
+            from protein_sequencing.data_preprocessing.max_quant_preprocessor import MaxQuantPreprocessor
+            MaxQuantPreprocessor(config, preprocessor_config, rows=rows)
+        else:
+            from protein_sequencing.data_preprocessing.ms_fragger_preprocessor import MSFraggerPreprocessor
+            MSFraggerPreprocessor(config, preprocessor_config, rows=rows)
+    except Exception as e:
+        return {**result, 'status': 'error', 'error': f'{type(e).__name__}: {e}', 'seconds': time.perf_counter() - start}
+    return {**result, 'status': 'ok', 'seconds': time.perf_counter() - start}
+
+
+def run_proteome(preprocessor: str, config, preprocessor_config) -> list[dict]:
+    """Process every family referenced by the input file, or the families of PROTEINS, and return their status."""
+    if preprocessor not in PROTEOME_PREPROCESSORS:
+        raise ValueError(f"The proteome mode supports the preprocessors {', '.join(PROTEOME_PREPROCESSORS)}, not {preprocessor}")
+    isoform_helper_dict = preprocessor_config.ISOFORM_HELPER_DICT
+    with instrumentation.span('read_fasta_index'):
+        fasta = fasta_index.FastaIndex(preprocessor_config.FASTA_FILE, getattr(preprocessor_config, 'FASTA_INDEX_FILE', None))
+        families = fasta.families
+        index = fasta.accession_index()
+        instrumentation.count(families=len(families), accessions=len(index))
+    with instrumentation.span('partition_rows'):
+        if preprocessor == 'mq':
+            rows_for_family = partition_max_quant_rows(preprocessor_config.MAX_QUANT_FILE, index, isoform_helper_dict)
+        else:
+            rows_for_family = partition_ms_fragger_rows(preprocessor_config.MS_FRAGGER_FILE, index, isoform_helper_dict)
+        instrumentation.count(families=len(rows_for_family))
+
+    results = []
+    proteins = getattr(preprocessor_config, 'PROTEINS', None)
+    if proteins is None:
+        selected = [family for family in families if family in rows_for_family]
+    else:
+        selected = []
+        for protein in proteins:
+            family = index.get(isoform_helper_dict.get(protein, protein), fasta_index.family_of(protein))
+            if family not in families:
+                results.append({'family': family, 'status': 'error', 'error': f'{protein} not found in {preprocessor_config.FASTA_FILE}'})
+            elif family not in rows_for_family:
+                results.append({'family': family, 'status': 'skipped', 'error': 'No rows in the input file'})
+            elif family not in selected:
+                selected.append(family)
+
+    config_settings = config_values(config)
+    preprocessor_settings = config_values(preprocessor_config)
+    # only the sequences of the selected families are read from the FASTA file
+    tasks = [(preprocessor, family, fasta.family_records(family), config_settings, preprocessor_settings, rows_for_family[family])
+             for family in selected]
+    workers = getattr(preprocessor_config, 'FAMILY_WORKERS', 1)
+    with instrumentation.span('run_families', families=len(tasks)):
+        if workers == 1 or len(tasks) < 2:
+            results.extend(run_family(*task) for task in tasks)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results.extend(executor.map(run_family, *zip(*tasks)))
+    return results
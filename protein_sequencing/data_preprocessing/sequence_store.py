@@ -0,0 +1,179 @@
+"""Memory-mapped store for isoform and aligned sequences.
+The sequences are written once into a contiguous byte buffer with an offset table in front of it.
+Every process that opens the store maps the same read-only pages, and pickled sequences only
+transfer the path and offsets instead of the sequence data."""
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+
+MAGIC = b'PTMSEQ1\n'
+ENTRY_HEADER = struct.Struct('<I')
+ENTRY_OFFSETS = struct.Struct('<QQQQ')
+
+# one read-only mapping per store file and process, with the inode, size and mtime of the mapped file
+_BUFFERS = {}
+
+
+def _file_key(stat: os.stat_result) -> tuple[int, int, int]:
+    """Identify a version of a store file, a rebuilt store replaces the file and gets a new inode."""
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _get_buffer(store_file: str) -> mmap.mmap:
+    """Return the read-only mapping for the store file, opening it on first use."""
+    if store_file not in _BUFFERS:
+        with open(store_file, 'rb') as f:
+            _BUFFERS[store_file] = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), _file_key(os.fstat(f.fileno())))
+    return _BUFFERS[store_file][0]
+
+
+class SequenceView:
+    """Read-only view on a sequence in the store. Supports the str operations used by the preprocessors
+    (len, indexing, slicing, `in` and index) without copying the sequence into a Python string."""
+
+    __slots__ = ('store_file', 'start', 'length', '_buffer')
+
+    def __init__(self, store_file: str, start: int, length: int):
+        self.store_file = store_file
+        self.start = start
+        self.length = length
+        self._buffer = _get_buffer(store_file)
+
+    def __reduce__(self):
+        return (SequenceView, (self.store_file, self.start, self.length))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step != 1:
+                return str(self)[index]
+            return self._buffer[self.start + start:self.start + max(start, stop)].decode('ascii')
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('sequence index out of range')
+        return chr(self._buffer[self.start + index])
+
+    def __contains__(self, peptide: str):
+        return self.find(peptide) != -1
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __str__(self):
+        return self[:]
+
+    def __repr__(self):
+        return f"SequenceView({self.store_file!r}, {self.start}, {self.length})"
+
+    def find(self, peptide: str) -> int:
+        """Return the offset of the peptide in the sequence or -1."""
+        position = self._buffer.find(peptide.encode('ascii'), self.start, self.start + self.length)
+        if position == -1:
+            return -1
+        return position - self.start
+
+    def index(self, peptide: str) -> int:
+        """Return the offset of the peptide in the sequence, raise ValueError if it is not present."""
+        position = self.find(peptide)
+        if position == -1:
+            raise ValueError(f"Peptide {peptide} not found in sequence")
+        return position
+
+
+def write_sequence_store(sorted_isoform_headers, store_file: Path | str):
+    """Write isoform ids, sequences and aligned sequences into a store file."""
+    entries = []
+    buffer = bytearray()
+    for isoform, sequence, aligned_sequence in sorted_isoform_headers:
+        sequence_start = len(buffer)
+        buffer += sequence.encode('ascii')
+        aligned_start = len(buffer)
+        buffer += aligned_sequence.encode('ascii')
+        entries.append((isoform.encode('utf-8'), sequence_start, len(sequence), aligned_start, len(aligned_sequence)))
+
+    table = bytearray(MAGIC)
+    table += ENTRY_HEADER.pack(len(entries))
+    for isoform, sequence_start, sequence_length, aligned_start, aligned_length in entries:
+        table += ENTRY_HEADER.pack(len(isoform)) + isoform
+        table += ENTRY_OFFSETS.pack(sequence_start, sequence_length, aligned_start, aligned_length)
+
+    store_file = Path(store_file)
+    store_file.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first, so that processes never map a partially written store
+    tmp_file = store_file.with_suffix(store_file.suffix + f'.{os.getpid()}.tmp')
+    with tmp_file.open('wb') as f:
+        f.write(ENTRY_HEADER.pack(len(table)))
+        f.write(table)
+        f.write(buffer)
+    os.replace(tmp_file, store_file)
+
+
+def read_sequence_store(store_file: Path | str) -> list[tuple[str, SequenceView, SequenceView]]:
+    """Open a store file and return the isoform headers in the same layout as process_tau_file."""
+    store_file = str(store_file)
+    mapped = _BUFFERS.get(store_file)
+    if mapped is not None and mapped[1] != _file_key(os.stat(store_file)):
+        # the store was rebuilt, the views of the replaced store must not be used any more
+        del _BUFFERS[store_file]
+        mapped[0].close()
+    buffer = _get_buffer(store_file)
+    table_length = ENTRY_HEADER.unpack_from(buffer, 0)[0]
+    data_start = ENTRY_HEADER.size + table_length
+    position = ENTRY_HEADER.size
+    if buffer[position:position + len(MAGIC)] != MAGIC:
+        raise ValueError(f"{store_file} is not a sequence store")
+    position += len(MAGIC)
+    count = ENTRY_HEADER.unpack_from(buffer, position)[0]
+    position += ENTRY_HEADER.size
+
+    headers = []
+    for _ in range(count):
+        isoform_length = ENTRY_HEADER.unpack_from(buffer, position)[0]
+        position += ENTRY_HEADER.size
+        isoform = buffer[position:position + isoform_length].decode('utf-8')
+        position += isoform_length
+        sequence_start, sequence_length, aligned_start, aligned_length = ENTRY_OFFSETS.unpack_from(buffer, position)
+        position += ENTRY_OFFSETS.size
+        headers.append((isoform,
+                        SequenceView(store_file, data_start + sequence_start, sequence_length),
+                        SequenceView(store_file, data_start + aligned_start, aligned_length)))
+    return headers
+
+
+def input_stamp(*input_files: Path | str) -> list[list[int]]:
+    """Return the size and mtime in nanoseconds of every input file."""
+    return [[os.stat(input_file).st_size, os.stat(input_file).st_mtime_ns] for input_file in input_files]
+
+
+def stamp_file(store_file: Path | str) -> Path:
+    """Return the file recording the input files a store was built from."""
+    return Path(f'{store_file}.stamp')
+
+
+def write_stamp(store_file: Path | str, *input_files: Path | str):
+    """Record the size and mtime of the files a store was built from, after the store is written."""
+    stamp = stamp_file(store_file)
+    tmp_file = stamp.with_suffix(stamp.suffix + f'.{os.getpid()}.tmp')
+    with tmp_file.open('w', encoding='utf-8') as f:
+        json.dump(input_stamp(*input_files), f)
+    os.replace(tmp_file, stamp)
+
+
+def is_outdated(store_file: Path | str, *input_files: Path | str) -> bool:
+    """Check if the store is missing or any of the files it was built from changed in size or mtime since."""
+    if not Path(store_file).exists():
+        return True
+    try:
+        with stamp_file(store_file).open(encoding='utf-8') as f:
+            return json.load(f) != input_stamp(*input_files)
+    except (OSError, ValueError):
+        return True
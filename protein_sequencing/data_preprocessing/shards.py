@@ -0,0 +1,94 @@
+"""Sharded preprocessing of large cohorts on several machines.
+A shard I/N processes the I-th of N contiguous blocks of the experiments (the rows of the groups file for MaxQuant
+and MS Fragger, the sorted input files for Mascot and ProteinPilot). Instead of the result files it writes a partial
+result to the shard folder: the site catalogue of the shard and the sites of each of its experiments.
+The shards only share this folder, e.g. on a network filesystem. Once all shards are written, the merge unions the
+partial results and writes the same result files as a single run, so the catalogue is sorted only once."""
+import json
+import os
+import re
+from pathlib import Path
+
+SHARD_PATTERN = re.compile(r'^(\d+)/(\d+)$')
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """Parse a shard given as I/N, where I counts from 0 to N-1."""
+    match = SHARD_PATTERN.match(shard)
+    if match is None or not int(match.group(1)) < int(match.group(2)):
+        raise ValueError(f"Invalid shard {shard}, expected I/N with 0 <= I < N")
+    return int(match.group(1)), int(match.group(2))
+
+
+def shard_block(items: list, shard: tuple[int, int] | None) -> list:
+    """Return the contiguous block of the items processed by a shard, all items without a shard.
+    The blocks of the shards in order are the items in order, so the merged rows keep the order of a single run."""
+    if shard is None:
+        return list(items)
+    index, count = shard
+    return list(items[index * len(items) // count:(index + 1) * len(items) // count])
+
+
+def shard_dir(config, preprocessor_config) -> Path:
+    """Return the folder of the partial results, SHARD_DIR of the preprocessor config or OUTPUT_FOLDER/shards."""
+    return Path(getattr(preprocessor_config, 'SHARD_DIR', None) or Path(config.OUTPUT_FOLDER) / 'shards')
+
+
+def shard_file(folder: Path | str, result_name: str, shard: tuple[int, int]) -> Path:
+    """Return the file of the partial result of a shard."""
+    index, count = shard
+    return Path(folder) / f'{result_name}.shard-{index:04d}-of-{count:04d}.json'
+
+
+def write_shard(folder: Path | str, result_name: str, shard: tuple[int, int], all_mods, mods_for_exp: dict,
+                all_cleavages=(), cleavages_for_exp: dict | None = None) -> Path:
+    """Write the catalogues and the sites per experiment of a shard."""
+    partial = {
+        'result': result_name,
+        'shard': list(shard),
+        'mods': sorted(set(all_mods)),
+        'cleavages': sorted(set(all_cleavages)),
+        'mods_for_exp': {experiment: sorted(mods) for experiment, mods in mods_for_exp.items()},
+        'cleavages_for_exp': {experiment: sorted(cleavages) for experiment, cleavages in (cleavages_for_exp or {}).items()},
+    }
+    output_file = shard_file(folder, result_name, shard)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first, so that the merge never reads a partially written shard
+    tmp_file = output_file.with_suffix(f'.{os.getpid()}.tmp')
+    with tmp_file.open('w', encoding='utf-8') as f:
+        json.dump(partial, f)
+    os.replace(tmp_file, output_file)
+    return output_file
+
+
+def read_shards(folder: Path | str, result_name: str) -> tuple[list, dict, list, dict]:
+    """Union the partial results of all shards of a result.
+    Return the catalogues of modifications and cleavages (unsorted) and the sites per experiment, with the
+    experiments in the order of the shards. Raises ValueError if a shard is missing."""
+    shard_files = sorted(Path(folder).glob(f'{result_name}.shard-*-of-*.json'))
+    if not shard_files:
+        raise ValueError(f"No shards of {result_name} found in {folder}")
+    partials = []
+    for file in shard_files:
+        with file.open(encoding='utf-8') as f:
+            partials.append(json.load(f))
+    counts = {partial['shard'][1] for partial in partials}
+    if len(counts) != 1:
+        raise ValueError(f"Shards of {result_name} in {folder} were split into different numbers of shards: {sorted(counts)}")
+    count = counts.pop()
+    missing = sorted(set(range(count)).difference(partial['shard'][0] for partial in partials))
+    if missing:
+        raise ValueError(f"Shards {', '.join(f'{index}/{count}' for index in missing)} of {result_name} are missing in {folder}")
+
+    all_mods = []
+    all_cleavages = []
+    mods_for_exp = {}
+    cleavages_for_exp = {}
+    for partial in sorted(partials, key=lambda partial: partial['shard'][0]):
+        all_mods.extend(partial['mods'])
+        all_cleavages.extend(partial['cleavages'])
+        for experiment, mods in partial['mods_for_exp'].items():
+            mods_for_exp.setdefault(experiment, set()).update(mods)
+        for experiment, cleavages in partial['cleavages_for_exp'].items():
+            cleavages_for_exp.setdefault(experiment, set()).update(cleavages)
+    return all_mods, mods_for_exp, all_cleavages, cleavages_for_exp
@@ -1,11 +1,16 @@
 """Module for plotting cleavages and PTMs on the sequence plot."""
+import heapq
 import math
+import warnings
 from pathlib import Path
 
-import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
-from protein_sequencing import utils, sequence_plot
+from protein_sequencing import instrumentation, utils, sequence_plot
+from protein_sequencing.layout import Layout
+
+# gap between two rows of PTM labels, the rows are label_length + PTM_LABEL_ROW_GAP pixels apart
+PTM_LABEL_ROW_GAP = 10
 
 class DetailsPlotter:
     """Class to plot cleavages and PTMs on the sequence plot."""
@@ -16,41 +21,39 @@ class DetailsPlotter:
         self.plot_config = plot_config
         self.input_file = input_file
         self.output_path = output_path
+        self.region_label_offset = None
+        self.region_index = None
         if not Path(self.output_path).exists():
             Path(self.output_path).mkdir(parents=True, exist_ok=True)
 
+    def get_region_index(self) -> tuple[np.ndarray, dict[str, int]]:
+        """Return the index of the regions, built once per plot: the last position of every region, as a running
+        maximum so that it is sorted for searchsorted, and the region of the sites of each exon isoform."""
+        if self.region_index is None:
+            region_ends = np.maximum.accumulate([region[1] for region in self.config.REGIONS])
+            exon_regions = {}
+            for isoform, exon_offset in (('exon1', utils.EXON_1_OFFSET), ('exon2', utils.EXON_2_OFFSET)):
+                index = next((index for index, region in enumerate(self.config.REGIONS) if region[1] == exon_offset['index_end']), None)
+                if exon_offset['index_start'] != -1 and index is not None:
+                    exon_regions[isoform] = index
+            self.region_index = (region_ends, exon_regions)
+        return self.region_index
+
+    def get_site_regions(self, positions, isoforms) -> np.ndarray:
+        """Return the region of every site from its first position, sites of an exon isoform belong to its exon."""
+        region_ends, exon_regions = self.get_region_index()
+        site_regions = np.searchsorted(region_ends, np.asarray(positions, dtype=int))
+        isoforms = np.asarray(isoforms, dtype=object)
+        for isoform, index in exon_regions.items():
+            site_regions[isoforms == isoform] = index
+        return site_regions
+
     def get_present_regions(self, positions, isoforms):
         """Get the regions present in the cleavages or PTMs."""
-        ranges = []
-        for position_range in positions:
-            if '-' in str(position_range):
-                start, end = map(int, position_range.split('-'))
-                ranges.append((start, end))
-            else:
-                start = end = int(position_range)
-                ranges.append((start, end))
-
-        region_ranges = []
-        region_start = 1
-        for _, region_end, _, _ in self.config.REGIONS:
-            region_ranges.append((region_start, region_end))
-            region_start = region_end + 1
-
-        regions_present = [False] * len(region_ranges)
-        region_index = 0
-        for i, position_range in enumerate(ranges):
-            if isoforms[i] == 'exon1':
-                index = next((index for index, region in enumerate(self.config.REGIONS) if region[1] == utils.EXON_1_OFFSET["index_end"]), None)
-                if index:
-                    regions_present[index] = True
-            elif isoforms[i] == 'exon2':
-                index = next((index for index, region in enumerate(self.config.REGIONS) if region[1] == utils.EXON_2_OFFSET["index_end"]), None)
-                if index:
-                    regions_present[index] = True
-            while position_range[0] > region_ranges[region_index][1]:
-                region_index += 1
-            regions_present[region_index] = True
-        return regions_present
+        starts = [int(str(position_range).split('-')[0]) for position_range in positions]
+        regions_present = np.zeros(len(self.config.REGIONS), dtype=bool)
+        regions_present[self.get_site_regions(starts, isoforms)] = True
+        return regions_present.tolist()
 
     def get_present_regions_cleavage(self, cleavage_df: pd.DataFrame):
         """Get the regions present in the cleavages."""
@@ -65,15 +68,17 @@ class DetailsPlotter:
         isoforms = ptm_df.iloc[2:3,2:].values[0].tolist()
         return self.get_present_regions(ptms, isoforms)
 
-    def plot_line_with_label_horizontal(self, fig: go.Figure, x_0: int, x_1: int, y_0: int, y_1: int, y_2: int, y_3: int, y_label: int, label: str, ptm: bool, ptm_color: str | None = None, ptm_modification: str | None = None):
-        """Plot a line with a label for the horizontal plot."""
+    def plot_line_with_label_horizontal(self, fig: Layout, x_0: int, x_1: int, y_0: int, y_1: int, y_2: int, y_3: int, y_label: int, label: str, ptm: bool, ptm_color: str | None = None, ptm_modification: str | None = None, show_label: bool = True):
+        """Plot a line with a label for the horizontal plot, the label is left out if show_label is False."""
         line_color = "black"
         if ptm:
             line_color = ptm_color
-        fig.add_trace(go.Scatter(x=[x_0, x_0, x_1, x_1],
-                                y=[y_0, y_1, y_2, y_3],
-                                mode='lines',
-                                line={"color": line_color, "width": 1}, showlegend=False, hoverinfo='none'))
+        fig.add_scatter(x=[x_0, x_0, x_1, x_1],
+                        y=[y_0, y_1, y_2, y_3],
+                        mode='lines',
+                        line={"color": line_color, "width": 1}, showlegend=False, hoverinfo='none')
+        if not show_label:
+            return fig
         if ptm:
             color=ptm_color
             if f'{ptm_modification}({label[0]})@{label[1:]}' in self.config.PTMS_TO_HIGHLIGHT:
@@ -100,15 +105,17 @@ class DetailsPlotter:
                                 ))
         return fig
 
-    def plot_line_with_label_vertical(self, fig: go.Figure, x_0: int, x_1: int, x_2: int, x_3: int, y_0: int, y_1: int, x_label: int, label: str, ptm: bool, ptm_color: str | None = None, ptm_modification: str | None = None):
-        """Plot a line with a label for the vertical plot."""
+    def plot_line_with_label_vertical(self, fig: Layout, x_0: int, x_1: int, x_2: int, x_3: int, y_0: int, y_1: int, x_label: int, label: str, ptm: bool, ptm_color: str | None = None, ptm_modification: str | None = None, show_label: bool = True):
+        """Plot a line with a label for the vertical plot, the label is left out if show_label is False."""
         line_color = "black"
         if ptm:
             line_color = ptm_color
-        fig.add_trace(go.Scatter(x=[x_0, x_1, x_2, x_3],
-                                y=[y_0, y_0, y_1, y_1],
-                                mode='lines',
-                                line={"color": line_color, "width": 1}, showlegend=False, hoverinfo='none'))
+        fig.add_scatter(x=[x_0, x_1, x_2, x_3],
+                        y=[y_0, y_0, y_1, y_1],
+                        mode='lines',
+                        line={"color": line_color, "width": 1}, showlegend=False, hoverinfo='none')
+        if not show_label:
+            return fig
         if ptm:
             color=ptm_color
             if f'{ptm_modification}({label[0]})@{label[1:]}' in self.config.PTMS_TO_HIGHLIGHT:
@@ -132,13 +139,15 @@ class DetailsPlotter:
                                 'color': color})
         return fig
 
-    def plot_range_with_label_horizontal(self, fig: go.Figure, x_0_start: int, x_0_end: int, x_1: int, y_0: int, y_1: int, y_2: int, y_3: int, y_label: int, label: str):
-        """Plot a range with a label for the horizontal plot."""
-        fig.add_trace(go.Scatter(x=[x_0_start, x_0_start, x_1, x_1, x_1, x_0_end, x_0_end],
-                                y=[y_0, y_1, y_2, y_3, y_2, y_1, y_0],
-                                mode='lines',
-                                fill='toself',
-                                line={"color": "black", "width": 1}, showlegend=False, hoverinfo='none'))
+    def plot_range_with_label_horizontal(self, fig: Layout, x_0_start: int, x_0_end: int, x_1: int, y_0: int, y_1: int, y_2: int, y_3: int, y_label: int, label: str, show_label: bool = True):
+        """Plot a range with a label for the horizontal plot, the label is left out if show_label is False."""
+        fig.add_scatter(x=[x_0_start, x_0_start, x_1, x_1, x_1, x_0_end, x_0_end],
+                        y=[y_0, y_1, y_2, y_3, y_2, y_1, y_0],
+                        mode='lines',
+                        fill='toself',
+                        line={"color": "black", "width": 1}, showlegend=False, hoverinfo='none')
+        if not show_label:
+            return fig
 
         color = self.plot_config.CLEAVAGE_LABEL_COLOR
         if label in self.plot_config.CLEAVAGES_TO_HIGHLIGHT:
@@ -152,13 +161,15 @@ class DetailsPlotter:
                                 'color': color})
         return fig
 
-    def plot_range_with_label_vertical(self, fig: go.Figure, x_0: int, x_1: int, x_2: int, x_3: int, y_0_start: int, y_0_end: int, y_1: int, x_label: int, label: str):
-        """Plot a range with a label for the vertical plot."""
-        fig.add_trace(go.Scatter(x=[x_0, x_1, x_2, x_3, x_2, x_1, x_0],
-                                y=[y_0_start, y_0_start, y_1, y_1, y_1, y_0_end, y_0_end],
-                                mode='lines',
-                                fill='toself',
-                                line={'color': 'black', 'width': 1}, showlegend=False, hoverinfo='none'))
+    def plot_range_with_label_vertical(self, fig: Layout, x_0: int, x_1: int, x_2: int, x_3: int, y_0_start: int, y_0_end: int, y_1: int, x_label: int, label: str, show_label: bool = True):
+        """Plot a range with a label for the vertical plot, the label is left out if show_label is False."""
+        fig.add_scatter(x=[x_0, x_1, x_2, x_3, x_2, x_1, x_0],
+                        y=[y_0_start, y_0_start, y_1, y_1, y_1, y_0_end, y_0_end],
+                        mode='lines',
+                        fill='toself',
+                        line={'color': 'black', 'width': 1}, showlegend=False, hoverinfo='none')
+        if not show_label:
+            return fig
         color = self.plot_config.CLEAVAGE_LABEL_COLOR
         if label in self.plot_config.CLEAVAGES_TO_HIGHLIGHT:
             color = self.plot_config.CLEAVAGE_HIGHLIGHT_COLOR
@@ -170,7 +181,7 @@ class DetailsPlotter:
                                 'color': color})
         return fig
 
-    def plot_groups_horizontal(self, fig: go.Figure, df: pd.DataFrame, x_0_groups: int, y_0_groups: int, dx: int, dy: int, x_label: int, y_label: int, last_region: int, group_dircetion: int, ptm: bool):
+    def plot_groups_horizontal(self, fig: Layout, mean_values: np.ndarray, x_0_groups: int, y_0_groups: int, dx: int, dy: int, x_label: int, y_label: int, last_region: int, group_dircetion: int, ptm: bool):
         """Plot the groups for the horizontal plot."""
         x_margin = 0
         if dx % 2 != 0:
@@ -185,22 +196,28 @@ class DetailsPlotter:
         fig.add_shape(type='rect',
                         x0=x_0_groups - dx//2 - x_margin,
                         y0=y_0_groups,
-                        x1=x_0_groups + dx * len(df.iloc[0:1,:].columns) - dx//2,
-                        y1=y_0_groups + dy * len(df.index) + 1,
+                        x1=x_0_groups + dx * mean_values.shape[1] - dx//2,
+                        y1=y_0_groups + dy * mean_values.shape[0] + 1,
                         fillcolor='grey',
                         line={'color': 'grey', 'width': 1},
                         showlegend=False,
                         layer='below',)
-        fig.add_trace(go.Heatmap(z=df,
-                        x0=x_0_groups,
+        z, edges = self.bin_sites(mean_values, dx)
+        if len(edges) == mean_values.shape[1] + 1:
+            cells = {'x0': x_0_groups, 'dx': dx}
+        else:
+            # cells of merged sites, the last one may hold fewer sites
+            cells = {'x': x_0_groups - dx/2 + edges*dx}
+        fig.add_heatmap(z=z,
+                        **cells,
                         y0=y_0_groups+dy//2,
-                        dx=dx, dy=dy,
+                        dy=dy,
                         showscale=False, hoverinfo='none',
                         xgap=1, ygap=1,
                         zmin=0,
                         zmax=1,
                         zmid=0.5,
-                        colorscale=[[0, color_low], [0.5, color_mid], [1, color_high]]))
+                        colorscale=[[0, color_low], [0.5, color_mid], [1, color_high]])
         yanchor = 'bottom'
         xanchor = 'left'
         if group_dircetion == -1:
@@ -218,7 +235,7 @@ class DetailsPlotter:
                             'color': 'black'})
         return fig
 
-    def plot_groups_vertical(self, fig: go.Figure, df: pd.DataFrame, x_0_groups: int, y_0_groups: int, dx: int, dy: int, x_label: int, y_label: int, last_region: int, group_dircetion: int, ptm: bool):
+    def plot_groups_vertical(self, fig: Layout, mean_values: np.ndarray, x_0_groups: int, y_0_groups: int, dx: int, dy: int, x_label: int, y_label: int, last_region: int, group_dircetion: int, ptm: bool):
         """Plot the groups for the vertical plot."""
         y_margin = 0
         if dy % 2 != 0:
@@ -233,23 +250,29 @@ class DetailsPlotter:
         fig.add_shape(type='rect',
                         x0=x_0_groups,
                         y0=y_0_groups + dy//2 + y_margin,
-                        x1=x_0_groups + dx * len(df.index) + 1,
-                        y1=y_0_groups - dy * len(df.iloc[0:1,:].columns) + dy//2,
+                        x1=x_0_groups + dx * mean_values.shape[0] + 1,
+                        y1=y_0_groups - dy * mean_values.shape[1] + dy//2,
                         fillcolor='grey',
                         line={'color': 'grey', 'width': 1},
                         showlegend=False,
                         layer='below',)
 
-        fig.add_trace(go.Heatmap(z=df.T,
+        z, edges = self.bin_sites(mean_values, dy)
+        if len(edges) == mean_values.shape[1] + 1:
+            cells = {'y0': y_0_groups, 'dy': -dy}
+        else:
+            # cells of merged sites, the last one may hold fewer sites
+            cells = {'y': y_0_groups + dy/2 - edges*dy}
+        fig.add_heatmap(z=z.T,
                         x0=x_0_groups+dx//2,
-                        y0=y_0_groups,
-                        dx=dx, dy=-dy,
+                        dx=dx,
+                        **cells,
                         showscale=False, hoverinfo='none',
                         xgap=1, ygap=1,
                         zmin=0,
                         zmax=1,
                         zmid=0.5,
-                        colorscale=[[0, color_low], [0.5, color_mid], [1, color_high]]))
+                        colorscale=[[0, color_low], [0.5, color_mid], [1, color_high]])
         xanchor = 'left'
         if group_dircetion == -1:
             xanchor = 'right'
@@ -263,9 +286,9 @@ class DetailsPlotter:
                     'color': 'black'})
         return fig
 
-    def plot_group_labels_horizontal(self, fig: go.Figure, mean_values: pd.DataFrame, y_0_groups: int, dy: int):
+    def plot_group_labels_horizontal(self, fig: Layout, groups: list[str], y_0_groups: int, dy: int):
         """Plot the group labels for the horizontal plot."""
-        for i, group in enumerate(mean_values.index):
+        for i, group in enumerate(groups):
             y_0_rect = y_0_groups + i*dy
             x_1_rect = self.calculate_group_space()
             fig.add_shape(type='rect',
@@ -293,9 +316,9 @@ class DetailsPlotter:
         red, green, blue = tuple(int(self.plot_config.GROUPS[group][1][i:i+2], 16) for i in (1, 3, 5))
         return '#000000' if red*0.299 + green*0.587 + blue*0.114 > 130 else '#ffffff'
 
-    def plot_group_labels_vertical(self, fig: go.Figure, mean_values: pd.DataFrame, x_0_groups: int, dx: int):
+    def plot_group_labels_vertical(self, fig: Layout, groups: list[str], x_0_groups: int, dx: int):
         """Plot the group labels for the vertical plot."""
-        for i, group in enumerate(mean_values.index):
+        for i, group in enumerate(groups):
             x_0_rect = x_0_groups + i*dx
             y_0_rect = utils.get_height()
             y_rect = self.calculate_group_space()
@@ -322,44 +345,93 @@ class DetailsPlotter:
                     color=color))
 
     def preprocess_groups(self, df: pd.DataFrame):
-        """Preprocess the groups for the heatmap."""
-        df.columns = df.iloc[0]
-        labels = df.iloc[1:2,2:].values.flatten().tolist()
-        df = df.iloc[3:]
-
-        reverse_group_mapping = {}
-        for k, v in self.plot_config.GROUPS.items():
-            values = v[0]
+        """Preprocess the groups for the heatmap.
+        Returns the mean of every group (rows, in the order of GROUPS) at every site (columns) as one matrix,
+        the regions are drawn from views of it."""
+        labels = df.iloc[1,2:].tolist()
+        groups = [*self.plot_config.GROUPS]
+        group_index = {}
+        for i, (_, (values, _)) in enumerate(self.plot_config.GROUPS.items()):
             for value in values:
-                reverse_group_mapping[value] = k
-        df.iloc[:,1] = df.iloc[:,1].map(reverse_group_mapping)
-        mean_values = df.iloc[:,2:].astype(float).groupby(df.iloc[:,1]).mean()
-        mean_values = mean_values.reindex([*self.plot_config.GROUPS])
-
-        return mean_values, labels
+                group_index[value] = i
+        sample_groups = df.iloc[3:,1].map(group_index)
+        in_group = sample_groups.notna().to_numpy()
+        sample_groups = sample_groups.to_numpy()[in_group].astype(int)
+        values = df.iloc[3:,2:].to_numpy(dtype=float)[in_group]
+
+        # sums and counts of all groups as one product with the group membership of the samples,
+        # missing values are left out of the mean of their group, as by pandas
+        membership = np.zeros((len(groups), len(sample_groups)))
+        membership[sample_groups, np.arange(len(sample_groups))] = 1.0
+        present = ~np.isnan(values)
+        sums = membership @ np.where(present, values, 0.0)
+        counts = membership @ present
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_values = sums / counts
+
+        return mean_values, groups, labels
+
+    def bin_sites(self, mean_values: np.ndarray, pixels_per_site: int):
+        """Merge adjacent sites of a region into one heatmap cell while a site is narrower than
+        HEATMAP_MIN_CELL_PIXELS. Returns the mean of every cell and the index of the first site of every cell
+        and of the end of the region."""
+        sites = mean_values.shape[1]
+        min_cell_pixels = getattr(self.plot_config, 'HEATMAP_MIN_CELL_PIXELS', 4)
+        sites_per_cell = max(1, math.ceil(min_cell_pixels / max(abs(pixels_per_site), 1)))
+        edges = np.minimum(np.arange(0, sites + sites_per_cell, sites_per_cell), sites)
+        if sites_per_cell == 1:
+            return mean_values, edges
+        present = ~np.isnan(mean_values)
+        sums = np.add.reduceat(np.where(present, mean_values, 0.0), edges[:-1], axis=1)
+        counts = np.add.reduceat(present, edges[:-1], axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts, edges
+
+    def pack_label_rows(self, positions, label_width: int, max_rows: int) -> tuple[np.ndarray, int]:
+        """Assign labels centered at positions along the sequence to rows, greedily in the order of the
+        positions: a label goes into the first row that is free at its position. Once all max_rows rows are
+        taken, it goes into the row that frees up first and overlaps its last label.
+        Returns the row of every label and the number of overlapping labels."""
+        rows = np.zeros(len(positions), dtype=int)
+        free_rows = list(range(max_rows))
+        # (end of the last label, row) of the rows in use
+        used_rows = []
+        overlapping = 0
+        for i in np.argsort(positions, kind='stable'):
+            start = positions[i] - label_width / 2
+            while used_rows and used_rows[0][0] <= start:
+                heapq.heappush(free_rows, heapq.heappop(used_rows)[1])
+            if free_rows:
+                row = heapq.heappop(free_rows)
+            else:
+                _, row = heapq.heappop(used_rows)
+                overlapping += 1
+            rows[i] = row
+            heapq.heappush(used_rows, (positions[i] + label_width / 2, row))
+        return rows, overlapping
 
     def offset_region_label_from_angle(self):
         """Calculate the offset for the region label based on the angle."""
-        longest_label = ''
-        for (_, _, _, region_label_short) in self.config.REGIONS:
-            if utils.get_label_length(region_label_short) > utils.get_label_length(longest_label):
-                longest_label = region_label_short
+        # called for every region label, the regions and the angle do not change during a plot
+        if self.region_label_offset is None:
+            length = max((utils.get_label_length(region_label_short) for (_, _, _, region_label_short) in self.config.REGIONS), default=0)
+            height = utils.get_label_height()
 
-        length = utils.get_label_length(longest_label)
-        height = utils.get_label_height()
+            angle_radians = math.radians(-self.plot_config.REGION_LABEL_ANGLE_GROUPS)
+            dy = abs((length / 2) * math.sin(angle_radians)) + abs((height / 2) * math.cos(angle_radians))
+            self.region_label_offset = int(dy)+10
+        return self.region_label_offset
 
-        angle_radians = math.radians(-self.plot_config.REGION_LABEL_ANGLE_GROUPS)
-        dy = abs((length / 2) * math.sin(angle_radians)) + abs((height / 2) * math.cos(angle_radians))
 
-        return int(dy)+10
-
-
-    def plot_cleavages(self, fig: go.Figure, cleavage_df: pd.DataFrame, pixels_per_cleavage: int, label_plot_height: int, above: str):
+    @instrumentation.traced()
+    def plot_cleavages(self, fig: Layout, cleavage_df: pd.DataFrame, pixels_per_cleavage: int, label_plot_height: int, above: str):
         """Plot the cleavages on the sequence plot."""
-        mean_values, cleavages = self.preprocess_groups(cleavage_df)
+        instrumentation.count(cleavages=len(cleavage_df.columns) - 2, samples=len(cleavage_df) - 3)
+        mean_values, groups, cleavages = self.preprocess_groups(cleavage_df)
         isoforms = cleavage_df.iloc[2:3,2:].values.flatten().tolist()
         if above == 'B':
-            mean_values = mean_values.iloc[::-1]
+            mean_values = mean_values[::-1]
+            groups = groups[::-1]
 
         longest_label = ''
         for cleavage in cleavages[::-1]:
@@ -369,8 +441,9 @@ class DetailsPlotter:
         group_direction = 1 if above == 'A' else -1
         first_cleavage_in_region = 0
         cleavage_idx = 0
-        last_end = self.config.REGIONS[0][1]
-        last_region = 0
+        # labels of cleavages narrower than the font would overlap, only every label_step-th column gets its label
+        label_step = math.ceil(self.config.FONT_SIZE / pixels_per_cleavage)
+        hidden_labels = 0
 
         if self.config.FIGURE_ORIENTATION == 0:
             y_0_line = utils.SEQUENCE_BOUNDARIES['y1'] if above == 'A' else utils.SEQUENCE_BOUNDARIES['y0']
@@ -385,9 +458,9 @@ class DetailsPlotter:
             dy_label = self.offset_region_label_from_angle()
             vertical_space_left -= dy_label*2
             dx = pixels_per_cleavage
-            dy = vertical_space_left//len(mean_values.index)*group_direction
+            dy = vertical_space_left//len(groups)*group_direction
 
-            self.plot_group_labels_horizontal(fig, mean_values, y_0_groups, dy)
+            self.plot_group_labels_horizontal(fig, groups, y_0_groups, dy)
         else:
             x_0_line = utils.SEQUENCE_BOUNDARIES['x1'] if above == 'A' else utils.SEQUENCE_BOUNDARIES['x0']
             x_1_line = x_0_line + 10 * group_direction
@@ -401,59 +474,57 @@ class DetailsPlotter:
             dx_label = self.offset_region_label_from_angle()
             horizontal_space_left -= dx_label*2
             dy = pixels_per_cleavage
-            dx = horizontal_space_left//len(mean_values.index)*group_direction
+            dx = horizontal_space_left//len(groups)*group_direction
 
-            self.plot_group_labels_vertical(fig, mean_values, x_0_groups, dx)
+            self.plot_group_labels_vertical(fig, groups, x_0_groups, dx)
+
+        # position of the lines on the sequence for the first and last residue of every cleavage
+        ranges = [tuple(map(int, str(cleavage).split('-'))) if '-' in str(cleavage) else (int(cleavage), int(cleavage))
+                  for cleavage in cleavages]
+        start_lines = utils.residue_pixels([start for start, _ in ranges], isoforms)
+        end_lines = utils.residue_pixels([end for _, end in ranges], isoforms)
+        # the sites of a region are contiguous, the heatmap of a region is a slice of the mean values
+        site_regions = self.get_site_regions([start for start, _ in ranges], isoforms).tolist()
+        region_starts = set((np.flatnonzero(np.diff(site_regions)) + 1).tolist())
 
-        previous_index = 0
         last_i = 0
-        for i, cleavage in enumerate(cleavages):
-            if '-' in str(cleavage):
-                start, end = map(int, cleavage.split('-'))
-            else:
-                start = end = int(cleavage)
-            if start > last_end or start < previous_index:
+        for i, (start, end) in enumerate(ranges):
+            if i in region_starts:
+                last_region = site_regions[i - 1]
                 if self.config.FIGURE_ORIENTATION == 0:
                     start_idx = cleavage_idx - (i - first_cleavage_in_region)
                     x_0_groups = start_idx * pixels_per_cleavage + self.get_horizontal_offset(dx)
                     x_divider = cleavage_idx * pixels_per_cleavage + self.get_horizontal_offset(dx)
                     x_label = x_0_groups + (x_divider-x_0_groups)//2 - dx//2
-                    y_label = y_0_groups + len(mean_values.index)*dy + (5+utils.get_label_height()//2) * group_direction
+                    y_label = y_0_groups + len(groups)*dy + (5+utils.get_label_height()//2) * group_direction
 
-                    self.plot_groups_horizontal(fig, mean_values.iloc[:,first_cleavage_in_region:i], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, False)
+                    self.plot_groups_horizontal(fig, mean_values[:,first_cleavage_in_region:i], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, False)
 
-                    fig.add_trace(go.Scatter(x=[x_divider,x_divider],
-                                y=[y_0_groups, y_0_groups+len(mean_values.index)*dy],
+                    fig.add_scatter(x=[x_divider,x_divider],
+                                y=[y_0_groups, y_0_groups+len(groups)*dy],
                                 mode='lines',
-                                line=dict(color="black", width=3), showlegend=False, hoverinfo='none'))
+                                line=dict(color="black", width=3), showlegend=False, hoverinfo='none')
                 else:
                     start_idx = cleavage_idx - (i - first_cleavage_in_region)
                     y_0_groups = utils.get_height() - start_idx * pixels_per_cleavage - self.get_vertical_offset(dy)
                     y_divider = utils.get_height() - cleavage_idx * pixels_per_cleavage - self.get_vertical_offset(dy)
                     y_label = y_0_groups - (y_0_groups - y_divider)//2 + dy//2
-                    x_label = x_0_groups + len(mean_values.index)*dx + (5+utils.get_label_height()//2) * group_direction
+                    x_label = x_0_groups + len(groups)*dx + (5+utils.get_label_height()//2) * group_direction
 
-                    self.plot_groups_vertical(fig, mean_values.iloc[:,first_cleavage_in_region:i], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, False)
+                    self.plot_groups_vertical(fig, mean_values[:,first_cleavage_in_region:i], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, False)
 
-                    fig.add_trace(go.Scatter(x=[x_0_groups, x_0_groups+len(mean_values.index)*dx],
+                    fig.add_scatter(x=[x_0_groups, x_0_groups+len(groups)*dx],
                                 y=[y_divider, y_divider],
                                 mode='lines',
-                                line=dict(color="black", width=3), showlegend=False, hoverinfo='none'))
-                if start < previous_index:
-                    last_region += 1
-                    last_end = self.config.REGIONS[last_region][1]
-                else:
-                    while start > last_end:
-                        last_region += 1
-                        last_end = self.config.REGIONS[last_region][1]
+                                line=dict(color="black", width=3), showlegend=False, hoverinfo='none')
                 cleavage_idx += 1
                 first_cleavage_in_region = i
+            show_label = cleavage_idx % label_step == 0
+            hidden_labels += not show_label
             if self.config.FIGURE_ORIENTATION == 0:
                 if start == end:
                     label = str(start)
-                    position = utils.get_position_with_offset(start, isoforms[i])
-                    x_0_line = position * utils.PIXELS_PER_AA + utils.SEQUENCE_OFFSET
-                    x_0_line = utils.offset_line_for_exon(x_0_line, start, self.config.FIGURE_ORIENTATION)
+                    x_0_line = start_lines[i]
                     x_1_line = cleavage_idx * pixels_per_cleavage + self.get_horizontal_offset(dx)
                     y_3_line = y_0_line + (label_plot_height - utils.get_label_length(label)) * group_direction
                     y_label = y_3_line + (utils.get_label_length(label) // 2 + 5) * group_direction
@@ -462,15 +533,11 @@ class DetailsPlotter:
                                     x_0_line, x_1_line,
                                     y_0_line, y_1_line, y_2_line, y_3_line,
                                     y_label,
-                                    label, False, None, None)
+                                    label, False, None, None, show_label)
                 else:
                     label = f'{start}-{end}'
-                    start_position = utils.get_position_with_offset(start, isoforms[i])
-                    end_position = utils.get_position_with_offset(end, isoforms[i])
-                    x_0_start_line = start_position * utils.PIXELS_PER_AA + utils.SEQUENCE_OFFSET
-                    x_0_end_line = end_position * utils.PIXELS_PER_AA + utils.SEQUENCE_OFFSET
-                    x_0_start_line = utils.offset_line_for_exon(x_0_start_line, start, self.config.FIGURE_ORIENTATION)
-                    x_0_end_line = utils.offset_line_for_exon(x_0_end_line, end, self.config.FIGURE_ORIENTATION)
+                    x_0_start_line = start_lines[i]
+                    x_0_end_line = end_lines[i]
                     x_1_line = cleavage_idx * pixels_per_cleavage + self.get_horizontal_offset(dx)
                     y_3_line = y_0_line + (label_plot_height - utils.get_label_length(label)) * group_direction
                     y_label = y_3_line + (utils.get_label_length(label) // 2 + 5) * group_direction
@@ -479,13 +546,11 @@ class DetailsPlotter:
                                         x_0_start_line, x_0_end_line, x_1_line,
                                         y_0_line, y_1_line, y_2_line, y_3_line,
                                         y_label,
-                                        label)
+                                        label, show_label)
             else:
                 if start == end:
                     label = str(start)
-                    position = utils.get_position_with_offset(start, isoforms[i])
-                    y_0_line = utils.get_height() - position * utils.PIXELS_PER_AA - utils.SEQUENCE_OFFSET
-                    y_0_line = utils.offset_line_for_exon(y_0_line, start, self.config.FIGURE_ORIENTATION)
+                    y_0_line = start_lines[i]
                     y_1_line = utils.get_height() - cleavage_idx * pixels_per_cleavage - self.get_vertical_offset(dy)
                     x_3_line = x_0_line + (label_plot_height - utils.get_label_length(label)) * group_direction
                     x_label = x_3_line + (utils.get_label_length(label) // 2 + 5) * group_direction
@@ -494,15 +559,11 @@ class DetailsPlotter:
                                     x_0_line, x_1_line, x_2_line, x_3_line,
                                     y_0_line, y_1_line,
                                     x_label,
-                                    label, False, None, None)
+                                    label, False, None, None, show_label)
                 else:
                     label = f'{start}-{end}'
-                    start_position = utils.get_position_with_offset(start, isoforms[i])
-                    end_position = utils.get_position_with_offset(end, isoforms[i])
-                    y_0_start_line = utils.get_height() - start_position * utils.PIXELS_PER_AA - utils.SEQUENCE_OFFSET
-                    y_0_end_line = utils.get_height() - end_position * utils.PIXELS_PER_AA - utils.SEQUENCE_OFFSET
-                    y_0_start_line = utils.offset_line_for_exon(y_0_start_line, start, self.config.FIGURE_ORIENTATION)
-                    y_0_end_line = utils.offset_line_for_exon(y_0_end_line, end, self.config.FIGURE_ORIENTATION)
+                    y_0_start_line = start_lines[i]
+                    y_0_end_line = end_lines[i]
                     y_1_line = utils.get_height() - cleavage_idx * pixels_per_cleavage - self.get_vertical_offset(dy)
                     x_3_line = x_0_line + (label_plot_height - utils.get_label_length(label)) * group_direction
                     x_label = x_3_line + (utils.get_label_length(label) // 2 + 5) * group_direction
@@ -512,34 +573,30 @@ class DetailsPlotter:
                                         y_0_start_line, y_0_end_line,
                                         y_1_line,
                                         x_label,
-                                        label)
+                                        label, show_label)
             cleavage_idx += 1
-            previous_index = start
             last_i = i
-        while start > last_end:
-            last_region += 1
-            last_end = self.config.REGIONS[last_region][1]
-
-        if isoforms[first_cleavage_in_region] == 'exon2' and isoforms[first_cleavage_in_region-1] != 'exon1':
-            last_region += 1
+        last_region = site_regions[-1]
+        if hidden_labels:
+            warnings.warn(f'{hidden_labels} of {len(cleavages)} cleavage labels are left out, the columns are narrower than the font.')
 
         # plot groups for last region
         if self.config.FIGURE_ORIENTATION == 0:
             start_idx = cleavage_idx - (last_i - first_cleavage_in_region)-1
             x_0_groups = start_idx * pixels_per_cleavage + self.get_horizontal_offset(dx)
-            region_length = len(mean_values.iloc[0:1,first_cleavage_in_region:].columns)
+            region_length = mean_values.shape[1] - first_cleavage_in_region
             x_label = x_0_groups + (region_length * pixels_per_cleavage)//2 - dx//2
-            y_label = y_0_groups + len(mean_values.index)*dy + (5+utils.get_label_height()//2) * group_direction
-            self.plot_groups_horizontal(fig, mean_values.iloc[:,first_cleavage_in_region:], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, False)
+            y_label = y_0_groups + len(groups)*dy + (5+utils.get_label_height()//2) * group_direction
+            self.plot_groups_horizontal(fig, mean_values[:,first_cleavage_in_region:], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, False)
 
             self.create_custome_colorscale(fig, vertical_space_left, group_direction, x_0_groups, y_0_groups, region_length, pixels_per_cleavage, False)
         else:
             start_idx = cleavage_idx - (last_i - first_cleavage_in_region)-1
             y_0_groups = utils.get_height() - start_idx * pixels_per_cleavage - self.get_vertical_offset(dy)
-            region_length = len(mean_values.iloc[0:1,first_cleavage_in_region:].columns)
+            region_length = mean_values.shape[1] - first_cleavage_in_region
             y_label = y_0_groups - (region_length * pixels_per_cleavage)//2 + dy//2
-            x_label = x_0_groups + len(mean_values.index)*dx + (5+utils.get_label_height()//2) * group_direction
-            self.plot_groups_vertical(fig, mean_values.iloc[:,first_cleavage_in_region:], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, False)
+            x_label = x_0_groups + len(groups)*dx + (5+utils.get_label_height()//2) * group_direction
+            self.plot_groups_vertical(fig, mean_values[:,first_cleavage_in_region:], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, False)
 
             self.create_custome_colorscale(fig, horizontal_space_left, group_direction, x_0_groups, y_0_groups, region_length, pixels_per_cleavage, False)
 
@@ -551,38 +608,51 @@ class DetailsPlotter:
         """Get the vertical offset for the heatmap."""
         return self.calculate_group_space() + dy//2
 
-    def plot_ptms(self, fig: go.Figure, ptm_df: pd.DataFrame, pixels_per_ptm: int, label_plot_height: int, above: str, second_row: bool):
+    @instrumentation.traced()
+    def plot_ptms(self, fig: Layout, ptm_df: pd.DataFrame, pixels_per_ptm: int, label_plot_height: int, above: str):
         """Plot the PTMs."""
+        instrumentation.count(ptms=len(ptm_df.columns) - 2, samples=len(ptm_df) - 3)
         group_direction = 1 if above == 'A' else -1
-        mean_values, ptms = self.preprocess_groups(ptm_df)
+        mean_values, groups, ptms = self.preprocess_groups(ptm_df)
         isoforms = ptm_df.iloc[2:3,2:].values.flatten().tolist()
         # For debugging purposes
-        #new_row = pd.DataFrame([ptms], columns=mean_values.columns, index=['ptm_position'])
-        #mean_values = pd.concat([new_row, mean_values])
-        #mean_values.to_csv('plotting_data_ptms.csv', sep=',')
+        #pd.DataFrame(mean_values, index=groups, columns=ptms).to_csv('plotting_data_ptms.csv', sep=',')
 
-        label_length = utils.get_label_length(ptms[-1])
+        label_length = max(utils.get_label_length(ptm) for ptm in ptms)
+        row_pitch = label_length + PTM_LABEL_ROW_GAP
         # inverse index for group B
         if above == 'B':
-            mean_values = mean_values.iloc[::-1]
+            mean_values = mean_values[::-1]
+            groups = groups[::-1]
+
+        ptm_positions = [int(ptm[1:]) for ptm in ptms]
+        # the sites of a region are contiguous, the heatmap of a region is a slice of the mean values
+        site_regions = self.get_site_regions(ptm_positions, isoforms).tolist()
+        region_starts = set((np.flatnonzero(np.diff(site_regions)) + 1).tolist())
+
+        # labels too close to each other are spread over rows, as many as fit between the sequence and the rects
+        slots = np.arange(len(ptms)) + np.cumsum([i in region_starts for i in range(len(ptms))])
+        max_rows = max(1, (label_plot_height - self.plot_config.PTM_RECT_LENGTH - 25) // row_pitch)
+        label_rows, overlapping = self.pack_label_rows(slots * pixels_per_ptm, utils.get_label_height(), max_rows)
+        if overlapping:
+            warnings.warn(f'{overlapping} of {len(ptms)} PTM labels overlap, {max_rows} rows of labels fit into the plot.')
+        label_rows = label_rows.tolist()
+        rows = max(label_rows) + 1
+        label_space = row_pitch + self.plot_config.PTM_RECT_LENGTH + 10
+        if rows > 1:
+            label_space = rows*row_pitch + self.plot_config.PTM_RECT_LENGTH + 5
 
         if self.config.FIGURE_ORIENTATION == 0:
             y_0_line = utils.SEQUENCE_BOUNDARIES['y1'] if above == 'A' else utils.SEQUENCE_BOUNDARIES['y0']
             y_1_line = y_0_line + 10 * group_direction
-            y_2_line = y_0_line + (label_plot_height - label_length - 10 - self.plot_config.PTM_RECT_LENGTH - 10) * group_direction
-            if second_row:
-                y_2_line = y_0_line + (label_plot_height - 2*(label_length + 10) - self.plot_config.PTM_RECT_LENGTH - 5) * group_direction
+            y_2_line = y_0_line + (label_plot_height - label_space) * group_direction
         else:
             x_0_line = utils.SEQUENCE_BOUNDARIES['x1'] if above == 'A' else utils.SEQUENCE_BOUNDARIES['x0']
             x_1_line = x_0_line + 10 * group_direction
-            x_2_line = x_0_line + (label_plot_height - label_length - 10 - self.plot_config.PTM_RECT_LENGTH - 10) * group_direction
-            if second_row:
-                x_2_line = x_0_line + (label_plot_height - 2*(label_length + 10) - self.plot_config.PTM_RECT_LENGTH - 5) * group_direction
+            x_2_line = x_0_line + (label_plot_height - label_space) * group_direction
 
-        last_end = self.config.REGIONS[0][1]
         first_ptm_in_region = 0
         ptm_idx = 0
-        last_region = 0
 
         if self.config.FIGURE_ORIENTATION == 0:
             dx = pixels_per_ptm
@@ -591,9 +661,9 @@ class DetailsPlotter:
             # offset for region label
             dy_label = self.offset_region_label_from_angle()
             vertical_space_left -= dy_label*2
-            dy = vertical_space_left//len(mean_values.index)*group_direction
+            dy = vertical_space_left//len(groups)*group_direction
 
-            self.plot_group_labels_horizontal(fig, mean_values, y_0_groups, dy)
+            self.plot_group_labels_horizontal(fig, groups, y_0_groups, dy)
         else:
             dy = pixels_per_ptm
             x_0_groups = x_0_line + (label_plot_height + 10) * group_direction
@@ -601,59 +671,50 @@ class DetailsPlotter:
             # offset for region label
             dx_label = self.offset_region_label_from_angle()
             horizontal_space_left -= dx_label*2
-            dx = horizontal_space_left//len(mean_values.index)*group_direction
+            dx = horizontal_space_left//len(groups)*group_direction
+
+            self.plot_group_labels_vertical(fig, groups, x_0_groups, dx)
 
-            self.plot_group_labels_vertical(fig, mean_values, x_0_groups, dx)
+        # position of the lines on the sequence for every PTM
+        ptm_lines = utils.residue_pixels(ptm_positions, isoforms)
 
-        previous_ptm = 0
         last_i = 0
         for i, ptm in enumerate(ptms):
-            ptm_position = int(ptm[1:])
-            if ptm_position > last_end or ptm_position < previous_ptm:
+            if i in region_starts:
+                last_region = site_regions[i - 1]
                 if self.config.FIGURE_ORIENTATION == 0:
                     start_idx = ptm_idx - (i - first_ptm_in_region)
                     x_0_groups = start_idx * pixels_per_ptm + self.get_horizontal_offset(dx)
                     x_divider = ptm_idx * pixels_per_ptm + self.get_horizontal_offset(dx)
                     x_label = x_0_groups + (x_divider-x_0_groups)//2 - dx//2
-                    y_label = y_0_groups + len(mean_values.index)*dy + (5+utils.get_label_height()//2) * group_direction
+                    y_label = y_0_groups + len(groups)*dy + (5+utils.get_label_height()//2) * group_direction
 
-                    self.plot_groups_horizontal(fig, mean_values.iloc[:,first_ptm_in_region:i], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, True)
+                    self.plot_groups_horizontal(fig, mean_values[:,first_ptm_in_region:i], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, True)
 
-                    fig.add_trace(go.Scatter(x=[x_divider,x_divider],
-                                y=[y_0_groups, y_0_groups+len(mean_values.index)*dy],
+                    fig.add_scatter(x=[x_divider,x_divider],
+                                y=[y_0_groups, y_0_groups+len(groups)*dy],
                                 mode='lines',
-                                line=dict(color="black", width=3), showlegend=False, hoverinfo='none'))
+                                line=dict(color="black", width=3), showlegend=False, hoverinfo='none')
                 else:
                     start_idx = ptm_idx - (i - first_ptm_in_region)
                     y_0_groups = utils.get_height() - start_idx * pixels_per_ptm - self.get_vertical_offset(dy)
                     y_divider = utils.get_height() - ptm_idx * pixels_per_ptm - self.get_vertical_offset(dy)
                     y_label = y_0_groups - (y_0_groups - y_divider)//2 + dy//2
-                    x_label = x_0_groups + len(mean_values.index)*dx + (5+utils.get_label_height()//2) * group_direction
+                    x_label = x_0_groups + len(groups)*dx + (5+utils.get_label_height()//2) * group_direction
 
-                    self.plot_groups_vertical(fig, mean_values.iloc[:,first_ptm_in_region:i], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, True)
+                    self.plot_groups_vertical(fig, mean_values[:,first_ptm_in_region:i], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, True)
 
-                    fig.add_trace(go.Scatter(x=[x_0_groups, x_0_groups+len(mean_values.index)*dx],
+                    fig.add_scatter(x=[x_0_groups, x_0_groups+len(groups)*dx],
                                 y=[y_divider, y_divider],
                                 mode='lines',
-                                line=dict(color="black", width=3), showlegend=False, hoverinfo='none'))
-                if ptm_position < previous_ptm:
-                    last_region += 1
-                    last_end = self.config.REGIONS[last_region][1]
-                else:
-                    while ptm_position > last_end:
-                        last_region += 1
-                        last_end = self.config.REGIONS[last_region][1]
+                                line=dict(color="black", width=3), showlegend=False, hoverinfo='none')
                 ptm_idx += 1
                 first_ptm_in_region = i
             if self.config.FIGURE_ORIENTATION == 0:
-                position = utils.get_position_with_offset(ptm_position, isoforms[i])
-                x_0_line = position * utils.PIXELS_PER_AA + utils.SEQUENCE_OFFSET
-                x_0_line = utils.offset_line_for_exon(x_0_line, ptm_position, self.config.FIGURE_ORIENTATION)
+                x_0_line = ptm_lines[i]
                 x_1_line = ptm_idx * pixels_per_ptm + self.get_horizontal_offset(dx)
-                y_3_line = y_2_line + 10 * group_direction
-                if second_row and i % 2 == 1:
-                    x_1_line = ptm_idx * pixels_per_ptm + self.get_horizontal_offset(dx)
-                    y_3_line = y_2_line + (label_length + 10 + 5) * group_direction
+                # the leader line ends at the row of the label
+                y_3_line = y_2_line + (10 + label_rows[i]*row_pitch) * group_direction
                 y_label = y_3_line + (utils.get_label_length(ptm)+10) // 2 * group_direction
                 text_color = self.config.MODIFICATIONS[str(ptm_df.iloc[0,i+2])][1]
                 self.plot_line_with_label_horizontal(fig, x_0_line, x_1_line, y_0_line, y_1_line, y_2_line, y_3_line, y_label, ptm, True, text_color, str(ptm_df.iloc[0,i+2]))
@@ -667,14 +728,10 @@ class DetailsPlotter:
                         line=dict(width=1, color='grey'),
                         showlegend=False,)
             else:
-                position = utils.get_position_with_offset(ptm_position, isoforms[i])
-                y_0_line = utils.get_height() - position * utils.PIXELS_PER_AA - utils.SEQUENCE_OFFSET
-                y_0_line = utils.offset_line_for_exon(y_0_line, ptm_position, self.config.FIGURE_ORIENTATION)
+                y_0_line = ptm_lines[i]
                 y_1_line = utils.get_height() - ptm_idx * pixels_per_ptm - self.get_vertical_offset(dy)
-                x_3_line = x_2_line + 10 * group_direction
-                if second_row and i % 2 == 1:
-                    y_1_line = utils.get_height() - ptm_idx * pixels_per_ptm - self.get_vertical_offset(dy)
-                    x_3_line = x_2_line + (label_length + 10 + 5) * group_direction
+                # the leader line ends at the row of the label
+                x_3_line = x_2_line + (10 + label_rows[i]*row_pitch) * group_direction
                 x_label = x_3_line + (utils.get_label_length(ptm)+10) // 2 * group_direction
                 text_color = self.config.MODIFICATIONS[str(ptm_df.iloc[0,i+2])][1]
                 self.plot_line_with_label_vertical(fig, x_0_line, x_1_line, x_2_line, x_3_line, y_0_line, y_1_line, x_label, ptm, True, text_color, str(ptm_df.iloc[0,i+2]))
@@ -688,38 +745,31 @@ class DetailsPlotter:
                         line=dict(width=1, color='grey'),
                         showlegend=False,)
             ptm_idx += 1
-            previous_ptm = ptm_position
             last_i = i
-
-        while ptm_position > last_end:
-            last_region += 1
-            last_end = self.config.REGIONS[last_region][1]
-
-        if isoforms[first_ptm_in_region] == 'exon2' and isoforms[first_ptm_in_region-1] != 'exon1':
-            last_region += 1
+        last_region = site_regions[-1]
 
         # plot groups for last region
         if self.config.FIGURE_ORIENTATION == 0:
             start_idx = ptm_idx - (last_i - first_ptm_in_region)-1
             x_0_groups = start_idx * pixels_per_ptm + self.get_horizontal_offset(dx)
-            region_length = len(mean_values.iloc[0:1,first_ptm_in_region:].columns)
+            region_length = mean_values.shape[1] - first_ptm_in_region
             x_label = x_0_groups + (region_length * pixels_per_ptm)//2 - dx//2
-            y_label = y_0_groups + len(mean_values.index)*dy + (5+utils.get_label_height()//2) * group_direction
-            self.plot_groups_horizontal(fig, mean_values.iloc[:,first_ptm_in_region:], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, True)
+            y_label = y_0_groups + len(groups)*dy + (5+utils.get_label_height()//2) * group_direction
+            self.plot_groups_horizontal(fig, mean_values[:,first_ptm_in_region:], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, True)
 
             self.create_custome_colorscale(fig, vertical_space_left, group_direction, x_0_groups, y_0_groups, region_length, pixels_per_ptm, True)
 
         else:
             start_idx = ptm_idx - (last_i - first_ptm_in_region)-1
             y_0_groups = utils.get_height() - start_idx * pixels_per_ptm - self.get_vertical_offset(dy)
-            region_length = len(mean_values.iloc[0:1,first_ptm_in_region:].columns)
+            region_length = mean_values.shape[1] - first_ptm_in_region
             y_label = y_0_groups - (region_length * pixels_per_ptm)//2 + dy//2
-            x_label = x_0_groups + len(mean_values.index)*dx + (5+utils.get_label_height()//2) * group_direction
-            self.plot_groups_vertical(fig, mean_values.iloc[:,first_ptm_in_region:], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, True)
+            x_label = x_0_groups + len(groups)*dx + (5+utils.get_label_height()//2) * group_direction
+            self.plot_groups_vertical(fig, mean_values[:,first_ptm_in_region:], x_0_groups, y_0_groups, dx, dy, x_label, y_label, last_region, group_direction, True)
 
             self.create_custome_colorscale(fig, horizontal_space_left, group_direction, x_0_groups, y_0_groups, region_length, pixels_per_ptm, True)
 
-    def create_custome_colorscale(self, fig: go.Figure, vertical_space_left: int, group_direction: int, x_0_groups: int, y_0_groups: int, region_length: int, pixels_per_step: int, ptm: bool):
+    def create_custome_colorscale(self, fig: Layout, vertical_space_left: int, group_direction: int, x_0_groups: int, y_0_groups: int, region_length: int, pixels_per_step: int, ptm: bool):
         """Create a custom colorscale for the heatmap."""
         if ptm:
             colorscale = [
@@ -755,7 +805,7 @@ class DetailsPlotter:
             x_offset = vertical_space_left // 2 * group_direction
             y_bar = y_0_groups - region_length * pixels_per_step - 5
             x_bar = x_0_groups + x_offset - dx * 50
-        fig.add_trace(go.Heatmap(
+        fig.add_heatmap(
             x0=x_bar,
             y0=y_bar,
             z=z,
@@ -764,7 +814,7 @@ class DetailsPlotter:
             colorscale=colorscale,
             showscale=False,
             hoverinfo='none',
-        ))
+        )
         for i in range(3):
             percentage_label = f'{i*50}%'
             if self.config.FIGURE_ORIENTATION == 0:
@@ -829,27 +879,14 @@ class DetailsPlotter:
 
     def calculate_group_space(self):
         """Calculate the space needed for the group labels."""
-        longest_label = ''
-        for key in self.plot_config.GROUPS.keys():
-            if utils.get_label_length(key) > utils.get_label_length(longest_label):
-                longest_label = key
-        return utils.get_label_length(longest_label)+10
+        return max((utils.get_label_length(group) for group in self.plot_config.GROUPS), default=0)+10
 
     def calculate_legend_space(self, ptm: bool):
         """Calculate the space needed for the legend."""
         if self.config.FIGURE_ORIENTATION == 0:
-            longest_label = ''
-            if ptm:
-                for string in self.plot_config.PTM_LEGEND_TITLE.split('<br>'):
-                    if utils.get_label_length(string) > utils.get_label_length(longest_label):
-                        longest_label = string
-            else:
-                for string in self.plot_config.CLEAVAGE_LEGEND_TITLE.split('<br>'):
-                    if utils.get_label_length(string) > utils.get_label_length(longest_label):
-                        longest_label = string
-            if utils.get_label_length('100%') + 10 > utils.get_label_length(longest_label):
-                return utils.get_label_length('100%') + 10
-            return utils.get_label_length(longest_label)
+            title = self.plot_config.PTM_LEGEND_TITLE if ptm else self.plot_config.CLEAVAGE_LEGEND_TITLE
+            title_length = max(utils.get_label_length(string) for string in title.split('<br>'))
+            return max(utils.get_label_length('100%') + 10, title_length)
         else:
             if ptm:
                 title_height = utils.get_label_height() * (self.plot_config.PTM_LEGEND_TITLE.count('<br')+1)
@@ -865,8 +902,8 @@ class DetailsPlotter:
                 return set(ptm_df.iloc[0:1,2:].values.flatten().tolist())
         return set()
 
-    def create_details_plot(self):
-        """Create a detailed sequence plot."""
+    def create_details_layout(self) -> Layout:
+        """Compute the layout of the details plot, without creating a plotly figure."""
         legend = None
         present_mod_types = self.get_present_mod_types()
         if not 'A' in self.plot_config.INPUT_FILES.keys():
@@ -883,6 +920,8 @@ class DetailsPlotter:
             if self.plot_config.INPUT_FILES['B'][0] == 'PTM':
                 legend = 'B'
             fig = sequence_plot.create_plot(self.input_file, present_mod_types, None, legend, out_dir=self.output_path)
+        # the exons are known once the sequence is plotted
+        self.region_index = None
         cleavage_file_path = None
         ptm_file_path = None
         for above in self.plot_config.INPUT_FILES.keys():
@@ -900,7 +939,7 @@ class DetailsPlotter:
             # first we calculate the missing space above the sequence and then subtract it from the total height
             plot_space = utils.get_height() - (utils.get_height()-utils.SEQUENCE_BOUNDARIES['y0'])
 
-        label_plot_height = 150
+        label_plot_height = getattr(self.plot_config, 'LABEL_PLOT_HEIGHT', 150)
 
         if cleavage_file_path:
             cleavage_df = pd.read_csv(cleavage_file_path)
@@ -909,7 +948,9 @@ class DetailsPlotter:
             number_of_dividers = present_regions.count(True)-1
             cleavage_space = plot_space - self.calculate_legend_space(False) - self.calculate_group_space()
             pixels_per_cleavage = cleavage_space // (number_of_cleavages + number_of_dividers)
-            assert pixels_per_cleavage >= self.config.FONT_SIZE
+            # narrow columns are merged into heatmap cells and their labels thinned out while drawing
+            if pixels_per_cleavage < 1:
+                raise ValueError(f'{number_of_cleavages} cleavages do not fit into {cleavage_space} pixels, increase FIGURE_WIDTH or FIGURE_HEIGHT.')
 
             self.plot_cleavages(fig, cleavage_df, pixels_per_cleavage, label_plot_height, cleavage_above)
 
@@ -918,15 +959,18 @@ class DetailsPlotter:
             present_regions = self.get_present_regions_ptm(ptm_df)
             number_of_ptms = len(ptm_df.columns)
             number_of_dividers = present_regions.count(True)-1
-            second_row = False
             ptm_space = plot_space - self.calculate_legend_space(True) - self.calculate_group_space()
             pixels_per_ptm = ptm_space // (number_of_ptms + number_of_dividers)
-            if (number_of_ptms + number_of_dividers) * utils.get_label_height() > 2*ptm_space:
-                raise ValueError('Too many PTMs to fit in plot')
-            if (number_of_ptms + 2*number_of_dividers) * utils.get_label_height() > ptm_space:
-                second_row = True
+            if pixels_per_ptm < 1:
+                raise ValueError(f'{number_of_ptms} PTMs do not fit into {ptm_space} pixels, increase FIGURE_WIDTH or FIGURE_HEIGHT.')
+
+            self.plot_ptms(fig, ptm_df, pixels_per_ptm, label_plot_height, ptm_above)
 
-            self.plot_ptms(fig, ptm_df, pixels_per_ptm, label_plot_height, ptm_above, second_row)
+        return fig
+
+    def create_details_plot(self):
+        """Create a detailed sequence plot."""
+        fig = self.create_details_layout().to_figure(getattr(self.config, 'VALIDATE_FIGURES', False))
 
         utils.finalize_plotting(
             fig,
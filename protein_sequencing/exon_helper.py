@@ -2,7 +2,7 @@
 import os
 from pathlib import Path
 
-from protein_sequencing import uniprot_align, utils
+from protein_sequencing import instrumentation, uniprot_align, utils
 
 
 def levenshtein_distance(str1: str, str2: str, min_exon_length: int) -> bool:
@@ -34,9 +34,14 @@ def levenshtein_distance(str1: str, str2: str, min_exon_length: int) -> bool:
     return matrix[-1][-1] <= min_exon_length
 
 
-def retrieve_exon(input_file: Path, min_exon_length: int, out_dir: Path) -> tuple:
-    """Retrieve exon from protein sequence."""
-    alignments = list(uniprot_align.get_alignment(input_file, out_dir))
+@instrumentation.traced()
+def retrieve_exon(input_file: Path, min_exon_length: int, out_dir: Path, aligner: str = 'auto', workers: int | None = 1,
+                  alignment=None) -> tuple:
+    """Retrieve exon from protein sequence.
+    If the alignment of the input file (see uniprot_align.get_alignment) is supplied, the sequences are not aligned again."""
+    if alignment is None:
+        alignment = uniprot_align.get_alignment(input_file, out_dir, aligner, workers)
+    alignments = list(alignment)
     max_sequence_length = 0
     for alignment in alignments:
         max_sequence_length = max(max_sequence_length, len(alignment.seq))
@@ -0,0 +1,171 @@
+"""Content-addressed cache of rendered figures.
+A figure is stored under a hash of everything it is rendered from: the plot type, the content of the FASTA
+and input files, the values of the config and plot config, the font file the labels are measured with and the
+versions of the plotting code, plotly, kaleido and fontTools. Next to the plotly JSON of the figure every exported format is stored, so an unchanged plot
+is not rendered again and only exports in new formats are computed.
+The least recently used figures are removed once the cache exceeds its size, a figure larger than the whole
+cache is kept until the next figure is stored."""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from importlib import metadata
+from pathlib import Path
+
+from protein_sequencing import font_metrics
+
+DEFAULT_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'protein_sequencing' / 'figures'
+DEFAULT_CACHE_SIZE_MB = 512
+
+# settings that only decide what happens with the finished figure
+IGNORED_SETTINGS = ('SAVE_PLOT', 'SHOW_PLOT', 'OUTPUT_FOLDER')
+
+_file_digests = {}
+_code_digest = None
+
+
+def settings(config) -> dict:
+    """Return the settings (upper case names) of a config module or namespace."""
+    return {name: getattr(config, name) for name in dir(config) if name.isupper()}
+
+
+def file_digest(path: Path | str) -> str:
+    """Return the SHA-256 of a file, remembered per path, modification time and size."""
+    stat = os.stat(path)
+    memo_key = (str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size)
+    if memo_key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        _file_digests[memo_key] = digest.hexdigest()
+    return _file_digests[memo_key]
+
+
+def code_digest() -> str:
+    """Return a hash of the plotting code and of the plotly, kaleido and fontTools versions."""
+    global _code_digest
+    if _code_digest is None:
+        digest = hashlib.sha256()
+        for source in sorted(Path(__file__).parent.glob('*.py')):
+            digest.update(source.name.encode('utf-8'))
+            digest.update(source.read_bytes())
+        for package in ('plotly', 'kaleido', 'fonttools'):
+            try:
+                digest.update(f'{package}=={metadata.version(package)}'.encode('utf-8'))
+            except metadata.PackageNotFoundError:
+                digest.update(f'{package} missing'.encode('utf-8'))
+        _code_digest = digest.hexdigest()
+    return _code_digest
+
+
+def font_digest(config) -> str | None:
+    """Return the hash of the font file the labels of a config are measured with, None for the fallback widths."""
+    font_file = font_metrics.resolve_font_file(getattr(config, 'FONT', 'Arial'), getattr(config, 'FONT_FILE', None))
+    return None if font_file is None else file_digest(font_file)
+
+
+def canonical(value):
+    """Turn a setting into a JSON serializable value, paths of existing files are replaced by their content hash."""
+    if isinstance(value, str):
+        return {'file': file_digest(value)} if os.path.isfile(value) else value
+    if isinstance(value, dict):
+        # the order of the entries decides e.g. the order of the legend
+        return [[canonical(key), canonical(item)] for key, item in value.items()]
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((canonical(item) for item in value), key=repr)
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return repr(value)
+
+
+def figure_key(plot: str, fasta: Path | str, config, plot_config) -> str:
+    """Return the cache key of a figure rendered with the given plot type, FASTA file and configs."""
+    content = {
+        'plot': plot,
+        'fasta': file_digest(fasta),
+        'config': {name: canonical(value) for name, value in settings(config).items() if name not in IGNORED_SETTINGS},
+        'plot_config': {name: canonical(value) for name, value in settings(plot_config).items() if name not in IGNORED_SETTINGS},
+        'font': font_digest(config),
+        'code': code_digest(),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class FigureCache:
+    """Figures and their exports in a cache folder, one subfolder per key."""
+
+    def __init__(self, cache_dir: Path | str = DEFAULT_CACHE_DIR, max_size_mb: float = DEFAULT_CACHE_SIZE_MB):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+
+    def entry(self, key: str) -> Path:
+        """Return the folder of a key."""
+        return self.cache_dir / key[:2] / key
+
+    def get(self, key: str, output_format: str) -> bytes | None:
+        """Return the cached figure (json) or export (svg, png) of a key, None if it is not cached."""
+        entry = self.entry(key)
+        try:
+            data = (entry / f'figure.{output_format}').read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            self.touch(entry)
+        except FileNotFoundError:
+            pass
+        return data
+
+    @staticmethod
+    def touch(entry: Path):
+        """Mark the last use of an entry with the modification time of its folder."""
+        # the clock of the file system is too coarse to order uses in quick succession
+        now = time.time_ns()
+        os.utime(entry, ns=(now, now))
+
+    def put(self, key: str, output_format: str, data: bytes):
+        """Store the figure (json) or an export (svg, png) of a key and evict old figures if the cache is full."""
+        entry = self.entry(key)
+        entry.mkdir(parents=True, exist_ok=True)
+        # written to a temporary file first, other processes may read the entry at the same time
+        with tempfile.NamedTemporaryFile(dir=entry, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, entry / f'figure.{output_format}')
+        self.touch(entry)
+        self.evict(keep=entry)
+
+    def evict(self, keep: Path | None = None):
+        """Remove the least recently used figures until the cache fits into its size, except the entry keep."""
+        entries = []
+        for entry in self.cache_dir.glob('*/*'):
+            try:
+                entries.append((entry.stat().st_mtime_ns, sum(f.stat().st_size for f in entry.iterdir()), entry))
+            except FileNotFoundError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def add_cache_arguments(parser):
+    """Add the figure cache options to a command line parser."""
+    parser.add_argument('--no-cache', action='store_true', help='Render every figure, without the figure cache.')
+    parser.add_argument('--cache-dir', default=str(DEFAULT_CACHE_DIR), help=f'Folder of the figure cache. Default={DEFAULT_CACHE_DIR}')
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_CACHE_SIZE_MB,
+                        help=f'Size of the figure cache in MB, least recently used figures are removed. Default={DEFAULT_CACHE_SIZE_MB}')
+
+
+def cache_from_args(args) -> FigureCache | None:
+    """Return the figure cache selected on the command line, None with --no-cache."""
+    if args.no_cache:
+        return None
+    return FigureCache(args.cache_dir, args.cache_size)
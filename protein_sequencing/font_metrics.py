@@ -0,0 +1,80 @@
+"""Text measurement for the layout of the labels.
+The advance widths of the glyphs are read once from the TrueType or OpenType file of the font with fontTools
+(optional). Without fontTools or a font file the widths of Helvetica are used, which match Arial.
+Measured widths are kept in a bounded LRU cache, as the layout measures the same labels many times.
+Kerning is ignored, the widths are the sum of the advance widths."""
+import functools
+import os
+from pathlib import Path
+
+# advance widths of Helvetica (and Arial) in 1/1000 em for the printable ASCII characters
+FALLBACK_WIDTHS = dict(zip(
+    ' !"#$%&\'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefghijklmnopqrstuvwxyz{|}~',
+    (278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+     556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556, 1015,
+     667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944,
+     667, 667, 611, 278, 278, 278, 469, 556, 333,
+     556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556, 556, 556, 333, 500, 278, 556, 500, 722,
+     500, 500, 500, 334, 260, 334, 584)))
+# width of characters missing in the table or the font, e.g. greek letters of the region names
+DEFAULT_WIDTH = 556
+
+# measured (text, size, family, font file) combinations kept in the cache
+TEXT_WIDTH_CACHE_SIZE = 65536
+
+FONT_DIRS = [Path.home() / '.fonts', Path.home() / '.local' / 'share' / 'fonts', Path('/usr/share/fonts'),
+             Path('/usr/local/share/fonts'), Path('/Library/Fonts'), Path.home() / 'Library' / 'Fonts',
+             Path('/System/Library/Fonts'), Path(os.environ.get('WINDIR', 'C:\\Windows')) / 'Fonts']
+FONT_SUFFIXES = ('.ttf', '.otf', '.ttc')
+
+
+@functools.lru_cache(maxsize=None)
+def find_font_file(family: str) -> Path | None:
+    """Find the regular font file of a family in the font folders of the system, e.g. arial.ttf for Arial."""
+    name = family.replace(' ', '').lower()
+    for font_dir in FONT_DIRS:
+        if not font_dir.is_dir():
+            continue
+        for font_file in sorted(font_dir.rglob('*')):
+            if font_file.suffix.lower() in FONT_SUFFIXES and font_file.stem.replace(' ', '').replace('-Regular', '').lower() == name:
+                return font_file
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def glyph_widths(font_file: str | None) -> tuple[dict[str, float], float]:
+    """Return the advance widths of the characters of a font file in 1/1000 em and the width of missing characters.
+    Without fontTools or a font file the fallback table is returned."""
+    if font_file is None:
+        return FALLBACK_WIDTHS, DEFAULT_WIDTH
+    try:
+        from fontTools.ttLib import TTFont
+    except ImportError:
+        return FALLBACK_WIDTHS, DEFAULT_WIDTH
+    font = TTFont(font_file, lazy=True, fontNumber=0)
+    scale = 1000 / font['head'].unitsPerEm
+    metrics = font['hmtx'].metrics
+    widths = {chr(code): metrics[glyph][0] * scale for code, glyph in font.getBestCmap().items()}
+    font.close()
+    return widths, widths.get('n', DEFAULT_WIDTH)
+
+
+def resolve_font_file(family: str, font_file: str | os.PathLike | None = None) -> str | None:
+    """Return the font file used to measure a family, the given file or the one found on the system."""
+    if font_file is not None:
+        return str(font_file)
+    found = find_font_file(family)
+    return None if found is None else str(found)
+
+
+@functools.lru_cache(maxsize=TEXT_WIDTH_CACHE_SIZE)
+def text_width(text: str, size: float, family: str = 'Arial', font_file: str | None = None) -> float:
+    """Return the width of a line of text in pixels, for a font size in pixels."""
+    widths, default = glyph_widths(resolve_font_file(family, font_file))
+    return sum(widths.get(char, default) for char in text) * size / 1000
+
+
+def max_text_width(texts, size: float, family: str = 'Arial', font_file: str | None = None) -> float:
+    """Return the width of the widest of several texts, 0 for none."""
+    return max((text_width(text, size, family, font_file) for text in texts), default=0)
+
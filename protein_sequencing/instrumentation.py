@@ -0,0 +1,182 @@
+"""Optional stage timing of the preprocessors and plotters.
+Stages are recorded as spans with wall time, CPU time, peak RSS and item counts once recording is enabled,
+e.g. with --trace on the command line. While it is disabled, spans and counts return immediately."""
+import functools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+TRACE_FORMATS = ('jsonl', 'chrome')
+
+_recorder = None
+
+
+def _peak_rss_mb() -> float | None:
+    """Return the peak resident set size of the process in MB."""
+    if resource is None:
+        return None
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Span:
+    """A recorded stage, use it as a context manager."""
+
+    def __init__(self, recorder, name: str, counts: dict):
+        self.recorder = recorder
+        self.name = name
+        self.counts = counts
+        self.parent = None
+        self.depth = 0
+        self.start = 0.0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_rss_mb = None
+        self.rss_growth_mb = None
+        self.thread = 0
+        self._cpu_start = 0.0
+        self._rss_start = None
+
+    def add(self, **counts):
+        """Add item counts to the span."""
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def __enter__(self):
+        stack = self.recorder.stack()
+        if stack:
+            self.parent = stack[-1].name
+            self.depth = len(stack)
+        stack.append(self)
+        self.thread = threading.get_ident()
+        self._rss_start = _peak_rss_mb()
+        self._cpu_start = time.thread_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.start
+        self.cpu = time.thread_time() - self._cpu_start
+        self.peak_rss_mb = _peak_rss_mb()
+        if self.peak_rss_mb is not None:
+            self.rss_growth_mb = self.peak_rss_mb - self._rss_start
+        self.recorder.stack().pop()
+        self.recorder.spans.append(self)
+        return False
+
+    def to_dict(self, origin: float) -> dict:
+        """Return the span as a JSON serializable dict with the start relative to origin."""
+        return {'name': self.name, 'parent': self.parent, 'depth': self.depth, 'start': self.start - origin,
+                'wall': self.wall, 'cpu': self.cpu, 'peak_rss_mb': self.peak_rss_mb,
+                'rss_growth_mb': self.rss_growth_mb, 'counts': self.counts}
+
+
+class _NullSpan:
+    """Stand-in for Span while recording is disabled."""
+
+    def add(self, **counts):
+        """Ignore the counts."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Recorder:
+    """Collects the finished spans of the process."""
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans = []
+        self._local = threading.local()
+
+    def stack(self) -> list:
+        """Return the open spans of the current thread."""
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def write(self, trace_file: Path | str, trace_format: str = 'jsonl'):
+        """Write the spans as JSON lines or as Chrome trace (chrome://tracing, Perfetto)."""
+        if trace_format not in TRACE_FORMATS:
+            raise ValueError(f"Unknown trace format {trace_format}, expected one of {', '.join(TRACE_FORMATS)}")
+        spans = sorted(self.spans, key=lambda span: span.start)
+        with open(trace_file, 'w', encoding='utf-8') as f:
+            if trace_format == 'jsonl':
+                for span in spans:
+                    f.write(json.dumps(span.to_dict(self.origin)) + '\n')
+                return
+            events = []
+            for span in spans:
+                args = {'cpu_ms': span.cpu * 1000, 'peak_rss_mb': span.peak_rss_mb, 'rss_growth_mb': span.rss_growth_mb, **span.counts}
+                events.append({'name': span.name, 'ph': 'X', 'ts': (span.start - self.origin) * 1e6, 'dur': span.wall * 1e6,
+                               'pid': os.getpid(), 'tid': span.thread, 'args': args})
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def enable() -> Recorder:
+    """Start recording spans in this process."""
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def disable() -> Recorder | None:
+    """Stop recording and return the recorder with the spans recorded so far."""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def is_enabled() -> bool:
+    """Check if spans are recorded."""
+    return _recorder is not None
+
+
+def span(name: str, **counts):
+    """Return a context manager that records the enclosed code as stage name."""
+    if _recorder is None:
+        return NULL_SPAN
+    return Span(_recorder, name, counts)
+
+
+def count(**counts):
+    """Add item counts to the innermost open span of the current thread."""
+    if _recorder is None:
+        return
+    stack = _recorder.stack()
+    if stack:
+        stack[-1].add(**counts)
+
+
+def traced(name: str | None = None):
+    """Decorator recording every call of a function as a span, named after the function by default."""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return func(*args, **kwargs)
+            with Span(_recorder, span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write(trace_file: Path | str, trace_format: str = 'jsonl'):
+    """Write the spans recorded so far, does nothing while recording is disabled."""
+    if _recorder is not None:
+        _recorder.write(trace_file, trace_format)
@@ -0,0 +1,245 @@
+"""In-process aligner for isoform families.
+Isoforms of a protein are near-identical sequences that differ by inserted or exchanged exons.
+Every isoform is aligned against the longest isoform (anchor) with a banded affine-gap alignment
+and the pairwise alignments are merged into a star alignment."""
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+from Bio.Align import MultipleSeqAlignment, substitution_matrices
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+GAP_OPEN = 11
+GAP_EXTEND = 1
+# additional diagonals around the length difference of two isoforms that are part of the band
+BAND_MARGIN = 50
+# shorter runs of identical residues between differing residues are treated as chance identities
+MIN_CONSERVED_RUN = 3
+
+NEG = -(2 ** 40)
+STATE_MATCH, STATE_GAP_OTHER, STATE_GAP_ANCHOR = 0, 1, 2
+
+_BLOSUM62 = substitution_matrices.load('BLOSUM62')
+_ALPHABET = _BLOSUM62.alphabet
+_SCORES = np.array([[_BLOSUM62[a, b] for b in _ALPHABET] for a in _ALPHABET], dtype=np.int64)
+# unknown amino acids (e.g. U, O) are scored like X
+_CODES = np.full(256, _ALPHABET.index('X'), dtype=np.intp)
+for _code, _amino_acid in enumerate(_ALPHABET):
+    _CODES[ord(_amino_acid)] = _code
+    _CODES[ord(_amino_acid.lower())] = _code
+
+
+def encode(sequence: str) -> np.ndarray:
+    """Encode a sequence as indices into the substitution matrix."""
+    return _CODES[np.frombuffer(sequence.encode('ascii', errors='replace'), dtype=np.uint8)]
+
+
+def align_pair(anchor: str, other: str, band_margin: int = BAND_MARGIN) -> tuple[str, str]:
+    """Banded global alignment with affine gap costs (Gotoh) of an isoform against the anchor.
+    Returns the gapped anchor and the gapped isoform."""
+    n, m = len(anchor), len(other)
+    if n == 0 or m == 0:
+        return anchor + '-' * m, '-' * n + other
+    a = encode(anchor)
+    b = encode(other)
+    band_low = min(0, m - n) - band_margin
+    band_high = max(0, m - n) + band_margin
+
+    # traceback pointers of the band, cell (i, j) is stored at (i, j - i - band_low),
+    # the scores are only kept for the previous row
+    width = band_high - band_low + 1
+    pointer_match = np.zeros((n + 1, width), dtype=np.int8)
+    pointer_gap_other = np.full((n + 1, width), STATE_GAP_OTHER, dtype=np.int8)
+    pointer_gap_anchor = np.full((n + 1, width), STATE_GAP_ANCHOR, dtype=np.int8)
+    if band_low < 0:
+        pointer_gap_other[1, -1 - band_low] = STATE_MATCH
+    if band_high > 0:
+        pointer_gap_anchor[0, 1 - band_low] = STATE_MATCH
+
+    columns = np.arange(m + 1, dtype=np.int64)
+    match = np.full(m + 1, NEG, dtype=np.int64)
+    gap_other = np.full(m + 1, NEG, dtype=np.int64)
+    gap_anchor = np.full(m + 1, NEG, dtype=np.int64)
+    match[0] = 0
+    first_row = columns[1:min(m, band_high) + 1]
+    gap_anchor[first_row] = -GAP_OPEN - (first_row - 1) * GAP_EXTEND
+
+    for i in range(1, n + 1):
+        low = max(1, i + band_low)
+        high = min(m, i + band_high)
+        new_match = np.full(m + 1, NEG, dtype=np.int64)
+        new_gap_other = np.full(m + 1, NEG, dtype=np.int64)
+        new_gap_anchor = np.full(m + 1, NEG, dtype=np.int64)
+        if i + band_low <= 0:
+            new_gap_other[0] = -GAP_OPEN - (i - 1) * GAP_EXTEND
+        if low <= high:
+            band = slice(low, high + 1)
+            previous = slice(low - 1, high)
+            stored = slice(low - i - band_low, high - i - band_low + 1)
+
+            # match: diagonal step from the best state of the previous cell
+            previous_states = np.stack((match[previous], gap_other[previous], gap_anchor[previous]))
+            pointer_match[i, stored] = previous_states.argmax(axis=0)
+            new_match[band] = previous_states.max(axis=0) + _SCORES[a[i - 1], b[low - 1:high]]
+
+            # gap in the isoform: vertical step, opened from match or the other gap state
+            opened = np.maximum(match[band], gap_anchor[band]) - GAP_OPEN
+            extended = gap_other[band] - GAP_EXTEND
+            new_gap_other[band] = np.maximum(opened, extended)
+            pointer_gap_other[i, stored] = np.where(extended > opened, STATE_GAP_OTHER,
+                                                  np.where(match[band] >= gap_anchor[band], STATE_MATCH, STATE_GAP_ANCHOR))
+
+            # gap in the anchor: horizontal steps within the row, solved with a prefix maximum
+            best = np.maximum(new_match[low - 1:high], new_gap_other[low - 1:high])
+            opening = best - GAP_OPEN + columns[low - 1:high] * GAP_EXTEND
+            new_gap_anchor[band] = np.maximum.accumulate(opening) - columns[previous] * GAP_EXTEND
+            extended = new_gap_anchor[previous] - GAP_EXTEND
+            opened = best - GAP_OPEN
+            pointer_gap_anchor[i, stored] = np.where(extended > opened, STATE_GAP_ANCHOR,
+                                                   np.where(new_match[previous] >= new_gap_other[previous], STATE_MATCH, STATE_GAP_OTHER))
+        match, gap_other, gap_anchor = new_match, new_gap_other, new_gap_anchor
+
+    aligned_anchor = []
+    aligned_other = []
+    i, j = n, m
+    state = int(np.argmax((match[m], gap_other[m], gap_anchor[m])))
+    while i > 0 or j > 0:
+        if state == STATE_MATCH:
+            aligned_anchor.append(anchor[i - 1])
+            aligned_other.append(other[j - 1])
+            state = pointer_match[i, j - i - band_low]
+            i -= 1
+            j -= 1
+        elif state == STATE_GAP_OTHER:
+            aligned_anchor.append(anchor[i - 1])
+            aligned_other.append('-')
+            state = pointer_gap_other[i, j - i - band_low]
+            i -= 1
+        else:
+            aligned_anchor.append('-')
+            aligned_other.append(other[j - 1])
+            state = pointer_gap_anchor[i, j - i - band_low]
+            j -= 1
+    return refine_divergent_blocks(''.join(reversed(aligned_anchor)), ''.join(reversed(aligned_other)))
+
+
+def layout_block(anchor_block: str, other_block: str) -> tuple[str, str]:
+    """Lay out a divergent block with a single gap run in the shorter part.
+    The gap run is placed where the fewest residues are identical, preferring the end of the block.
+    This is a heuristic for the exon detection rather than an alignment: substitutions are not scored and
+    the block is assumed to hold one inserted or exchanged exon. Identities that no placement avoids,
+    e.g. in exchanged exons of the same length, remain in the block."""
+    swapped = len(anchor_block) < len(other_block)
+    longer, shorter = (other_block, anchor_block) if swapped else (anchor_block, other_block)
+    gaps = '-' * (len(longer) - len(shorter))
+    best_identities, best_layout = None, None
+    for k in range(len(shorter), -1, -1):
+        layout = shorter[:k] + gaps + shorter[k:]
+        identities = sum(x == y for x, y in zip(longer, layout))
+        if best_identities is None or identities < best_identities:
+            best_identities, best_layout = identities, layout
+            if identities == 0:
+                break
+    return (best_layout, longer) if swapped else (longer, best_layout)
+
+
+def refine_divergent_blocks(aligned_anchor: str, aligned_other: str) -> tuple[str, str]:
+    """Lay out the blocks between conserved runs of a pairwise alignment again.
+    The alignment within alternative exons is arbitrary and exon_helper.retrieve_exon would read
+    chance identities in them as exon boundaries. Runs of at least MIN_CONSERVED_RUN identical residues
+    are kept, so a chance run within exchanged exons still splits them into two blocks."""
+    identical = [a == b and a != '-' for a, b in zip(aligned_anchor, aligned_other)]
+    conserved = [False] * len(identical)
+    i = 0
+    while i < len(identical):
+        j = i
+        while j < len(identical) and identical[j] == identical[i]:
+            j += 1
+        if identical[i] and j - i >= MIN_CONSERVED_RUN:
+            conserved[i:j] = [True] * (j - i)
+        i = j
+
+    refined_anchor = []
+    refined_other = []
+    i = 0
+    while i < len(conserved):
+        j = i
+        while j < len(conserved) and conserved[j] == conserved[i]:
+            j += 1
+        if conserved[i]:
+            refined_anchor.append(aligned_anchor[i:j])
+            refined_other.append(aligned_other[i:j])
+        else:
+            anchor_block, other_block = layout_block(aligned_anchor[i:j].replace('-', ''), aligned_other[i:j].replace('-', ''))
+            refined_anchor.append(anchor_block)
+            refined_other.append(other_block)
+        i = j
+    return ''.join(refined_anchor), ''.join(refined_other)
+
+
+def merge_pairwise_alignments(anchor: str, pairwise_alignments: list[tuple[str, str]]) -> list[str]:
+    """Merge pairwise alignments against the same anchor into a star alignment.
+    Returns the gapped anchor followed by the gapped isoforms in the order of the pairwise alignments."""
+    # residues of each isoform that are inserted before anchor position p and aligned to anchor position p
+    insertions = []
+    aligned = []
+    for aligned_anchor, aligned_other in pairwise_alignments:
+        inserted = [[] for _ in range(len(anchor) + 1)]
+        matched = ['-'] * len(anchor)
+        position = 0
+        for anchor_aa, other_aa in zip(aligned_anchor, aligned_other):
+            if anchor_aa == '-':
+                inserted[position].append(other_aa)
+            else:
+                matched[position] = other_aa
+                position += 1
+        insertions.append(inserted)
+        aligned.append(matched)
+
+    max_insertions = [max((len(inserted[p]) for inserted in insertions), default=0) for p in range(len(anchor) + 1)]
+    rows = [[] for _ in range(len(pairwise_alignments) + 1)]
+    for p in range(len(anchor) + 1):
+        rows[0].append('-' * max_insertions[p])
+        for k, inserted in enumerate(insertions):
+            rows[k + 1].append(''.join(inserted[p]) + '-' * (max_insertions[p] - len(inserted[p])))
+        if p < len(anchor):
+            rows[0].append(anchor[p])
+            for k, matched in enumerate(aligned):
+                rows[k + 1].append(matched[p])
+    return [''.join(row) for row in rows]
+
+
+def get_anchor_index(records: list[SeqRecord]) -> int:
+    """Return the index of the longest isoform, which is used as anchor of the star alignment."""
+    return max(range(len(records)), key=lambda k: len(records[k].seq))
+
+
+def align_isoforms(records: list[SeqRecord], workers: int | None = 1) -> MultipleSeqAlignment:
+    """Align all isoforms against the longest isoform and merge them into a multiple sequence alignment.
+    With more than one worker the pairwise alignments run in a process pool (None for one worker per core).
+    The records keep the order of the input."""
+    anchor_index = get_anchor_index(records)
+    anchor = str(records[anchor_index].seq)
+    others = [k for k in range(len(records)) if k != anchor_index]
+    other_sequences = [str(records[k].seq) for k in others]
+    if workers == 1 or len(others) < 2:
+        pairwise_alignments = [align_pair(anchor, other) for other in other_sequences]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pairwise_alignments = list(executor.map(align_pair, repeat(anchor), other_sequences))
+    return build_alignment(records, anchor_index, others, pairwise_alignments)
+
+
+def build_alignment(records: list[SeqRecord], anchor_index: int, others: list[int],
+                    pairwise_alignments: list[tuple[str, str]]) -> MultipleSeqAlignment:
+    """Merge the pairwise alignments against the anchor record and return them in the order of the records."""
+    anchor = str(records[anchor_index].seq)
+    merged = merge_pairwise_alignments(anchor, pairwise_alignments)
+    aligned_sequences = {anchor_index: merged[0]}
+    for k, aligned_sequence in zip(others, merged[1:]):
+        aligned_sequences[k] = aligned_sequence
+    return MultipleSeqAlignment([
+        SeqRecord(Seq(aligned_sequences[k]), id=record.id, name=record.name, description=record.description)
+        for k, record in enumerate(records)
+    ])
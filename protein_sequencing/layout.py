@@ -0,0 +1,168 @@
+"""Headless layout of the plots.
+The plotters draw into a Layout with the drawing methods of plotly figures (add_scatter, add_heatmap, add_shape,
+add_annotation, update_layout). The Layout only records the computed geometry, plotly is not imported until
+to_figure() creates the figure from the dict of to_dict(). geometry() returns the layout as NumPy arrays, e.g. to cache, compare or
+render the layout without plotly."""
+import numpy as np
+
+from protein_sequencing import static_export
+
+REGION_DTYPE = np.dtype([('name', object), ('x0', float), ('y0', float), ('x1', float), ('y1', float),
+                         ('start', int), ('end', int), ('color', object)])
+RECT_DTYPE = np.dtype([('x0', float), ('y0', float), ('x1', float), ('y1', float), ('fillcolor', object), ('layer', object)])
+LABEL_DTYPE = np.dtype([('x', float), ('y', float), ('xshift', float), ('yshift', float), ('angle', float),
+                        ('size', float), ('anchor', object), ('text', object)])
+
+# anchor of the text of scatter traces relative to their point, as the anchor of an annotation
+TEXT_POSITIONS = {'top': 'bottom', 'middle': 'middle', 'bottom': 'top', 'left': 'right', 'center': 'center', 'right': 'left'}
+
+
+def _merge(target: dict, properties: dict):
+    """Merge nested settings into target, as update_layout does."""
+    for name, value in properties.items():
+        if isinstance(value, dict) and isinstance(target.get(name), dict):
+            _merge(target[name], value)
+        else:
+            target[name] = dict(value) if isinstance(value, dict) else value
+
+
+class Layout:
+    """Traces, shapes, annotations and layout settings of a figure, in the order they are drawn."""
+
+    def __init__(self):
+        self.traces = []
+        self.shapes = []
+        self.annotations = []
+        self.layout_updates = []
+        self.regions = []
+        # pixel coordinates of the sequence positions per isoform segment (utils.RESIDUE_PIXELS)
+        self.residues = np.zeros((0, 0), dtype=int)
+
+    def add_scatter(self, **properties):
+        """Add a scatter trace (lines, filled polygons or text)."""
+        self.traces.append(('scatter', properties))
+        return self
+
+    def add_heatmap(self, **properties):
+        """Add a heatmap trace."""
+        self.traces.append(('heatmap', properties))
+        return self
+
+    def add_shape(self, **properties):
+        """Add a shape (rectangle or line)."""
+        self.shapes.append(properties)
+        return self
+
+    def add_annotation(self, **properties):
+        """Add a text annotation."""
+        self.annotations.append(properties)
+        return self
+
+    def update_layout(self, **properties):
+        """Update the layout settings, e.g. the size and the axes."""
+        self.layout_updates.append(('update_layout', properties))
+        return self
+
+    def update_xaxes(self, **properties):
+        """Update the settings of the x axis."""
+        self.layout_updates.append(('update_xaxes', properties))
+        return self
+
+    def update_yaxes(self, **properties):
+        """Update the settings of the y axis."""
+        self.layout_updates.append(('update_yaxes', properties))
+        return self
+
+    def add_region(self, name: str, x0: float, y0: float, x1: float, y1: float, start: int, end: int, color: str):
+        """Record the box of a region of the sequence and its first and last residue."""
+        self.regions.append((name, x0, y0, x1, y1, start, end, color))
+        return self
+
+    def setting(self, name: str, default=None):
+        """Return the last value of a layout setting given to update_layout."""
+        for method, properties in reversed(self.layout_updates):
+            if method == 'update_layout' and name in properties:
+                return properties[name]
+        return default
+
+    def to_dict(self) -> dict:
+        """Return the figure as a plotly figure dict, without running plotly's property validators."""
+        layout = {}
+        for method, properties in self.layout_updates:
+            if method == 'update_layout':
+                _merge(layout, properties)
+            else:
+                _merge(layout.setdefault('xaxis' if method == 'update_xaxes' else 'yaxis', {}), properties)
+        if self.shapes:
+            layout['shapes'] = list(self.shapes)
+        if self.annotations:
+            layout['annotations'] = list(self.annotations)
+        return {'data': [{'type': trace_type, **properties} for trace_type, properties in self.traces], 'layout': layout}
+
+    def to_figure(self, validate: bool = False):
+        """Create the plotly figure of the layout in one step, which validates every property only once.
+        Invalid properties are dropped, with validate (VALIDATE_FIGURES in the config) they raise a ValueError,
+        e.g. to debug a plotter."""
+        import plotly.graph_objects as go
+        return go.Figure(self.to_dict(), skip_invalid=not validate)
+
+    def geometry(self) -> dict:
+        """Return the geometry of the layout as arrays:
+        size: width and height of the figure in pixels
+        regions: boxes of the sequence regions (REGION_DTYPE)
+        residues: coordinate along the sequence axis of every position (columns) of the isoform segments
+            general, exon1 and exon2 (rows)
+        rects: rectangles, e.g. bars and label backgrounds (RECT_DTYPE)
+        paths: points (n x 2) of lines and polygons, path i is points[offsets[i]:offsets[i + 1]], fills holds the
+            fill color of a polygon and None for lines
+        labels: anchors and offsets of annotations and text traces (LABEL_DTYPE)
+        heatmaps: value grid z (rows x columns) and cell edges x and y of every heatmap"""
+        rects = []
+        path_points = []
+        offsets = [0]
+        fills = []
+        labels = []
+        heatmaps = []
+        for shape in self.shapes:
+            if shape.get('type', 'rect') == 'rect':
+                rects.append((shape['x0'], shape['y0'], shape['x1'], shape['y1'], shape.get('fillcolor'), shape.get('layer', 'above')))
+            else:
+                path_points.extend([(shape['x0'], shape['y0']), (shape['x1'], shape['y1'])])
+                offsets.append(len(path_points))
+                fills.append(None)
+        for trace_type, trace in self.traces:
+            if trace_type == 'heatmap':
+                z = np.asarray(trace['z'], dtype=float)
+                rows, columns = z.shape
+                heatmaps.append({
+                    'z': z,
+                    'x': np.array(static_export.cell_edges(trace.get('x'), trace.get('x0', 0), trace.get('dx', 1), columns)),
+                    'y': np.array(static_export.cell_edges(trace.get('y'), trace.get('y0', 0), trace.get('dy', 1), rows)),
+                })
+                continue
+            x, y = list(trace.get('x', ())), list(trace.get('y', ()))
+            if 'text' in trace.get('mode', 'lines'):
+                texts = trace.get('text', '')
+                texts = list(texts) if isinstance(texts, (list, tuple)) else [texts] * len(x)
+                size = (trace.get('textfont') or {}).get('size', np.nan)
+                anchor = ' '.join(TEXT_POSITIONS[part] for part in trace.get('textposition', 'middle center').split())
+                labels.extend((x_i, y_i, 0, 0, 0, size, anchor, str(text)) for x_i, y_i, text in zip(x, y, texts))
+                continue
+            path_points.extend(zip(x, y))
+            offsets.append(len(path_points))
+            fills.append(trace.get('fillcolor') if trace.get('fill') == 'toself' else None)
+        for annotation in self.annotations:
+            anchor = f"{annotation.get('yanchor', 'middle')} {annotation.get('xanchor', 'center')}"
+            labels.append((annotation['x'], annotation['y'], annotation.get('xshift', 0), annotation.get('yshift', 0),
+                           annotation.get('textangle', 0), (annotation.get('font') or {}).get('size', np.nan), anchor,
+                           str(annotation.get('text', ''))))
+        return {
+            'size': (self.setting('width'), self.setting('height')),
+            'regions': np.array(self.regions, dtype=REGION_DTYPE),
+            'residues': self.residues,
+            'rects': np.array(rects, dtype=RECT_DTYPE),
+            'paths': {'points': np.array(path_points, dtype=float).reshape(-1, 2), 'offsets': np.array(offsets),
+                      'fills': np.array(fills, dtype=object)},
+            'labels': np.array(labels, dtype=LABEL_DTYPE),
+            'heatmaps': heatmaps,
+        }
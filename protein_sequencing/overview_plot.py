@@ -1,8 +1,8 @@
 """Module to generate overview plot for protein sequences."""
 import importlib
 from collections import defaultdict
-import plotly.graph_objects as go
-from protein_sequencing import utils, sequence_plot as sequence
+from protein_sequencing import instrumentation, utils, sequence_plot as sequence
+from protein_sequencing.layout import Layout
 
 class OverviewPlotter:
     """Class to generate overview plot for protein sequences."""
@@ -59,20 +59,26 @@ class OverviewPlotter:
                 modifications_by_position[position] = list(set(mods))
         return modifications_by_position
 
+    @instrumentation.traced()
     def plot_labels(self, fig, modifications_by_position):
         """Main plotting function. Plots labels for modifications at correspinding positions."""
+        instrumentation.count(positions=len(modifications_by_position))
         x0 = utils.SEQUENCE_BOUNDARIES['x0']
         x1 = utils.SEQUENCE_BOUNDARIES['x1']
         y0 = utils.SEQUENCE_BOUNDARIES['y0']
         y1 = utils.SEQUENCE_BOUNDARIES['y1']
 
         label_offsets_with_orientation = self.get_label_offsets_with_orientation(modifications_by_position)
+        # position of the lines on the sequence for every label
+        sites = [(aa_position, label, isoform) for aa_position, mods in modifications_by_position.items()
+                 for label, _, _, isoform in mods]
+        line_positions = dict(zip([site[:2] for site in sites],
+                                  utils.residue_pixels([int(site[1][1:]) for site in sites], [site[2] for site in sites])))
         for aa_position in label_offsets_with_orientation.keys():
             line_plotted_a, line_plotted_b = False, False
             for height_offset, group, label, modification_type, orientation in label_offsets_with_orientation[aa_position]:
                 if self.config.FIGURE_ORIENTATION == 0:
-                    x_position_line = (aa_position * utils.PIXELS_PER_AA) + utils.SEQUENCE_OFFSET
-                    x_position_line = utils.offset_line_for_exon(x_position_line, int(label[1:]), self.config.FIGURE_ORIENTATION)
+                    x_position_line = line_positions[aa_position, label]
                     y_length = self.plot_config.SEQUENCE_MIN_LINE_LENGTH + height_offset * utils.get_label_height()
                     y_beginning_line = y0 if group == 'B' else y1
                     y_end_line = y_beginning_line - y_length if group == 'B' else y_beginning_line + y_length
@@ -92,8 +98,7 @@ class OverviewPlotter:
 
                     self.plot_label(fig, x_position_line, y_end_line, label, modification_type, position_label)
                 else:
-                    y_position_line = self.config.FIGURE_WIDTH - (aa_position * utils.PIXELS_PER_AA) - utils.SEQUENCE_OFFSET
-                    y_position_line = utils.offset_line_for_exon(y_position_line, int(label[1:]), self.config.FIGURE_ORIENTATION)
+                    y_position_line = line_positions[aa_position, label]
 
                     x_length = self.plot_config.SEQUENCE_MIN_LINE_LENGTH + height_offset * utils.get_label_length(label)
                     x_beginning_line = x0 if group == 'B' else x1
@@ -289,7 +294,7 @@ class OverviewPlotter:
 
     def plot_line(self, fig, x_start, x_end, y_start, y_end):
         """Plot single line for modifications."""
-        fig.add_trace(go.Scatter(x=[x_start, x_end], y=[y_start, y_end], mode='lines', line=dict(color='black', width=1), showlegend=False, hoverinfo='none'))
+        fig.add_scatter(x=[x_start, x_end], y=[y_start, y_end], mode='lines', line=dict(color='black', width=1), showlegend=False, hoverinfo='none')
 
     def plot_label(self, fig, x, y, text, modification_type, position_label):
         """Plots single label for modification."""
@@ -322,18 +327,18 @@ class OverviewPlotter:
                     fillcolor=self.config.PTM_HIGHLIGHT_LABEL_COLOR,
                     line=dict(width=0),
                 )
-        fig.add_trace(go.Scatter(x=[x], y=[y], mode='text',
-                                text=text,
-                                textposition=position_label,
-                                showlegend=False,
-                                hoverinfo='none',
-                                textfont=dict(
-                                    family=self.config.FONT,
-                                    size=self.config.SEQUENCE_PLOT_FONT_SIZE,
-                                    color=self.config.MODIFICATIONS[modification_type][1])))
-
-    def create_overview_plot(self):
-        """Create overview plot for protein sequences."""
+        fig.add_scatter(x=[x], y=[y], mode='text',
+                        text=text,
+                        textposition=position_label,
+                        showlegend=False,
+                        hoverinfo='none',
+                        textfont=dict(
+                            family=self.config.FONT,
+                            size=self.config.SEQUENCE_PLOT_FONT_SIZE,
+                            color=self.config.MODIFICATIONS[modification_type][1]))
+
+    def create_overview_layout(self) -> Layout:
+        """Compute the layout of the overview plot, without creating a plotly figure."""
         present_modifications = self.get_present_modifications(self.plot_config.INPUT_FILE)
         groups_present = {self.plot_config.MODIFICATIONS_GROUP[mod] for mod in present_modifications if mod in self.plot_config.MODIFICATIONS_GROUP}
         if not 'A' in groups_present:
@@ -345,6 +350,11 @@ class OverviewPlotter:
 
         modifications_by_position = self.get_modifications_per_position(self.plot_config.INPUT_FILE)
         fig = self.plot_labels(fig, modifications_by_position)
+        return fig
+
+    def create_overview_plot(self):
+        """Create overview plot for protein sequences."""
+        fig = self.create_overview_layout().to_figure(getattr(self.config, 'VALIDATE_FIGURES', False))
 
         utils.finalize_plotting(
             fig,
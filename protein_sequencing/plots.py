@@ -1,38 +1,56 @@
 """
 Main module to create different plots.
 Execute with python3 plots.py -p <plot_type> -f <fasta_file> -o <output_folder>
+or start a render server with python3 plots.py serve (see render_server.py)
+or render many plots with python3 plots.py batch JOBS_FILE (see batch.py).
 Optional arguments:
     -pc, --plot-config: Path to plot specific configuration file.
     -c, --config: Path to configuration file.
+    --trace: Write the timing of every stage to this file.
+    --trace-format: jsonl (default) or chrome.
+    --profile: Profile the run with cprofile (default) or pyinstrument.
+    --profile-aggregate: Add the per-function totals to this .prof file.
+    --no-cache: Render the plot even if it is in the figure cache (see figure_cache.py).
+    --cache-dir, --cache-size: Folder and size in MB of the figure cache.
 """
 
 import argparse
 import importlib
-from protein_sequencing import utils, sequence_plot
-from protein_sequencing.bar_plot import BarPlotter
-from protein_sequencing.details_plot import DetailsPlotter
-from protein_sequencing.overview_plot import OverviewPlotter
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from protein_sequencing import figure_cache, instrumentation, profiling, static_export
+
+
+def load_config(config):
+    """Import a config module by name, configs that are already loaded are returned as they are."""
+    if isinstance(config, str):
+        return importlib.import_module(config, 'configs')
+    return config
 
 
 def generate_bar_plot(config, plot_config, fasta, output):
     """Generate bar plot."""
-    BarPlotter(importlib.import_module(config, 'configs'),
-               importlib.import_module(plot_config, 'configs'),
-               fasta, output)
+    from protein_sequencing.bar_plot import BarPlotter
+    return BarPlotter(load_config(config),
+                      load_config(plot_config),
+                      fasta, output).create_bar_plot()
 
 
 def generate_details_plot(config, plot_config, fasta, output):
     """Generate details plot."""
-    DetailsPlotter(importlib.import_module(config, 'configs'),
-                   importlib.import_module(plot_config, 'configs'),
-                   fasta, output)
+    from protein_sequencing.details_plot import DetailsPlotter
+    return DetailsPlotter(load_config(config),
+                          load_config(plot_config),
+                          fasta, output).create_details_plot()
 
 
 def generate_overview_plot(config, plot_config, fasta, output):
     """Generate overview plot."""
-    OverviewPlotter(importlib.import_module(config, 'configs'),
-                    importlib.import_module(plot_config, 'configs'),
-                    fasta, output)
+    from protein_sequencing.overview_plot import OverviewPlotter
+    return OverviewPlotter(load_config(config),
+                           load_config(plot_config),
+                           fasta, output).create_overview_plot()
 
 
 DEFAULT_CONFIGS = {
@@ -45,6 +63,15 @@ DEFAULT_CONFIGS = {
 
 def main():
     """Main function to generate protein sequencing plots."""
+    if sys.argv[1:2] == ['serve']:
+        from protein_sequencing import render_server
+        render_server.main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['batch']:
+        from protein_sequencing import batch
+        batch.main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description='Generate protein sequencing plots.')
 
     parser.add_argument(
@@ -71,24 +98,93 @@ def main():
                         required=False,
                         default='output',
                         help='Path to output folder, default=output')
+    parser.add_argument('--trace',
+                        required=False,
+                        help='Record the time, CPU time, peak RSS and item counts of every stage and write them to this file.')
+    parser.add_argument('--trace-format',
+                        required=False,
+                        default='jsonl',
+                        choices=instrumentation.TRACE_FORMATS,
+                        help='Format of the trace file, JSON lines or Chrome trace (chrome://tracing, Perfetto). Default=jsonl')
+    parser.add_argument('--profile',
+                        required=False,
+                        nargs='?',
+                        const='cprofile',
+                        choices=profiling.PROFILERS,
+                        help='Profile the run and write the profile and collapsed stacks to the output folder. Default profiler=cprofile')
+    parser.add_argument('--profile-aggregate',
+                        required=False,
+                        help='Add the per-function totals of the profiled run to this .prof file (cprofile only).')
+    figure_cache.add_cache_arguments(parser)
     args = parser.parse_args()
+    cache = figure_cache.cache_from_args(args)
 
     if args.plot_config:
         plot_config = args.plot_config
     else:
         plot_config = DEFAULT_CONFIGS[args.plot]
 
+    from protein_sequencing import sequence_plot, utils
     sequence_plot.CONFIG = importlib.import_module(args.config, 'configs')
     utils.CONFIG = importlib.import_module(args.config, 'configs')
 
-    if args.plot == 'bar':
-        generate_bar_plot(args.config, plot_config, args.fasta, args.output)
-    elif args.plot == 'details':
-        generate_details_plot(args.config, plot_config, args.fasta, args.output)
-    elif args.plot == 'overview':
-        generate_overview_plot(args.config, plot_config, args.fasta, args.output)
-    else:
-        print(f"Unknown plot type: {args.plot}. Please choose from 'bar', 'details', 'overview'.")
+    if args.trace:
+        instrumentation.enable()
+    try:
+        with instrumentation.span(f'{args.plot}_plot'):
+            if args.profile:
+                profiling.run_profiled(lambda: generate_plot(args.plot, args.config, plot_config, args.fasta, args.output, cache),
+                                       args.output, f'profile_{args.plot}', args.profile, args.profile_aggregate)
+            else:
+                generate_plot(args.plot, args.config, plot_config, args.fasta, args.output, cache)
+    finally:
+        instrumentation.write(args.trace, args.trace_format)
+
+
+def generate_plot(plot, config, plot_config, fasta, output, cache=None):
+    """Generate the plot selected on the command line, with the figure cache if one is given."""
+    if cache is not None and plot in ('bar', 'details', 'overview'):
+        return generate_cached_plot(plot, config, plot_config, fasta, output, cache)
+    if plot == 'bar':
+        return generate_bar_plot(config, plot_config, fasta, output)
+    if plot == 'details':
+        return generate_details_plot(config, plot_config, fasta, output)
+    if plot == 'overview':
+        return generate_overview_plot(config, plot_config, fasta, output)
+    print(f"Unknown plot type: {plot}. Please choose from 'bar', 'details', 'overview'.")
+    return None
+
+
+def generate_cached_plot(plot, config, plot_config, fasta, output, cache):
+    """Copy the figure from the figure cache or generate it, and export only the formats missing in the cache."""
+    config = load_config(config)
+    plot_config = load_config(plot_config)
+    save_plot = getattr(plot_config, 'SAVE_PLOT', True)
+    show_plot = getattr(plot_config, 'SHOW_PLOT', True)
+    key = figure_cache.figure_key(plot, fasta, config, plot_config)
+
+    exports = {output_format: cache.get(key, output_format) for output_format in (('png', 'svg') if save_plot else ())}
+    fig = None
+    if show_plot or None in exports.values():
+        figure_json = cache.get(key, 'json')
+        if figure_json is None:
+            # the plotter only creates the figure, saving and showing is done here
+            plot_settings = {**figure_cache.settings(plot_config), 'SAVE_PLOT': False, 'SHOW_PLOT': False}
+            fig = generate_plot(plot, config, SimpleNamespace(**plot_settings), fasta, output)
+            cache.put(key, 'json', fig.to_json().encode('utf-8'))
+        else:
+            import plotly.io as pio
+            fig = pio.from_json(figure_json.decode('utf-8'))
+    for output_format, data in exports.items():
+        if data is None:
+            with instrumentation.span(f'write_image_{output_format}'):
+                data = static_export.to_image(fig, output_format, getattr(config, 'EXPORT_BACKEND', 'auto'))
+            cache.put(key, output_format, data)
+        Path(output).mkdir(parents=True, exist_ok=True)
+        (Path(output) / f'figure1.{output_format}').write_bytes(data)
+    if show_plot:
+        fig.show()
+    return fig
 
 
 if __name__ == '__main__':
@@ -0,0 +1,143 @@
+"""Profiling of complete preprocessor and plot runs for the command line tools.
+The deterministic profiler (cProfile) writes a .prof file, the sampling profiler (pyinstrument, optional)
+an HTML report. Both write collapsed stacks, which can be turned into a flame graph with flamegraph.pl,
+speedscope or inferno."""
+import cProfile
+import os
+import pstats
+from collections import defaultdict
+from pathlib import Path
+
+PROFILERS = ('cprofile', 'pyinstrument')
+
+# deeper call chains, branches below one microsecond and the stacks after the first MAX_STACKS are cut off when
+# the collapsed stacks of cProfile are built, the number of call paths grows exponentially with the callers per function
+MAX_STACK_DEPTH = 64
+MIN_STACK_TIME = 1e-6
+MAX_STACKS = 100000
+
+
+def frame_label(function: tuple[str, int, str]) -> str:
+    """Return the label of a pstats function (file, line, name) in a collapsed stack."""
+    file_name, line, name = function
+    if file_name == '~':
+        return name
+    return f'{name} ({os.path.basename(file_name)}:{line})'
+
+
+def cprofile_collapsed_stacks(stats: pstats.Stats) -> dict[str, float]:
+    """Build collapsed stacks with the self time in seconds from the call graph recorded by cProfile.
+    cProfile only records caller and callee pairs, so the time of a function is split over its callers
+    in proportion to the time spent in the function from every caller. The callees are visited by descending time,
+    so with more than MAX_STACKS paths the remaining, shortest branches are left out."""
+    callees = defaultdict(dict)
+    roots = []
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        if not callers:
+            roots.append(function)
+        for caller, (_, _, _, cumulative) in callers.items():
+            callees[caller][function] = cumulative
+
+    stacks = defaultdict(float)
+    visited = 0
+
+    def visit(function, path, fraction):
+        nonlocal visited
+        visited += 1
+        total_time = stats.stats[function][2]
+        path = path + (frame_label(function),)
+        if total_time * fraction > 0:
+            stacks[';'.join(path)] += total_time * fraction
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        branches = []
+        for callee, edge_time in callees[function].items():
+            callee_cumulative = stats.stats[callee][3]
+            # recursive calls are already contained in the time of the outer call
+            if callee == function or frame_label(callee) in path or callee_cumulative <= 0:
+                continue
+            callee_fraction = fraction * min(1.0, edge_time / callee_cumulative)
+            if callee_cumulative * callee_fraction >= MIN_STACK_TIME:
+                branches.append((callee_cumulative * callee_fraction, callee, callee_fraction))
+        for _, callee, callee_fraction in sorted(branches, key=lambda branch: -branch[0]):
+            if visited >= MAX_STACKS:
+                return
+            visit(callee, path, callee_fraction)
+
+    for root in sorted(roots, key=lambda root: -stats.stats[root][3]):
+        if visited >= MAX_STACKS:
+            break
+        visit(root, (), 1.0)
+    return stacks
+
+
+def pyinstrument_collapsed_stacks(session) -> dict[str, float]:
+    """Build collapsed stacks with the self time in seconds from a pyinstrument session."""
+    stacks = defaultdict(float)
+    root = session.root_frame()
+    if root is None:
+        return stacks
+    pending = [(root, ())]
+    while pending:
+        frame, path = pending.pop()
+        path = path + (f'{frame.function} ({os.path.basename(frame.file_path_short or "")}:{frame.line_no})',)
+        self_time = frame.time - sum(child.time for child in frame.children)
+        if self_time > 0:
+            stacks[';'.join(path)] += self_time
+        pending.extend((child, path) for child in frame.children)
+    return stacks
+
+
+def write_collapsed_stacks(stacks: dict[str, float], collapsed_file: Path):
+    """Write collapsed stacks with the self time in microseconds, one stack per line."""
+    with collapsed_file.open('w', encoding='utf-8') as f:
+        for stack, seconds in sorted(stacks.items()):
+            microseconds = round(seconds * 1e6)
+            if microseconds > 0:
+                f.write(f'{stack} {microseconds}\n')
+
+
+def aggregate_profile(profile_file: Path, aggregate_file: Path | str):
+    """Add the per-function totals of a .prof file to the totals of earlier runs in aggregate_file."""
+    aggregate_file = Path(aggregate_file)
+    stats = pstats.Stats(str(profile_file))
+    if aggregate_file.exists():
+        stats.add(str(aggregate_file))
+    stats.dump_stats(aggregate_file)
+
+
+def run_profiled(func, output_dir: Path | str, name: str, profiler: str = 'cprofile', aggregate_file: Path | str | None = None):
+    """Run func under the profiler and write <name>.prof (cProfile) or <name>.html (pyinstrument)
+    and <name>.collapsed into output_dir. With an aggregate_file the per-function totals of the run
+    are added to it (cProfile only)."""
+    if profiler not in PROFILERS:
+        raise ValueError(f"Unknown profiler {profiler}, expected one of {', '.join(PROFILERS)}")
+    if aggregate_file is not None and profiler != 'cprofile':
+        raise ValueError("Aggregating profiles is only supported with cprofile")
+    output_dir = Path(output_dir)
+
+    if profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError as e:
+            raise ImportError("pyinstrument is not installed, install it or use the cprofile profiler") from e
+        sampling_profiler = Profiler()
+        sampling_profiler.start()
+        try:
+            return func()
+        finally:
+            session = sampling_profiler.stop()
+            output_dir.mkdir(parents=True, exist_ok=True)
+            (output_dir / f'{name}.html').write_text(sampling_profiler.output_html(), encoding='utf-8')
+            write_collapsed_stacks(pyinstrument_collapsed_stacks(session), output_dir / f'{name}.collapsed')
+
+    deterministic_profiler = cProfile.Profile()
+    try:
+        return deterministic_profiler.runcall(func)
+    finally:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        profile_file = output_dir / f'{name}.prof'
+        deterministic_profiler.dump_stats(profile_file)
+        write_collapsed_stacks(cprofile_collapsed_stacks(pstats.Stats(deterministic_profiler)), output_dir / f'{name}.collapsed')
+        if aggregate_file is not None:
+            aggregate_profile(profile_file, aggregate_file)
@@ -0,0 +1,318 @@
+"""Render server, keeps the plotting libraries, the alignments and kaleido (if installed) warm between plots.
+Start with python3 plots.py serve [--host HOST] [--port PORT | --socket PATH] [--input-root DIR] [--output-root DIR]
+[--config-package PACKAGE].
+
+Jobs are posted as JSON to /render:
+    plot: bar, details or overview
+    fasta: path to the FASTA file inside the --input-root folder
+    input: result CSV of the bar or overview plot inside the --input-root folder (optional)
+    config, plot_config: config modules of the configs package or a --config-package (optional, default as in plots.py)
+    config_overrides, plot_config_overrides: settings replacing the ones of the config modules (optional)
+    format: svg (default), png or json (plotly figure), exported with the EXPORT_BACKEND of the config
+    output_file: write the figure to this file inside the --output-root folder instead of returning it (optional)
+Jobs are rendered one after another, as the plotters keep the layout in module variables.
+The overrides can replace any setting, so the server must only listen on localhost or a socket of trusted users.
+Figures and exports are kept in the figure cache (see figure_cache.py) unless the server runs with --no-cache."""
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import socketserver
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+
+from protein_sequencing import figure_cache, sequence_plot, static_export, uniprot_align, utils
+from protein_sequencing.bar_plot import BarPlotter
+from protein_sequencing.details_plot import DetailsPlotter
+from protein_sequencing.overview_plot import OverviewPlotter
+from protein_sequencing.plots import DEFAULT_CONFIGS
+
+PLOTTERS = {
+    'bar': (BarPlotter, 'create_bar_plot', 'BAR_INPUT_FILE'),
+    'details': (DetailsPlotter, 'create_details_plot', None),
+    'overview': (OverviewPlotter, 'create_overview_plot', 'INPUT_FILE'),
+}
+CONTENT_TYPES = {'svg': 'image/svg+xml', 'png': 'image/png', 'json': 'application/json'}
+
+# figure cache of the server, None renders every job
+FIGURE_CACHE = None
+# packages of the config modules a job may load and the folders its input files and output_file must be in,
+# None allows all (batches run local jobs files), the server sets them from its arguments
+CONFIG_PACKAGES = None
+INPUT_ROOT = None
+OUTPUT_ROOT = None
+
+
+class RenderError(Exception):
+    """A render job that cannot be rendered, reported to the client with the status code."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+    def __reduce__(self):
+        # errors of worker processes are pickled
+        return RenderError, (self.status, str(self))
+
+
+def load_config(module: str, overrides: dict) -> SimpleNamespace:
+    """Copy the settings of a config module and replace single settings, without changing the module."""
+    if not isinstance(module, str):
+        raise RenderError(400, f"Invalid config module: {module!r}")
+    name = importlib.util.resolve_name(module, 'configs')
+    if CONFIG_PACKAGES is not None and not any(name.startswith(package + '.') for package in CONFIG_PACKAGES):
+        raise RenderError(403, f"Config module {name} is not in the config packages {', '.join(CONFIG_PACKAGES)}")
+    settings = figure_cache.settings(importlib.import_module(name))
+    settings.update(overrides)
+    return SimpleNamespace(**settings)
+
+
+def warm_up():
+    """Start the kaleido process, so that the first job does not wait for it."""
+    if static_export.kaleido_available():
+        import plotly.graph_objects as go
+        go.Figure().to_image(format='png')
+
+
+def check_path(path, name: str, root: Path | None) -> Path:
+    """Return a resolved file of a job, which must be inside root if it is set."""
+    if not isinstance(path, str) or not path:
+        raise RenderError(400, f"Invalid {name}: {path!r}")
+    resolved = Path(path).resolve()
+    if root is not None and not resolved.is_relative_to(root):
+        raise RenderError(403, f"The {name} {path} is not inside {root}")
+    return resolved
+
+
+def check_output_file(output_file) -> Path:
+    """Return the resolved output file of a job, which must be inside OUTPUT_ROOT if it is set."""
+    return check_path(output_file, 'output_file', OUTPUT_ROOT)
+
+
+def input_files(plot: str, plot_config) -> list:
+    """Return the result files a plot reads, set in its plot config."""
+    input_setting = PLOTTERS[plot][2]
+    if input_setting is not None:
+        return [getattr(plot_config, input_setting, None)]
+    return [input_file for _, input_file in getattr(plot_config, 'INPUT_FILES', {}).values()]
+
+
+def check_job(job: dict) -> tuple[str, SimpleNamespace, SimpleNamespace]:
+    """Check the plot type, input files, output file and format of a job.
+    Return the format and the configs of the job, which are loaded only once per job."""
+    if job.get('plot') not in PLOTTERS:
+        raise RenderError(400, f"Unknown plot type: {job.get('plot')}. Please choose from {', '.join(PLOTTERS)}.")
+    if 'fasta' not in job:
+        raise RenderError(400, "Missing fasta")
+    if 'output_file' in job:
+        check_output_file(job['output_file'])
+    output_format = job.get('format', 'svg')
+    if output_format not in CONTENT_TYPES:
+        raise RenderError(400, f"Unknown format: {output_format}. Please choose from {', '.join(CONTENT_TYPES)}.")
+    config, plot_config = load_job_configs(job)
+    if INPUT_ROOT is not None:
+        check_path(job['fasta'], 'fasta', INPUT_ROOT)
+        for input_file in input_files(job['plot'], plot_config):
+            check_path(input_file, 'input file', INPUT_ROOT)
+    if output_format != 'json':
+        try:
+            available = static_export.format_available(output_format, export_backend(config))
+        except ValueError as e:
+            raise RenderError(400, str(e)) from e
+        if not available:
+            raise RenderError(501, f"The {output_format} export needs kaleido, or resvg-py or cairosvg for png without kaleido")
+    return output_format, config, plot_config
+
+
+def load_job_configs(job: dict) -> tuple[SimpleNamespace, SimpleNamespace]:
+    """Load the config and plot config of a job with the overrides of the job."""
+    input_setting = PLOTTERS[job['plot']][2]
+    plot_config_overrides = dict(job.get('plot_config_overrides', {}))
+    if 'input' in job:
+        if input_setting is None:
+            raise RenderError(400, "The details plot takes its input files from the INPUT_FILES setting")
+        plot_config_overrides[input_setting] = job['input']
+    # the plotters only return the figure, the export is done by the caller
+    plot_config_overrides.update({'SAVE_PLOT': False, 'SHOW_PLOT': False})
+    try:
+        config = load_config(job.get('config', DEFAULT_CONFIGS['config']), job.get('config_overrides', {}))
+        plot_config = load_config(job.get('plot_config', DEFAULT_CONFIGS[job['plot']]), plot_config_overrides)
+    except ImportError as e:
+        raise RenderError(400, str(e)) from e
+    return config, plot_config
+
+
+def export_backend(config) -> str:
+    """Return the static export backend of a job, set by EXPORT_BACKEND in its config."""
+    return getattr(config, 'EXPORT_BACKEND', 'auto')
+
+
+def create_figure(job: dict, config, plot_config):
+    """Create the figure of a checked job with the plotter of its plot type."""
+    plotter_class, create, _ = PLOTTERS[job['plot']]
+    sequence_plot.CONFIG = config
+    utils.CONFIG = config
+    # the plotters remove all files of the output folder when they are done
+    with tempfile.TemporaryDirectory() as output_dir:
+        return getattr(plotter_class(config, plot_config, job['fasta'], output_dir), create)()
+
+
+def export_figure(fig, output_format: str, backend: str = 'auto') -> bytes:
+    """Export a figure as svg, png or plotly JSON."""
+    if output_format == 'json':
+        return fig.to_json().encode('utf-8')
+    return static_export.to_image(fig, output_format, backend)
+
+
+def job_key(job: dict, config, plot_config) -> str:
+    """Return the figure cache key of a checked job."""
+    return figure_cache.figure_key(job['plot'], job['fasta'], config, plot_config)
+
+
+def create_cached_figure(job: dict, config, plot_config, key: str):
+    """Return the figure of a checked job from the figure cache, or create it and add it to the cache."""
+    figure_json = FIGURE_CACHE.get(key, 'json')
+    if figure_json is not None:
+        import plotly.io as pio
+        return pio.from_json(figure_json.decode('utf-8'))
+    fig = create_figure(job, config, plot_config)
+    FIGURE_CACHE.put(key, 'json', fig.to_json().encode('utf-8'))
+    return fig
+
+
+def render(job: dict) -> tuple[bytes, str]:
+    """Render a job and return the figure and its content type."""
+    output_format, config, plot_config = check_job(job)
+    if FIGURE_CACHE is None:
+        return export_figure(create_figure(job, config, plot_config), output_format, export_backend(config)), CONTENT_TYPES[output_format]
+    key = job_key(job, config, plot_config)
+    figure = FIGURE_CACHE.get(key, output_format)
+    if figure is None:
+        figure = export_figure(create_cached_figure(job, config, plot_config, key), output_format, export_backend(config))
+        if output_format != 'json':
+            FIGURE_CACHE.put(key, output_format, figure)
+    return figure, CONTENT_TYPES[output_format]
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    """Handles GET /health and POST /render."""
+
+    def do_GET(self):
+        """Report that the server is running."""
+        if self.path != '/health':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        self.send_json(200, {'status': 'ok', 'kaleido': static_export.kaleido_available(),
+                             'native_png': static_export.rasteriser_available(),
+                             'cached_alignments': len(uniprot_align.ALIGNMENT_CACHE or {})})
+
+    def do_POST(self):
+        """Render the posted job."""
+        if self.path != '/render':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        start = time.perf_counter()
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(job, dict):
+                raise RenderError(400, "The job must be a JSON object")
+            figure, content_type = render(job)
+        except json.JSONDecodeError as e:
+            self.send_json(400, {'error': f'Invalid JSON: {e}'})
+            return
+        except RenderError as e:
+            self.send_json(e.status, {'error': str(e)})
+            return
+        except FileNotFoundError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            # errors of the plotters (e.g. too many PTMs) must not stop the server
+            self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+            return
+        seconds = time.perf_counter() - start
+
+        if 'output_file' in job:
+            with open(check_output_file(job['output_file']), 'wb') as f:
+                f.write(figure)
+            self.send_json(200, {'output_file': job['output_file'], 'seconds': seconds})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(figure)))
+        self.send_header('X-Render-Seconds', f'{seconds:.3f}')
+        self.end_headers()
+        self.wfile.write(figure)
+
+    def send_json(self, status: int, body: dict):
+        """Send a JSON response."""
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', CONTENT_TYPES['json'])
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix socket."""
+
+    def get_request(self):
+        # clients of a Unix socket have no address, the request handler expects one for logging
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+def serve(host: str = '127.0.0.1', port: int = 8050, socket_path: str | None = None,
+          cache: figure_cache.FigureCache | None = None, output_root: str = 'output',
+          config_packages: tuple[str, ...] = ('configs',), input_root: str = '.'):
+    """Render jobs until interrupted, with the figures of earlier jobs taken from cache.
+    Jobs only load config modules of the config packages, only read the FASTA and result files inside input_root
+    and only write output files inside output_root."""
+    global FIGURE_CACHE, INPUT_ROOT, OUTPUT_ROOT, CONFIG_PACKAGES
+    uniprot_align.ALIGNMENT_CACHE = {}
+    FIGURE_CACHE = cache
+    INPUT_ROOT = Path(input_root).resolve()
+    OUTPUT_ROOT = Path(output_root).resolve()
+    CONFIG_PACKAGES = tuple(config_packages)
+    warm_up()
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, RenderHandler)
+        print(f"Rendering plots on unix socket {socket_path}")
+    else:
+        server = HTTPServer((host, port), RenderHandler)
+        print(f"Rendering plots on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def main(argv=None):
+    """Main function to start the render server."""
+    parser = argparse.ArgumentParser(prog='plots.py serve', description='Render protein sequencing plots on request.')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on. Default=127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050, help='Port to listen on. Default=8050')
+    parser.add_argument('--socket', default=None, help='Listen on this Unix socket instead of host and port.')
+    parser.add_argument('--input-root', default='.', help='Folder the FASTA and result files of the jobs must be in. Default=.')
+    parser.add_argument('--output-root', default='output', help='Folder the output files of the jobs must be in. Default=output')
+    parser.add_argument('--config-package', action='append', default=None,
+                        help='Package of the config modules jobs may load, can be repeated. Default=configs')
+    figure_cache.add_cache_arguments(parser)
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.socket, figure_cache.cache_from_args(args), args.output_root,
+          tuple(args.config_package or ('configs',)), args.input_root)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,20 +4,22 @@ import os
 import importlib
 from pathlib import Path
 
-import plotly.graph_objects as go
-from protein_sequencing import utils, exon_helper
+from protein_sequencing import utils, exon_helper, instrumentation
+from protein_sequencing.layout import Layout
 
 CONFIG = importlib.import_module('configs.default_config', 'configs')
 
 
+@instrumentation.traced()
 def create_plot(
         input_file: str | os.PathLike,
         present_modifications,
         groups_missing=None,
         legend_positioning=None,
         out_dir=None
-) -> go.Figure:
+) -> Layout:
     """Create the plot with main sequence and all addiational information."""
+    utils.reset_layout()
     (
         exon_found,
         exon_start_index,
@@ -29,7 +31,10 @@ def create_plot(
         exon_2_length,
         _,
         max_sequence_length
-    ) = exon_helper.retrieve_exon(input_file, CONFIG.MIN_EXON_LENGTH, out_dir=Path(out_dir))
+    ) = exon_helper.retrieve_exon(input_file, CONFIG.MIN_EXON_LENGTH, out_dir=Path(out_dir), aligner=getattr(CONFIG, 'ALIGNER', 'auto'), workers=getattr(CONFIG, 'ALIGNMENT_WORKERS', 1))
+
+    # last position of the isoforms, before the exons are placed one after the other
+    max_position = max_sequence_length
 
     # exon checks
     if exon_found:
@@ -142,28 +147,30 @@ def create_plot(
         region_index += 1
         region_plot_type = 0
 
+    utils.build_residue_pixels(max_position)
     fig = create_sequence_plot(region_boundaries, present_modifications, groups_missing, legend_positioning)
+    fig.residues = utils.RESIDUE_PIXELS
 
     return fig
 
 
 def create_sequence_plot(region_boundaries: list[tuple[str, int, int, str, int, int]], present_modifications,
-                         groups_missing: str | None, legend_positioning: str | None) -> go.Figure:
+                         groups_missing: str | None, legend_positioning: str | None) -> Layout:
     """Create the sequence plot."""
-    fig = go.Figure()
+    fig = Layout()
 
     width = utils.get_width()
     height = utils.get_height()
 
     # General Layout
     fig.update_layout(
-        title="",
+        title=dict(text=""),
         width=width,
         height=height,
         xaxis=dict(range=[0, width], autorange=False),
         yaxis=dict(range=[0, height], autorange=False),
         plot_bgcolor="white",
-        font_family=CONFIG.FONT,
+        font=dict(family=CONFIG.FONT),
         margin=dict(l=0, r=0, t=0, b=0),
     )
     fig.update_xaxes(visible=False)
@@ -207,13 +214,13 @@ def create_sequence_plot(region_boundaries: list[tuple[str, int, int, str, int,
         text_position = "bottom right"
         if legend_positioning == 'A' and CONFIG.FIGURE_ORIENTATION == 1:
             text_position = "bottom left"
-        fig.add_trace(go.Scatter(x=[x_legend], y=[y_legend],
-                                 mode='text',
-                                 text=f"<b>{CONFIG.MODIFICATION_LEGEND_TITLE}</b>",
-                                 textposition=text_position,
-                                 showlegend=False, hoverinfo='none',
-                                 textfont=dict(size=CONFIG.SEQUENCE_PLOT_FONT_SIZE,
-                                               color="black")))
+        fig.add_scatter(x=[x_legend], y=[y_legend],
+                        mode='text',
+                        text=f"<b>{CONFIG.MODIFICATION_LEGEND_TITLE}</b>",
+                        textposition=text_position,
+                        showlegend=False, hoverinfo='none',
+                        textfont=dict(size=CONFIG.SEQUENCE_PLOT_FONT_SIZE,
+                                      color="black"))
         y_legend -= utils.get_label_height()
 
         labels = [CONFIG.MODIFICATIONS[mod] for mod in present_modifications]
@@ -221,15 +228,14 @@ def create_sequence_plot(region_boundaries: list[tuple[str, int, int, str, int,
         if groups_missing == 'A' or CONFIG.FIGURE_ORIENTATION == 1:
             sorted_labels = sorted_labels[::-1]
         for i, mod in enumerate(sorted_labels):
-            fig.add_trace(
-                go.Scatter(x=[x_legend],
-                           y=[y_legend - i * utils.get_label_height()],
-                           mode='text',
-                           text=mod[0],
-                           textposition=text_position,
-                           showlegend=False,
-                           hoverinfo='none',
-                           textfont=dict(size=CONFIG.SEQUENCE_PLOT_FONT_SIZE, color=mod[1])))
+            fig.add_scatter(x=[x_legend],
+                            y=[y_legend - i * utils.get_label_height()],
+                            mode='text',
+                            text=mod[0],
+                            textposition=text_position,
+                            showlegend=False,
+                            hoverinfo='none',
+                            textfont=dict(size=CONFIG.SEQUENCE_PLOT_FONT_SIZE, color=mod[1]))
 
     # Sequence
     fig = plot_sequence(fig, region_boundaries, groups_missing)
@@ -317,12 +323,13 @@ def plot_sequence(fig, region_boundaries, groups_missing):
                 x = [x0, x1, x1, x0, x0]
                 y = [y0, y0 + CONFIG.EXON_GAP // 2, y1, y1 - CONFIG.EXON_GAP // 2, y0]
         if exon_type != 0:
-            fig.add_trace(go.Scatter(x=x,
-                                     y=y,
-                                     mode='lines',
-                                     fillcolor=region_color,
-                                     fill='toself',
-                                     line=dict(color="darkgrey", width=2), showlegend=False, hoverinfo='none'))
+            fig.add_scatter(x=x,
+                            y=y,
+                            mode='lines',
+                            fillcolor=region_color,
+                            fill='toself',
+                            line=dict(color="darkgrey", width=2), showlegend=False, hoverinfo='none')
+        fig.add_region(region_name, x0, y0, x1, y1, region_start, region_end, region_color)
         # Labels
         x_label = (x0 + x1) / 2
         y_label = (y0 + y1) / 2
@@ -361,7 +368,7 @@ def plot_sequence(fig, region_boundaries, groups_missing):
     fig.add_annotation(
         x=x,
         y=y,
-        text=max(last_region_end, region_boundaries[last_i - 1][5]),
+        text=str(max(last_region_end, region_boundaries[last_i - 1][5])),
         showarrow=False,
         font=dict(size=CONFIG.SEQUENCE_PLOT_FONT_SIZE, color="gray"),
         textangle=0
@@ -0,0 +1,352 @@
+"""Static export of the figures as SVG and PNG, with kaleido or with the native backend.
+The plotters draw on hidden axes whose ranges match the figure size, so every trace, shape and annotation
+maps to a few SVG elements without a browser. The native backend writes these elements directly and
+rasterises PNG images with resvg (resvg-py) or cairosvg, if one of them is installed.
+It supports what the plotters use: scatter traces with lines, filled polygons and text, heatmaps,
+rectangle and line shapes and annotations without arrows. Text widths for the anchoring are measured with font_metrics."""
+import importlib
+import math
+import re
+from xml.sax.saxutils import escape
+
+from protein_sequencing import font_metrics
+
+EXPORT_BACKENDS = ('auto', 'kaleido', 'native')
+
+# used if the font of the figure is not installed, e.g. Arial on Linux
+FALLBACK_FONTS = 'Helvetica, Liberation Sans, DejaVu Sans, sans-serif'
+
+# plotly's line height of multi-line text in em
+LINE_SPACING = 1.3
+
+
+def kaleido_available() -> bool:
+    """Check if kaleido is installed for the static image export."""
+    try:
+        import kaleido
+    except ImportError:
+        return False
+    return True
+
+
+def rasteriser_available() -> bool:
+    """Check if resvg-py or cairosvg is installed for the PNG export of the native backend."""
+    for module in ('resvg_py', 'cairosvg'):
+        try:
+            importlib.import_module(module)
+        except (ImportError, OSError):
+            # cairosvg raises OSError if the cairo library is missing
+            continue
+        return True
+    return False
+
+
+def resolve_backend(backend: str = 'auto') -> str:
+    """Return the backend used for the export, auto prefers kaleido if it is installed."""
+    if backend not in EXPORT_BACKENDS:
+        raise ValueError(f"Unknown export backend {backend}, expected one of {', '.join(EXPORT_BACKENDS)}")
+    if backend == 'auto':
+        return 'kaleido' if kaleido_available() else 'native'
+    return backend
+
+
+def format_available(image_format: str, backend: str = 'auto') -> bool:
+    """Check if figures can be exported in the format (svg or png) with the backend."""
+    if resolve_backend(backend) == 'kaleido':
+        return kaleido_available()
+    return image_format == 'svg' or (image_format == 'png' and rasteriser_available())
+
+
+def to_image(fig, image_format: str, backend: str = 'auto') -> bytes:
+    """Export a figure as svg or png."""
+    if resolve_backend(backend) == 'kaleido':
+        return fig.to_image(format=image_format)
+    svg = figure_to_svg(fig)
+    if image_format == 'svg':
+        return svg.encode('utf-8')
+    if image_format == 'png':
+        return svg_to_png(svg)
+    raise ValueError(f"Unknown image format {image_format}, the native backend writes svg and png")
+
+
+def write_image(fig, image_file, backend: str = 'auto'):
+    """Export a figure to a file, the format is taken from the extension."""
+    image_format = str(image_file).rsplit('.', 1)[-1]
+    if resolve_backend(backend) == 'kaleido':
+        fig.write_image(image_file)
+        return
+    with open(image_file, 'wb') as f:
+        f.write(to_image(fig, image_format, 'native'))
+
+
+def svg_to_png(svg: str, scale: float = 1.0) -> bytes:
+    """Rasterise an SVG image with resvg-py or cairosvg."""
+    try:
+        import resvg_py
+        return bytes(resvg_py.svg_to_bytes(svg_string=svg, zoom=scale))
+    except ImportError:
+        pass
+    try:
+        import cairosvg
+    except (ImportError, OSError) as e:
+        raise ImportError("The png export without kaleido needs resvg-py or cairosvg, install one of them or export svg") from e
+    return cairosvg.svg2png(bytestring=svg.encode('utf-8'), scale=scale)
+
+
+def parse_color(color: str) -> tuple[float, float, float]:
+    """Return the red, green and blue values of a hex or rgb() color."""
+    color = color.strip()
+    if color.startswith('#'):
+        value = color[1:]
+        if len(value) == 3:
+            value = ''.join(char * 2 for char in value)
+        return tuple(int(value[i:i + 2], 16) for i in (0, 2, 4))
+    match = re.fullmatch(r'rgba?\(([^)]*)\)', color)
+    if match is None:
+        raise ValueError(f"Unsupported color {color} in a colorscale of the native export")
+    return tuple(float(part) for part in match.group(1).split(',')[:3])
+
+
+def colorscale_color(colorscale: list, value: float) -> str:
+    """Interpolate the color of a normalized value (0 to 1) in a colorscale."""
+    value = min(max(value, 0.0), 1.0)
+    for (start, start_color), (end, end_color) in zip(colorscale, colorscale[1:]):
+        if value <= end:
+            fraction = 0.0 if end == start else (value - start) / (end - start)
+            low, high = parse_color(start_color), parse_color(end_color)
+            return 'rgb({},{},{})'.format(*(round(a + (b - a) * fraction) for a, b in zip(low, high)))
+    return colorscale[-1][1]
+
+
+class _Canvas:
+    """Maps the coordinates of the figure to pixels and collects the SVG elements."""
+
+    def __init__(self, layout: dict):
+        self.layout = layout
+        self.template = layout.get('template', {}).get('layout', {})
+        self.width = layout.get('width') or 700
+        self.height = layout.get('height') or 450
+        margin = {**{'l': 80, 'r': 80, 't': 100, 'b': 80}, **self.template.get('margin', {}), **layout.get('margin', {})}
+        self.left, self.top = margin['l'], margin['t']
+        self.plot_width = self.width - margin['l'] - margin['r']
+        self.plot_height = self.height - margin['t'] - margin['b']
+        self.x_range = layout.get('xaxis', {}).get('range')
+        self.y_range = layout.get('yaxis', {}).get('range')
+        if self.x_range is None or self.y_range is None:
+            raise ValueError("The native export needs fixed axis ranges, use the kaleido backend")
+        self.font = {'family': 'Arial', 'size': 12, 'color': '#444', **self.template.get('font', {}), **layout.get('font', {})}
+        self.colorway = self.template.get('colorway') or ['#636efa']
+        self.elements = []
+
+    def setting(self, name: str, default):
+        """Return a layout setting, from the template if the figure does not set it."""
+        return self.layout.get(name, self.template.get(name, default))
+
+    def x(self, value: float) -> float:
+        """Return the pixel column of an x coordinate."""
+        start, end = self.x_range
+        return round(self.left + (value - start) / (end - start) * self.plot_width, 2)
+
+    def y(self, value: float) -> float:
+        """Return the pixel row of a y coordinate."""
+        start, end = self.y_range
+        return round(self.top + (end - value) / (end - start) * self.plot_height, 2)
+
+    def text(self, lines: list[str], x: float, y: float, font: dict, anchor: str = 'middle', first_line_offset: float | None = None,
+             angle: float = 0, center: tuple[float, float] | None = None, bold: bool = False):
+        """Add lines of text, centered on (x, y) unless the first baseline is given relative to y.
+        Rotated text turns around center, (x, y) by default."""
+        size = font['size']
+        if first_line_offset is None:
+            first_line_offset = -(len(lines) - 1) * LINE_SPACING * size / 2 + 0.35 * size
+        center_x, center_y = center or (x, y)
+        transform = f' transform="rotate({angle:g} {center_x:g} {center_y:g})"' if angle else ''
+        weight = ' font-weight="bold"' if bold else ''
+        spans = []
+        for i, line in enumerate(lines):
+            line_y = y + first_line_offset + i * LINE_SPACING * size
+            spans.append(f'<tspan x="{x:g}" y="{line_y:.2f}">{line}</tspan>')
+        self.elements.append(f'<text font-family="{escape(font["family"])}, {FALLBACK_FONTS}" font-size="{size:g}" fill="{font["color"]}" '
+                             f'text-anchor="{anchor}"{weight}{transform}>{"".join(spans)}</text>')
+
+
+def _text_lines(text) -> tuple[list[str], bool]:
+    """Split the HTML-like text of plotly into escaped lines and tell if it is bold."""
+    text = str(text)
+    bold = bool(re.search(r'<b>', text, re.IGNORECASE))
+    lines = re.split(r'<br\s*/?>', text, flags=re.IGNORECASE)
+    return [escape(re.sub(r'<[^>]+>', '', line)) for line in lines], bold
+
+
+def _values(value, count: int) -> list:
+    """Return a trace attribute that is either one value or one value per point as a list."""
+    if isinstance(value, (list, tuple)) or hasattr(value, 'tolist'):
+        return list(value)
+    return [value] * count
+
+
+def _draw_shape(canvas: _Canvas, shape: dict):
+    """Draw a rectangle or line shape."""
+    shape_type = shape.get('type', 'rect')
+    line = shape.get('line', {})
+    stroke = line.get('color', '#444') if line.get('width', 2) else 'none'
+    stroke_width = line.get('width', 2)
+    x_0, x_1 = canvas.x(shape['x0']), canvas.x(shape['x1'])
+    y_0, y_1 = canvas.y(shape['y0']), canvas.y(shape['y1'])
+    if shape_type == 'rect':
+        fill = shape.get('fillcolor', 'none')
+        canvas.elements.append(f'<rect x="{min(x_0, x_1):g}" y="{min(y_0, y_1):g}" width="{abs(x_1 - x_0):g}" '
+                               f'height="{abs(y_1 - y_0):g}" fill="{fill}" stroke="{stroke}" stroke-width="{stroke_width:g}"/>')
+    elif shape_type == 'line':
+        canvas.elements.append(f'<line x1="{x_0:g}" y1="{y_0:g}" x2="{x_1:g}" y2="{y_1:g}" stroke="{stroke}" '
+                               f'stroke-width="{stroke_width:g}"/>')
+    else:
+        raise ValueError(f"Shapes of type {shape_type} are not supported by the native export, use the kaleido backend")
+
+
+def _draw_scatter(canvas: _Canvas, trace: dict, index: int):
+    """Draw the lines, filled polygons and text of a scatter trace."""
+    mode = trace.get('mode', 'lines')
+    xs, ys = list(trace.get('x', [])), list(trace.get('y', []))
+    if 'markers' in mode:
+        raise ValueError("Scatter markers are not supported by the native export, use the kaleido backend")
+    if 'lines' in mode:
+        line = trace.get('line', {})
+        color = line.get('color', canvas.colorway[index % len(canvas.colorway)])
+        width = line.get('width', 2)
+        # None separates the parts of a line
+        parts, part = [], []
+        for x, y in zip(xs, ys):
+            if x is None or y is None:
+                parts.append(part)
+                part = []
+            else:
+                part.append(f'{canvas.x(x):g},{canvas.y(y):g}')
+        parts.append(part)
+        fill = trace.get('fillcolor', color) if trace.get('fill') == 'toself' else 'none'
+        path = ''.join(f'M{"L".join(part)}{"Z" if fill != "none" else ""}' for part in parts if part)
+        if path:
+            canvas.elements.append(f'<path d="{path}" fill="{fill}" stroke="{color if width else "none"}" '
+                                   f'stroke-width="{width:g}" stroke-linejoin="round"/>')
+    if 'text' in mode:
+        count = len(xs)
+        font = trace.get('textfont', {})
+        positions = _values(trace.get('textposition', 'middle center'), count)
+        sizes = _values(font.get('size', canvas.font['size']), count)
+        colors = _values(font.get('color', canvas.font['color']), count)
+        families = _values(font.get('family', canvas.font['family']), count)
+        for x, y, text, position, size, color, family in zip(xs, ys, _values(trace.get('text', ''), count),
+                                                              positions, sizes, colors, families):
+            if x is None or y is None or text in (None, ''):
+                continue
+            lines, _ = _text_lines(text)
+            vertical, _, horizontal = position.partition(' ')
+            anchor = {'left': 'end', 'right': 'start'}.get(horizontal, 'middle')
+            block = (len(lines) - 1) * LINE_SPACING * size
+            # the text is placed next to the point as plotly does for text without markers
+            first_line_offset = {'top': -0.3 * size - block, 'bottom': 1.0 * size}.get(vertical, -block / 2 + 0.35 * size)
+            canvas.text(lines, canvas.x(x), canvas.y(y), {'family': family, 'size': size, 'color': color}, anchor,
+                        first_line_offset=first_line_offset)
+
+
+def cell_edges(coordinates, start, step, count: int) -> list[float]:
+    """Return the edges of the heatmap cells along one axis."""
+    if coordinates is not None and len(coordinates) == count + 1:
+        return [float(value) for value in coordinates]
+    if coordinates is not None and len(coordinates) == count:
+        centers = [float(value) for value in coordinates]
+    else:
+        centers = [start + i * step for i in range(count)]
+    if count == 1:
+        half = step / 2
+        return [centers[0] - half, centers[0] + half]
+    edges = [(a + b) / 2 for a, b in zip(centers, centers[1:])]
+    return [2 * centers[0] - edges[0], *edges, 2 * centers[-1] - edges[-1]]
+
+
+def _draw_heatmap(canvas: _Canvas, trace: dict):
+    """Draw the cells of a heatmap as rectangles."""
+    z = [[None if value is None or (isinstance(value, float) and math.isnan(value)) else float(value) for value in row]
+         for row in (trace['z'].tolist() if hasattr(trace['z'], 'tolist') else trace['z'])]
+    if not z or not z[0]:
+        return
+    values = [value for row in z for value in row if value is not None]
+    if not values:
+        return
+    z_min, z_max = trace.get('zmin'), trace.get('zmax')
+    if z_min is None or z_max is None:
+        z_min, z_max = min(values), max(values)
+        if trace.get('zmid') is not None:
+            spread = max(abs(z_max - trace['zmid']), abs(z_min - trace['zmid']))
+            z_min, z_max = trace['zmid'] - spread, trace['zmid'] + spread
+    colorscale = trace['colorscale']
+    x_edges = cell_edges(trace.get('x'), trace.get('x0', 0), trace.get('dx', 1), len(z[0]))
+    y_edges = cell_edges(trace.get('y'), trace.get('y0', 0), trace.get('dy', 1), len(z))
+    x_gap, y_gap = trace.get('xgap', 0), trace.get('ygap', 0)
+    cells = []
+    for row, (y_0, y_1) in zip(z, zip(y_edges, y_edges[1:])):
+        top, bottom = sorted((canvas.y(y_0), canvas.y(y_1)))
+        for value, (x_0, x_1) in zip(row, zip(x_edges, x_edges[1:])):
+            if value is None:
+                continue
+            left, right = sorted((canvas.x(x_0), canvas.x(x_1)))
+            normalized = 0.5 if z_max == z_min else (value - z_min) / (z_max - z_min)
+            cells.append(f'<rect x="{left + x_gap / 2:g}" y="{top + y_gap / 2:g}" width="{max(right - left - x_gap, 0):g}" '
+                         f'height="{max(bottom - top - y_gap, 0):g}" fill="{colorscale_color(colorscale, normalized)}"/>')
+    canvas.elements.append(f'<g shape-rendering="crispEdges">{"".join(cells)}</g>')
+
+
+def _draw_annotation(canvas: _Canvas, annotation: dict):
+    """Draw the text of an annotation, anchored and rotated as plotly does."""
+    if annotation.get('showarrow', True):
+        raise ValueError("Annotations with arrows are not supported by the native export, use the kaleido backend")
+    font = {**canvas.font, **{key: value for key, value in annotation.get('font', {}).items() if value is not None}}
+    lines, bold = _text_lines(annotation.get('text', ''))
+    size = font['size']
+    # text box with the default border and padding of plotly
+    padding = 2 * (annotation.get('borderpad', 1) + annotation.get('borderwidth', 1))
+    width = max(font_metrics.text_width(re.sub(r'&\w+;', 'x', line), size, font['family'].split(',')[0].strip()) for line in lines) + padding
+    height = len(lines) * LINE_SPACING * size + padding
+    angle = annotation.get('textangle', 0) or 0
+    radians = math.radians(angle)
+    box_width = abs(width * math.cos(radians)) + abs(height * math.sin(radians))
+    box_height = abs(width * math.sin(radians)) + abs(height * math.cos(radians))
+    x, y = canvas.x(annotation['x']), canvas.y(annotation['y'])
+    x += {'left': box_width / 2, 'right': -box_width / 2}.get(annotation.get('xanchor'), 0)
+    y += {'top': box_height / 2, 'bottom': -box_height / 2}.get(annotation.get('yanchor'), 0)
+    align = annotation.get('align', 'center')
+    anchor = {'left': 'start', 'right': 'end'}.get(align, 'middle')
+    line_x = x + {'left': -(width - padding) / 2, 'right': (width - padding) / 2}.get(align, 0)
+    canvas.text(lines, line_x, y, font, anchor, angle=angle, center=(x, y), bold=bold)
+
+
+def figure_to_svg(fig) -> str:
+    """Write a figure (plotly figure or its dict) as SVG."""
+    figure = fig if isinstance(fig, dict) else fig.to_dict()
+    layout = figure.get('layout', {})
+    canvas = _Canvas(layout)
+    canvas.elements.append(f'<rect width="{canvas.width}" height="{canvas.height}" fill="{canvas.setting("paper_bgcolor", "white")}"/>')
+    canvas.elements.append(f'<rect x="{canvas.left}" y="{canvas.top}" width="{canvas.plot_width}" height="{canvas.plot_height}" '
+                           f'fill="{canvas.setting("plot_bgcolor", "#E5ECF6")}"/>')
+    shapes = layout.get('shapes', [])
+    for shape in shapes:
+        if shape.get('layer') == 'below':
+            _draw_shape(canvas, shape)
+    for index, trace in enumerate(figure.get('data', [])):
+        if trace.get('visible', True) is not True:
+            continue
+        trace_type = trace.get('type', 'scatter')
+        if trace_type == 'scatter':
+            _draw_scatter(canvas, trace, index)
+        elif trace_type == 'heatmap':
+            _draw_heatmap(canvas, trace)
+        else:
+            raise ValueError(f"Traces of type {trace_type} are not supported by the native export, use the kaleido backend")
+    for shape in shapes:
+        if shape.get('layer') != 'below':
+            _draw_shape(canvas, shape)
+    for annotation in layout.get('annotations', []):
+        _draw_annotation(canvas, annotation)
+    body = '\n'.join(canvas.elements)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{canvas.width}" height="{canvas.height}" '
+            f'viewBox="0 0 {canvas.width} {canvas.height}">\n{body}\n</svg>\n')
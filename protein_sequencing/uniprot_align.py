@@ -1,53 +1,128 @@
-"""Module to align protein sequences using Clustal Omega"""
+"""Module to align protein sequences using Clustal Omega or the in-process isoform aligner"""
 
 import os
+import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from Bio import AlignIO, SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
 
+from protein_sequencing import instrumentation
+from protein_sequencing.data_preprocessing import fasta_index
 
-def get_alignment(input_file: Path | str, out_dir: Path | str) -> AlignIO.MultipleSeqAlignment:
-    if not isinstance(input_file, Path):
-        input_file = Path(input_file)
-    if not isinstance(out_dir, Path):
-        out_dir = Path(out_dir)
-    if not out_dir.exists():
-        os.makedirs(out_dir, exist_ok=True)
+ALIGNERS = ('auto', 'clustalo', 'builtin')
+# file of the output folder the alignment is written to
+ALIGNED_FASTA_NAME = 'aligned.fasta'
+CLUSTAL_OMEGA_BINARY = Path(__file__).resolve().parent.parent / 'clustal-omega' / 'clustalo-1.2.4-Ubuntu-x86_64'
+
+# set to a dict to reuse the alignments of unchanged FASTA files in a long-running process
+ALIGNMENT_CACHE = None
 
-    """Align protein sequences using Clustal Omega."""
-    records = list(SeqIO.parse(input_file, 'fasta'))
 
+def get_clustal_omega_path() -> str | None:
+    """Locate Clustal Omega: the CLUSTAL_OMEGA environment variable, the clustal-omega folder of the repository or the PATH."""
+    for candidate in (os.environ.get('CLUSTAL_OMEGA'), CLUSTAL_OMEGA_BINARY):
+        if candidate and os.access(candidate, os.X_OK):
+            return str(candidate)
+    return shutil.which('clustalo')
+
+
+def run_clustal_omega(records: list, clustal_omega_path: str, input_file: Path, out_dir: Path, threads: int | None = None) -> AlignIO.MultipleSeqAlignment:
+    """Align the records with the Clustal Omega binary."""
     padded_sequences_path = out_dir / f'{input_file.stem}_padded{input_file.suffix}'
     aligned_fasta_path = out_dir / f'{input_file.stem}_aligned{input_file.suffix}'
     # write to temporary file and do alignment
     with padded_sequences_path.open('w', encoding="utf-8") as f:
         SeqIO.write(records, f, 'fasta')
+    try:
+        subprocess.run([clustal_omega_path,
+                        f'--infile={padded_sequences_path}',
+                        f'--outfile={aligned_fasta_path}',
+                        '--outfmt=fasta',
+                        '--iter=0',
+                        '--force'] + ([f'--threads={threads}'] if threads else []),
+                       stdout=subprocess.PIPE, text=True, check=True)
+        return AlignIO.read(f"{aligned_fasta_path}", "fasta")
+    finally:
+        # clean up temporary files
+        if padded_sequences_path.exists():
+            padded_sequences_path.unlink()
+        if aligned_fasta_path.exists():
+            aligned_fasta_path.unlink()
+
+
+def run_clustal_omega_star(records: list, clustal_omega_path: str, out_dir: Path, workers: int | None) -> AlignIO.MultipleSeqAlignment:
+    """Align every isoform against the longest isoform with concurrent Clustal Omega runs and merge them into a star alignment."""
+    from protein_sequencing import isoform_aligner
+
+    anchor_index = isoform_aligner.get_anchor_index(records)
+    others = [k for k in range(len(records)) if k != anchor_index]
+
+    def align_with_anchor(k: int) -> tuple[str, str]:
+        # every pair gets its own directory for the temporary files of Clustal Omega
+        with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+            pair = run_clustal_omega([records[anchor_index], records[k]], clustal_omega_path, Path(tmp_dir) / 'pair.fasta', Path(tmp_dir), threads=1)
+        aligned = {record.id: str(record.seq) for record in pair}
+        return aligned[records[anchor_index].id], aligned[records[k].id]
+
+    # every worker waits on its own Clustal Omega process, so threads are sufficient
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pairwise_alignments = list(executor.map(align_with_anchor, others))
+    return isoform_aligner.build_alignment(records, anchor_index, others, pairwise_alignments)
+
+
+def align_records(input_file: Path, out_dir: Path, aligner: str, workers: int | None):
+    """Align the sequences of the FASTA file with the aligner selected by get_alignment."""
+    index = fasta_index.FastaIndex(input_file)
+    records = [SeqRecord(Seq(sequence), id=name, name=name, description=index.header(name)) for name, sequence in index.records()]
+    instrumentation.count(isoforms=len(records))
 
     if len(records) == 1:
-        align = records
-    else:
-        # TODO: magic path for now, but this won't work with a proper library installation
-        #   - maybe do relative to __file__?
-        clustal_omega_path = '/home/hendraet/stud_sync/Studium/phd/proteomics/PROTzilla/backend/ptm-visualization/clustal-omega/clustalo-1.2.4-Ubuntu-x86_64'
-        cmd = f"{clustal_omega_path} \
-                --infile={padded_sequences_path} \
-                --outfile={aligned_fasta_path} \
-                --outfmt=fasta \
-                --iter=0 \
-                --force"
-        subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, text=True, check=True)
-        align = AlignIO.read(f"{aligned_fasta_path}", "fasta")
+        return records
+    clustal_omega_path = get_clustal_omega_path() if aligner != 'builtin' else None
+    if aligner == 'clustalo' and clustal_omega_path is None:
+        raise FileNotFoundError("Clustal Omega not found, set CLUSTAL_OMEGA or use the builtin aligner")
+    if clustal_omega_path is None:
+        # the builtin aligner loads numpy and the substitution matrix, so it is only imported when needed
+        from protein_sequencing import isoform_aligner
+        return isoform_aligner.align_isoforms(records, workers)
+    if workers == 1 or len(records) < 3:
+        return run_clustal_omega(records, clustal_omega_path, input_file, out_dir)
+    return run_clustal_omega_star(records, clustal_omega_path, out_dir, workers)
+
 
+@instrumentation.traced()
+def get_alignment(input_file: Path | str, out_dir: Path | str, aligner: str = 'auto', workers: int | None = 1) -> AlignIO.MultipleSeqAlignment:
+    """Align protein sequences using Clustal Omega or the in-process isoform aligner.
+    With aligner 'auto' Clustal Omega is used if it can be found, otherwise the builtin aligner.
+    With more than one worker (None for one worker per core) the isoforms are aligned pairwise against
+    the longest isoform in parallel and merged into a star alignment."""
+    if aligner not in ALIGNERS:
+        raise ValueError(f"Unknown aligner {aligner}, expected one of {', '.join(ALIGNERS)}")
+    if not isinstance(input_file, Path):
+        input_file = Path(input_file)
+    if not isinstance(out_dir, Path):
+        out_dir = Path(out_dir)
     if not out_dir.exists():
-        out_dir.mkdir(parents=True, exist_ok=True)
-    with (out_dir / 'aligned.fasta').open('w', encoding="utf-8") as f:
-        SeqIO.write(align, f, 'fasta')
+        os.makedirs(out_dir, exist_ok=True)
 
-    # clean up temporary files
-    if padded_sequences_path.exists():
-        padded_sequences_path.unlink()
-    if aligned_fasta_path.exists():
-        aligned_fasta_path.unlink()
+    if ALIGNMENT_CACHE is None:
+        align = align_records(input_file, out_dir, aligner, workers)
+    else:
+        stat = input_file.stat()
+        cache_key = (str(input_file.resolve()), stat.st_mtime_ns, stat.st_size, aligner, workers)
+        if cache_key not in ALIGNMENT_CACHE:
+            ALIGNMENT_CACHE[cache_key] = align_records(input_file, out_dir, aligner, workers)
+        align = ALIGNMENT_CACHE[cache_key]
+
+    # write to a temporary file first, so that concurrent runs in the same folder never read a partial alignment
+    tmp_file = out_dir / f'{ALIGNED_FASTA_NAME}.{os.getpid()}.tmp'
+    with tmp_file.open('w', encoding="utf-8") as f:
+        SeqIO.write(align, f, 'fasta')
+    os.replace(tmp_file, out_dir / ALIGNED_FASTA_NAME)
 
     return align
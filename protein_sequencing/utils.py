@@ -1,11 +1,12 @@
 """Utility functions for protein sequencing tool."""
 
 import importlib
+import math
+import re
 from collections import defaultdict
 from pathlib import Path
 
-import numpy as np
-import plotly.graph_objects as go
+from protein_sequencing import font_metrics, instrumentation, static_export
 
 CONFIG = importlib.import_module('configs.default_config', 'configs')
 
@@ -24,6 +25,27 @@ EXON_2_OFFSET = {'index_start': -1,
 
 ISOFORM_IDS = []
 
+# isoform segments of the sites, the rows of RESIDUE_PIXELS
+ISOFORM_SEGMENTS = ('general', 'exon1', 'exon2')
+# pixel coordinate of every (isoform segment, sequence position) along the sequence axis of the figure,
+# None until build_residue_pixels is called, so that importing utils does not load numpy
+RESIDUE_PIXELS = None
+# False for the positions that are out of range for an isoform segment
+RESIDUE_VALID = None
+
+
+def reset_layout():
+    """Reset the layout of the previous plot, so that several plots can be created in one process."""
+    global PIXELS_PER_AA, SEQUENCE_OFFSET, RESIDUE_PIXELS, RESIDUE_VALID
+    SEQUENCE_BOUNDARIES.update({'x0': 0, 'x1': 0, 'y0': 0, 'y1': 0})
+    PIXELS_PER_AA = 0
+    SEQUENCE_OFFSET = 0
+    for exon_offset in (EXON_1_OFFSET, EXON_2_OFFSET):
+        exon_offset.update({'index_start': -1, 'index_end': -1, 'pixel_start': -1, 'pixel_end': -1})
+    ISOFORM_IDS.clear()
+    RESIDUE_PIXELS = None
+    RESIDUE_VALID = None
+
 
 def get_width():
     """Return width of the plot, based on user settings in default_config.py."""
@@ -42,10 +64,8 @@ def get_height():
 def get_left_margin():
     """Return the left margin for the sequence plot.
     Calculated based on the longest label in the legend."""
-    longest_text = CONFIG.MODIFICATION_LEGEND_TITLE
-    for mod in CONFIG.MODIFICATIONS:
-        if len(CONFIG.MODIFICATIONS[mod][0]) > len(longest_text):
-            longest_text = CONFIG.MODIFICATIONS[mod][0]
+    longest_text = max([CONFIG.MODIFICATION_LEGEND_TITLE] + [label for label, _ in CONFIG.MODIFICATIONS.values()],
+                       key=get_label_length)
     return int((get_label_length(longest_text) / get_width() * 1.05) * get_width())
 
 
@@ -57,8 +77,12 @@ def get_top_margin():
 
 
 def get_label_length(label):
-    """Approximate the length of a label in pixels based on font size and label length."""
-    return int(CONFIG.FONT_SIZE / 1.5 * len(label))
+    """Return the length of a label in pixels, measured with the glyph widths of FONT (see font_metrics.py).
+    With TEXT_MEASUREMENT = 'approximate' every character counts as FONT_SIZE / 1.5 pixels."""
+    if getattr(CONFIG, 'TEXT_MEASUREMENT', 'font') == 'approximate':
+        return int(CONFIG.FONT_SIZE / 1.5 * len(label))
+    text = re.sub(r'<[^>]+>', '', str(label))
+    return math.ceil(font_metrics.text_width(text, CONFIG.FONT_SIZE, CONFIG.FONT, getattr(CONFIG, 'FONT_FILE', None)))
 
 
 def get_label_height():
@@ -83,6 +107,9 @@ def separate_by_group(groups_by_position_and_isoform):
 
 def different_possibilities_plot(width: int, height: int, different_possibilities: list[int]):
     """Debug option. Plot the different possibilities of the sequence in a heatmap."""
+    import numpy as np
+    import plotly.graph_objects as go
+
     rectangle = np.zeros((height, width))
     for i, value in enumerate(different_possibilities):
         rectangle[:, i] = value
@@ -98,19 +125,24 @@ def clean_up(out_dir):
             file_path.unlink()
 
 
+@instrumentation.traced()
 def finalize_plotting(fig, output_path, save_plot: bool = True, show_plot: bool = True):
     """Show the plot and save it as a .png and .svg file."""
+    instrumentation.count(traces=len(fig.data), shapes=len(fig.layout.shapes), annotations=len(fig.layout.annotations))
+    # remove the temporary files first, the saved figures stay in the output folder
+    clean_up(output_path)
     # TODO: hardcoded paths -.-
     if save_plot:
         output_svg = f"{output_path}/figure1.svg"
         output_png = f"{output_path}/figure1.png"
-        fig.write_image(output_png)
-        fig.write_image(output_svg)
+        export_backend = getattr(CONFIG, 'EXPORT_BACKEND', 'auto')
+        with instrumentation.span('write_image_png'):
+            static_export.write_image(fig, output_png, export_backend)
+        with instrumentation.span('write_image_svg'):
+            static_export.write_image(fig, output_svg, export_backend)
     if show_plot:
         fig.show()
 
-    clean_up(output_path)
-
 
 def get_position_with_offset(position, isoform):
     """Return the position in the rendering index based on sequence position and isoform."""
@@ -140,3 +172,45 @@ def offset_line_for_exon(line_position, aa_position, oritentation):
             line_position -= CONFIG.EXONS_GAP
 
     return line_position
+
+
+def build_residue_pixels(max_position: int):
+    """Compute the pixel coordinates of the sequence positions 0 to max_position for every isoform segment,
+    as get_position_with_offset and offset_line_for_exon do for a single position.
+    The coordinates are x in horizontal and y in vertical figures."""
+    global RESIDUE_PIXELS, RESIDUE_VALID
+    import numpy as np
+
+    positions = np.arange(max_position + 1)
+    exon_1_length = EXON_1_OFFSET['index_end'] - EXON_1_OFFSET['index_start'] + 1
+    exon_2_length = EXON_2_OFFSET['index_end'] - EXON_2_OFFSET['index_start'] + 1
+    after_exons = positions > max(EXON_1_OFFSET['index_end'], EXON_2_OFFSET['index_end'])
+    general = positions + after_exons * max(exon_1_length, exon_2_length)
+    rendering_index = np.stack([general, general, positions + exon_1_length])
+    RESIDUE_VALID = np.stack([np.ones_like(after_exons), ~after_exons, np.ones_like(after_exons)])
+
+    pixels = rendering_index * PIXELS_PER_AA + SEQUENCE_OFFSET
+    if EXON_1_OFFSET['index_start'] != -1:
+        exon_gaps = ((positions >= EXON_1_OFFSET['index_start']).astype(int)
+                     + (positions > EXON_1_OFFSET['index_end'])) * CONFIG.EXONS_GAP
+        pixels = pixels + exon_gaps
+    RESIDUE_PIXELS = pixels if CONFIG.FIGURE_ORIENTATION == 0 else get_height() - pixels
+
+
+def residue_pixels(positions, isoforms) -> list[int]:
+    """Return the pixel coordinates of the sites at sequence positions of isoforms along the sequence axis,
+    looked up in RESIDUE_PIXELS in one step."""
+    import numpy as np
+
+    positions = np.asarray(positions, dtype=int).reshape(-1)
+    if positions.size == 0:
+        return []
+    if RESIDUE_PIXELS is None or positions.max() >= RESIDUE_PIXELS.shape[1]:
+        build_residue_pixels(int(positions.max()))
+    # like get_position_with_offset, other isoforms than general and exon2 are limited to the exons
+    segments = np.array([{'general': 0, 'exon2': 2}.get(isoform, 1) for isoform in isoforms], dtype=int)
+    invalid = ~RESIDUE_VALID[segments, positions]
+    if invalid.any():
+        index = np.flatnonzero(invalid)[0]
+        raise ValueError(f"Position {positions[index]} is out of range for isoform {isoforms[index]}")
+    return RESIDUE_PIXELS[segments, positions].tolist()
@@ -4,10 +4,5 @@ FASTA_FILE = 'tests/test_data/input.fasta'
 ISOFORM_HELPER_DICT = {}
 GROUPS_CSV = 'tests/test_data/groups_mascot.csv'
 
-# this is the default path where the tool will safe the alignment
-# just change if you want to supply your own alignment
-# CAUTION: the alignment must match with the fasta file
-ALIGNED_FASTA_FILE = "tests/test_data/aligned.fasta"
-
 # Mascot
 MASCOT_INPUT_DIR = 'tests/test_data/mascot/'
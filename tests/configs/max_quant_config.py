@@ -4,11 +4,6 @@ FASTA_FILE = 'tests/test_data/input.fasta'
 ISOFORM_HELPER_DICT = {}
 GROUPS_CSV = 'tests/test_data/groups_max_quant.csv'
 
-# this is the default path where the tool will save the alignment
-# just change if you want to supply your own alignment
-# CAUTION: the alignment must match with the fasta file
-ALIGNED_FASTA_FILE = "tests/test_data/aligned.fasta"
-
 # MaxQuant
 MAX_QUANT_FILE = 'tests/test_data/max_quant/evidence.txt'
 THRESHOLD = 0.01
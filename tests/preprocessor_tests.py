@@ -1,8 +1,32 @@
 """Test the Mascot preprocessor."""
 
+import asyncio
+import importlib
+import json
+import os
+import pickle
+import pstats
+import random
+import shutil
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
 import pandas as pd
+import pytest
+from Bio import SeqIO
 
-from protein_sequencing.data_preprocessing.preprocessor import mascot, ms_fragger, protein_pilot, max_quant
+from benchmarks import preprocessor_benchmark
+from protein_sequencing import batch, exon_helper, figure_cache, font_metrics, instrumentation, isoform_aligner,\
+    profiling, render_server, sequence_plot, static_export, uniprot_align, utils
+from protein_sequencing.data_preprocessing import fasta_index, preprocessor_helper, proteome, sequence_store
+from protein_sequencing.data_preprocessing.mascot_preprocessor import read_mascot_rows
+from protein_sequencing.details_plot import DetailsPlotter
+from protein_sequencing.layout import Layout
+from protein_sequencing.overview_plot import OverviewPlotter
+from protein_sequencing.data_preprocessing.preprocessor import mascot, ms_fragger, protein_pilot, max_quant, merge
 
 
 def compare_files(file1, file2):
@@ -35,6 +59,14 @@ def test_process_mascot_dir():
     compare_files("tests/output/result_mascot.csv", "tests/results/expected_result_mascot.csv")
 
 
+def test_read_mascot_rows():
+    """Test that reloaded proteins and unquoted fields with ', ' are read as one row of the protein hits table."""
+    with open('tests/test_data/mascot_comma_in_field.csv', encoding='utf-8', newline='') as f:
+        peptides = [values for kind, values in read_mascot_rows(f) if kind == 'peptide']
+    # the row interrupted by the reload message and the row with a comma in the protein description
+    assert peptides == [('RLGPGTRL', 'Phospho (ST)', '0.00000400.0', 'P14136')] * 2
+
+
 def test_process_ms_fragger_file():
     """Test the process_ms_fragger_file function."""
 
@@ -75,3 +107,479 @@ def test_max_quant_file():
     compare_files("tests/output/result_max_quant_mods.csv", "tests/results/expected_result_max_quant_mods.csv")
     compare_files("tests/output/result_max_quant_cleavages.csv",
                   "tests/results/expected_result_max_quant_cleavages.csv")
+
+
+def test_sharded_max_quant():
+    """Test that the merged shards of a MaxQuant run give the result files of a single run."""
+    config = 'tests.configs.default_config'
+    preprocessor_config = 'tests.configs.max_quant_config'
+    shutil.rmtree('tests/output/shards', ignore_errors=True)
+    max_quant(config, preprocessor_config)
+    shutil.copy('tests/output/result_max_quant_mods.csv', 'tests/output/single_max_quant_mods.csv')
+    shutil.copy('tests/output/result_max_quant_cleavages.csv', 'tests/output/single_max_quant_cleavages.csv')
+
+    max_quant(config, preprocessor_config, (0, 2))
+    with pytest.raises(ValueError, match='1/2'):
+        merge('mq', config, preprocessor_config)
+    max_quant(config, preprocessor_config, (1, 2))
+    merge('mq', config, preprocessor_config)
+
+    assert compare_files('tests/output/result_max_quant_mods.csv', 'tests/output/single_max_quant_mods.csv')
+    assert compare_files('tests/output/result_max_quant_cleavages.csv', 'tests/output/single_max_quant_cleavages.csv')
+
+
+def test_proteome_max_quant(tmp_path):
+    """Test that a proteome run writes the result of a single run for every protein family of the evidence."""
+    fasta = Path('tests/test_data/input.fasta').read_text(encoding='utf-8')
+    (tmp_path / 'proteome.fasta').write_text(fasta + fasta.replace('P14136', 'Q99999').replace('GFAP', 'TEST'), encoding='utf-8')
+    lines = Path('tests/test_data/max_quant/evidence.txt').read_text(encoding='utf-8').splitlines(True)
+    (tmp_path / 'evidence.txt').write_text(''.join(lines + [line.replace('\tP14136\t', '\tQ99999\t') for line in lines[1:]]), encoding='utf-8')
+    config = SimpleNamespace(**{**proteome.config_values(importlib.import_module('tests.configs.default_config')),
+                                'OUTPUT_FOLDER': str(tmp_path / 'output')})
+    preprocessor_config = SimpleNamespace(**{**proteome.config_values(importlib.import_module('tests.configs.max_quant_config')),
+                                             'FASTA_FILE': str(tmp_path / 'proteome.fasta'),
+                                             'MAX_QUANT_FILE': str(tmp_path / 'evidence.txt')})
+    max_quant('tests.configs.default_config', 'tests.configs.max_quant_config')
+
+    results = proteome.run_proteome('mq', config, preprocessor_config)
+    assert [(result['family'], result['status'], result['rows']) for result in results] == [('P14136', 'ok', 9), ('Q99999', 'ok', 9)]
+    for family in ('P14136', 'Q99999'):
+        assert compare_files(tmp_path / 'output' / family / 'result_max_quant_mods.csv', 'tests/output/result_max_quant_mods.csv')
+        assert compare_files(tmp_path / 'output' / family / 'result_max_quant_cleavages.csv', 'tests/output/result_max_quant_cleavages.csv')
+
+    preprocessor_config.PROTEINS = ['Q99999-3', 'P10636']
+    results = proteome.run_proteome('mq', config, preprocessor_config)
+    assert [(result['family'], result['status']) for result in results] == [('P10636', 'error'), ('Q99999', 'ok')]
+
+
+def test_fasta_index(tmp_path):
+    """Test the faidx index and the random access to the sequences of wrapped and unevenly wrapped FASTA files."""
+    records = [(record.id, str(record.seq)) for record in SeqIO.parse('tests/test_data/input.fasta', 'fasta')]
+    fasta_index.write_fasta(records, tmp_path / 'wrapped.fasta')
+    shutil.copy('tests/test_data/input.fasta', tmp_path / 'uneven.fasta')
+    for fasta_file in (tmp_path / 'wrapped.fasta', tmp_path / 'uneven.fasta'):
+        index = fasta_index.FastaIndex(fasta_file)
+        assert index.records() == records
+        assert index.header('sp|P14136-3|GFAP_HUMAN') == 'sp|P14136-3|GFAP_HUMAN'
+        assert index.family_records('P14136') == records
+        assert index.accession_index() == {'P14136': 'P14136', 'P14136-3': 'P14136'}
+    assert (tmp_path / 'wrapped.fasta.fai').read_text(encoding='utf-8').splitlines() == \
+        ['sp|P14136|GFAP_HUMAN\t432\t22\t60\t61', 'sp|P14136-3|GFAP_HUMAN\t431\t486\t60\t61']
+
+
+def test_preprocessor_benchmark(tmp_path):
+    """Test that the benchmark runs a preprocessor on a tiny generated input."""
+    args = SimpleNamespace(experiments=2, rows=20, isoforms=None, mods_per_peptide=2, seed=0)
+    config, preprocessor_config, rows = preprocessor_benchmark.prepare('max_quant', tmp_path, args)
+    seconds, peak_rss, start_rss = preprocessor_benchmark.run_preprocessor('max_quant', config, preprocessor_config)
+
+    assert rows == 20
+    assert seconds > 0 and peak_rss >= start_rss
+    assert (tmp_path / 'output' / 'result_max_quant_mods.csv').exists()
+
+
+def test_sequence_store(tmp_path):
+    """Test that the memory-mapped sequence store serves the same headers as process_tau_file."""
+    fasta_file = 'tests/test_data/input.fasta'
+    aligned_fasta_file = 'tests/test_data/aligned.fasta'
+    expected = preprocessor_helper.process_tau_file(fasta_file, aligned_fasta_file)
+    headers = preprocessor_helper.load_isoform_headers(fasta_file, aligned_fasta_file, tmp_path / 'sequences.bin')
+
+    assert [(isoform, str(sequence), str(aligned)) for isoform, sequence, aligned in headers] == expected
+    assert pickle.loads(pickle.dumps(headers)) == headers
+    for (_, sequence, aligned), (_, expected_sequence, expected_aligned) in zip(headers, expected):
+        assert sequence.index('RLGPGT') == expected_sequence.index('RLGPGT')
+        assert 'NOTINSEQUENCE' not in sequence
+        assert aligned[-1] == expected_aligned[-1]
+
+    # an input file that changed without a newer mtime is detected by its size
+    store_file = tmp_path / 'sequences.bin'
+    shutil.copy(fasta_file, tmp_path / 'input.fasta')
+    shutil.copy(aligned_fasta_file, tmp_path / 'aligned.fasta')
+    preprocessor_helper.load_isoform_headers(tmp_path / 'input.fasta', tmp_path / 'aligned.fasta', store_file)
+    assert not sequence_store.is_outdated(store_file, tmp_path / 'input.fasta', tmp_path / 'aligned.fasta')
+    stat = (tmp_path / 'aligned.fasta').stat()
+    with (tmp_path / 'aligned.fasta').open('a', encoding='utf-8') as f:
+        f.write('>sp|P00000|TEST\n-MAAA\n')
+    os.utime(tmp_path / 'aligned.fasta', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert sequence_store.is_outdated(store_file, tmp_path / 'input.fasta', tmp_path / 'aligned.fasta')
+    # the mapping of the replaced store is closed
+    with pytest.raises(ValueError):
+        str(headers[0][1])
+
+
+def test_builtin_aligner(tmp_path):
+    """Test that the builtin aligner keeps the isoform sequences and finds the alternative exon."""
+    records = list(SeqIO.parse('tests/test_data/input.fasta', 'fasta'))
+    alignment = uniprot_align.get_alignment('tests/test_data/input.fasta', tmp_path, 'builtin')
+
+    assert [record.id for record in alignment] == [record.id for record in records]
+    for aligned, record in zip(alignment, records):
+        assert str(aligned.seq).replace('-', '') == str(record.seq)
+    exon_found, _, _, _, exon_1_isoforms, _, exon_2_isoforms, _, _, _ = exon_helper.retrieve_exon('tests/test_data/input.fasta', 5, tmp_path, 'builtin')
+    assert exon_found
+    assert exon_1_isoforms == ['P14136']
+    assert exon_2_isoforms == ['P14136-3']
+
+
+def write_isoform_family(fasta_file):
+    """Write the two GFAP isoforms of the fixture and two shortened isoforms, four isoforms in total."""
+    records = [(record.id, str(record.seq)) for record in SeqIO.parse('tests/test_data/input.fasta', 'fasta')]
+    sequence = records[0][1]
+    records += [('sp|P14136-4|GFAP_HUMAN', sequence[:100] + sequence[140:]), ('sp|P14136-5|GFAP_HUMAN', sequence[:300])]
+    fasta_index.write_fasta(records, fasta_file)
+    return records
+
+
+@pytest.mark.parametrize('aligner', ['builtin', 'clustalo'])
+def test_parallel_star_alignment(tmp_path, aligner):
+    """Test that the star alignment of four isoforms is the same with one and with several workers."""
+    records = write_isoform_family(tmp_path / 'isoforms.fasta')
+    if aligner == 'builtin':
+        serial = uniprot_align.get_alignment(tmp_path / 'isoforms.fasta', tmp_path / 'serial', 'builtin', 1)
+        parallel = uniprot_align.get_alignment(tmp_path / 'isoforms.fasta', tmp_path / 'parallel', 'builtin', 3)
+    else:
+        clustal_omega_path = uniprot_align.get_clustal_omega_path()
+        if clustal_omega_path is None:
+            pytest.skip('Clustal Omega not found')
+        # with one worker Clustal Omega aligns all isoforms at once, so the star alignment is compared directly
+        seq_records = list(SeqIO.parse(tmp_path / 'isoforms.fasta', 'fasta'))
+        serial = uniprot_align.run_clustal_omega_star(seq_records, clustal_omega_path, tmp_path, 1)
+        parallel = uniprot_align.run_clustal_omega_star(seq_records, clustal_omega_path, tmp_path, 3)
+
+    assert [(record.id, str(record.seq)) for record in parallel] == [(record.id, str(record.seq)) for record in serial]
+    assert [(record.id, str(record.seq).replace('-', '')) for record in parallel] == records
+
+
+def test_builtin_aligner_exon_blocks(tmp_path):
+    """Test the layout of divergent blocks on synthetic isoforms with an inserted and an exchanged exon."""
+    # the gap run goes where the fewest residues are identical, on ties at the end of the block
+    assert isoform_aligner.layout_block('KLMNPQ', 'KAB') == ('KLMNPQ', '---KAB')
+    assert isoform_aligner.layout_block('AA', 'AAAA') == ('AA--', 'AAAA')
+
+    rng = random.Random(1)
+    shared_1, shared_2, exon_1, exon_2 = (''.join(rng.choice('ACDEFGHIKLMNPQRSTVWY') for _ in range(length))
+                                          for length in (60, 80, 32, 21))
+    aligned_anchor, aligned_other = isoform_aligner.align_pair(shared_1 + exon_1 + shared_2, shared_1 + shared_2)
+    assert aligned_anchor == shared_1 + exon_1 + shared_2
+    assert aligned_other == shared_1 + '-' * len(exon_1) + shared_2
+
+    records = [('sp|Q00001|TEST', shared_1 + exon_1 + shared_2), ('sp|Q00001-2|TEST', shared_1 + exon_2 + shared_2),
+               ('sp|Q00001-3|TEST', shared_1 + shared_2)]
+    fasta_index.write_fasta(records, tmp_path / 'isoforms.fasta')
+    utils.reset_layout()
+    try:
+        exon_found, exon_start, exon_end, _, exon_1_isoforms, exon_1_length, exon_2_isoforms, exon_2_length, exon_none_isoforms, _ = \
+            exon_helper.retrieve_exon(tmp_path / 'isoforms.fasta', 5, tmp_path, 'builtin')
+    finally:
+        utils.reset_layout()
+    assert exon_found and (exon_start, exon_end) == (61, 93)
+    assert (exon_1_isoforms, exon_1_length, exon_2_isoforms, exon_2_length) == (['Q00001'], 32, ['Q00001-2'], 21)
+    assert exon_none_isoforms == ['Q00001-3']
+
+
+def test_instrumentation(tmp_path):
+    """Test that the stages of a preprocessor are recorded while tracing is enabled."""
+    instrumentation.enable()
+    try:
+        max_quant('tests.configs.default_config', 'tests.configs.max_quant_config')
+        instrumentation.write(tmp_path / 'trace.jsonl')
+    finally:
+        instrumentation.disable()
+    with (tmp_path / 'trace.jsonl').open(encoding='utf-8') as f:
+        recorded = [json.loads(line) for line in f]
+    spans = {span['name']: span for span in recorded}
+    assert {'retrieve_exon', 'MaxQuantPreprocessor.process_max_quant_file', 'write_results'} <= set(spans)
+    assert spans['write_results']['parent'] == 'MaxQuantPreprocessor.process_max_quant_file'
+    # the isoforms are aligned once, for the exon and the sites
+    assert [span['name'] for span in recorded].count('get_alignment') == 1
+    assert Path('tests/output/aligned.fasta').exists()
+    assert instrumentation.span('disabled') is instrumentation.NULL_SPAN
+
+
+def test_profiling(tmp_path, monkeypatch):
+    """Test that profiled runs write a profile and collapsed stacks and are aggregated."""
+    for _ in range(2):
+        profiling.run_profiled(lambda: max_quant('tests.configs.default_config', 'tests.configs.max_quant_config'),
+                               tmp_path, 'profile_mq', aggregate_file=tmp_path / 'all.prof')
+    assert (tmp_path / 'profile_mq.prof').exists()
+    with (tmp_path / 'profile_mq.collapsed').open(encoding='utf-8') as f:
+        stacks = [line.rsplit(' ', 1) for line in f]
+    assert any('process_max_quant_file' in stack for stack, _ in stacks)
+    assert all(int(microseconds) > 0 for _, microseconds in stacks)
+    stats = pstats.Stats(str(tmp_path / 'all.prof'))
+    assert any(calls == 2 for function, (_, calls, *_) in stats.stats.items() if function[2] == 'process_max_quant_file')
+    # the number of call paths is capped, the stacks with the most time are kept
+    monkeypatch.setattr(profiling, 'MAX_STACKS', 20)
+    stacks = profiling.cprofile_collapsed_stacks(pstats.Stats(str(tmp_path / 'profile_mq.prof')))
+    assert 0 < len(stacks) <= 20
+
+
+def test_render_server():
+    """Test that repeated render jobs give the same figure and reuse the alignment."""
+    uniprot_align.ALIGNMENT_CACHE = {}
+    try:
+        regions = [('N-Term', 72, 'A', 'N'), ('', 390, 'A', ''), ('α', 432, 'B', 'α'), ('ε', 431, 'A', 'ε')]
+        job = {'plot': 'overview', 'fasta': 'tests/test_data/input.fasta', 'config': 'tests.configs.default_config',
+               'config_overrides': {'REGIONS': regions}, 'plot_config': 'configs.default_overview',
+               'input': 'tests/results/expected_result_max_quant_mods.csv', 'format': 'json'}
+        figure, content_type = render_server.render(job)
+        assert content_type == 'application/json'
+        assert render_server.render(job)[0] == figure
+        assert len(uniprot_align.ALIGNMENT_CACHE) == 1
+        assert len(json.loads(figure)['data']) > 0
+    finally:
+        uniprot_align.ALIGNMENT_CACHE = None
+
+
+def test_render_server_restrictions(tmp_path):
+    """Test that the server only loads config modules of its config packages, only reads inside its input root
+    and only writes inside its output root."""
+    job = {'plot': 'overview', 'fasta': 'tests/test_data/input.fasta', 'config': 'tests.configs.default_config',
+           'plot_config': 'configs.default_overview', 'input': 'tests/results/expected_result_max_quant_mods.csv',
+           'format': 'json', 'output_file': str(tmp_path / 'figure.json')}
+    render_server.CONFIG_PACKAGES = ('configs', 'tests.configs')
+    render_server.INPUT_ROOT = Path('tests').resolve()
+    render_server.OUTPUT_ROOT = tmp_path.resolve()
+    try:
+        assert render_server.check_job(job)[0] == 'json'
+        render_server.load_job_configs({**job, 'config': '.default_config'})
+        for config in ({'config': 'os'}, {'plot_config': 'protein_sequencing.render_server'}, {'config': 'configs_x.default'}):
+            with pytest.raises(render_server.RenderError) as e:
+                render_server.load_job_configs({**job, **config})
+            assert e.value.status == 403
+        for output_file in (str(tmp_path / '..' / 'figure.json'), '/etc/figure.json', 'figure.json'):
+            with pytest.raises(render_server.RenderError) as e:
+                render_server.check_job({**job, 'output_file': output_file})
+            assert e.value.status == 403
+        for input_file in ({'fasta': '/etc/passwd'}, {'input': 'tests/../README.md'}):
+            with pytest.raises(render_server.RenderError) as e:
+                render_server.check_job({**job, **input_file})
+            assert e.value.status == 403
+    finally:
+        render_server.CONFIG_PACKAGES = None
+        render_server.INPUT_ROOT = None
+        render_server.OUTPUT_ROOT = None
+
+
+def test_batch():
+    """Test that a batch renders its jobs and reports failed jobs without stopping."""
+    regions = [('N-Term', 72, 'A', 'N'), ('', 390, 'A', ''), ('α', 432, 'B', 'α'), ('ε', 431, 'A', 'ε')]
+    job = {'plot': 'overview', 'fasta': 'tests/test_data/input.fasta', 'config': 'tests.configs.default_config',
+           'config_overrides': {'REGIONS': regions}, 'plot_config': 'configs.default_overview',
+           'input': 'tests/results/expected_result_max_quant_mods.csv', 'format': 'json'}
+    jobs = [{**job, 'output_file': 'tests/output/batch/overview_1.json'},
+            {**job, 'plot': 'unknown', 'output_file': 'tests/output/batch/unknown.json'},
+            {**job, 'output_file': 'tests/output/batch/overview_2.json'}]
+    results = asyncio.run(batch.run_jobs(jobs, workers=2))
+    assert [result['status'] for result in results] == ['ok', 'error', 'ok']
+    with open('tests/output/batch/overview_1.json', encoding='utf-8') as f1, \
+            open('tests/output/batch/overview_2.json', encoding='utf-8') as f2:
+        assert f1.read() == f2.read()
+    # a worker that finishes after the deadline of its job writes nothing
+    with open('tests/output/batch/overview_1.json', encoding='utf-8') as f:
+        figure_json = f.read()
+    with pytest.raises(TimeoutError):
+        batch.export_job(figure_json, 'json', 'tests/output/batch/late.json', deadline=time.time() - 1)
+    assert sorted(os.listdir('tests/output/batch')) == ['overview_1.json', 'overview_2.json']
+
+
+def test_figure_cache():
+    """Test that rendered figures are served from the figure cache and the least recently used are evicted."""
+    regions = [('N-Term', 72, 'A', 'N'), ('', 390, 'A', ''), ('α', 432, 'B', 'α'), ('ε', 431, 'A', 'ε')]
+    job = {'plot': 'overview', 'fasta': 'tests/test_data/input.fasta', 'config': 'tests.configs.default_config',
+           'config_overrides': {'REGIONS': regions}, 'plot_config': 'configs.default_overview',
+           'input': 'tests/results/expected_result_max_quant_mods.csv', 'format': 'json'}
+    cache = figure_cache.FigureCache('tests/output/figure_cache')
+    render_server.FIGURE_CACHE = cache
+    create_figure = render_server.create_figure
+    try:
+        figure, _ = render_server.render(job)
+        key = render_server.job_key(job, *render_server.load_job_configs(job))
+        assert cache.get(key, 'json') == figure
+        # a changed setting is a different figure
+        changed_job = {**job, 'plot_config_overrides': {'SEQUENCE_MIN_LINE_LENGTH': 30}}
+        assert render_server.job_key(changed_job, *render_server.load_job_configs(changed_job)) != key
+
+        def fail(*_):
+            raise AssertionError('cached figure rendered again')
+        render_server.create_figure = fail
+        assert render_server.render(job)[0] == figure
+    finally:
+        render_server.create_figure = create_figure
+        render_server.FIGURE_CACHE = None
+
+    small_cache = figure_cache.FigureCache('tests/output/figure_cache', max_size_mb=2.5 * len(figure) / 1024 / 1024)
+    small_cache.put('a' * 64, 'json', figure)
+    small_cache.put('b' * 64, 'json', figure)
+    assert small_cache.get('a' * 64, 'json') == figure
+    small_cache.put('c' * 64, 'json', figure)
+    # b was used least recently
+    assert small_cache.get('b' * 64, 'json') is None
+    assert small_cache.get('a' * 64, 'json') == figure
+    assert small_cache.get('c' * 64, 'json') == figure
+    # a figure larger than the cache is kept, the older ones are removed
+    figure_cache.FigureCache('tests/output/figure_cache', max_size_mb=0.5 * len(figure) / 1024 / 1024).put('d' * 64, 'json', figure)
+    assert small_cache.get('d' * 64, 'json') == figure
+    assert small_cache.get('a' * 64, 'json') is None and small_cache.get('c' * 64, 'json') is None
+
+
+def test_details_heatmap_bins():
+    """Test the group means of the details heatmap and the merging of narrow sites."""
+    df = pd.DataFrame([['', '', 'Phospho', 'Phospho', 'Phospho'], ['', '', 'S1', 'S2', 'T3'], ['', '', 'general', 'general', 'general'],
+                       ['s1', 'CTR', '1', '0', '1'], ['s2', 'CTRL', '0', None, '1'], ['s3', 'AD', '1', '1', '0'], ['s4', 'other', '1', '1', '1']])
+    plot_config = SimpleNamespace(GROUPS={'CTRL': (['CTRL', 'CTR'], '#4DAF4A'), 'AD': (['AD'], '#E41A1C'), 'PSP': (['PSP'], '#FF7F00')},
+                                  HEATMAP_MIN_CELL_PIXELS=10)
+    plotter = DetailsPlotter(None, plot_config, None, 'tests/output')
+    mean_values, groups, labels = plotter.preprocess_groups(df)
+    assert groups == ['CTRL', 'AD', 'PSP'] and labels == ['S1', 'S2', 'T3']
+    np.testing.assert_array_equal(mean_values, [[0.5, 0.0, 1.0], [1.0, 1.0, 0.0], [np.nan, np.nan, np.nan]])
+
+    cells, edges = plotter.bin_sites(mean_values, 12)
+    assert cells is mean_values and edges.tolist() == [0, 1, 2, 3]
+    cells, edges = plotter.bin_sites(mean_values, 5)
+    assert edges.tolist() == [0, 2, 3]
+    np.testing.assert_array_equal(cells, [[0.25, 1.0], [1.0, 0.0], [np.nan, np.nan]])
+
+
+def test_details_narrow_cleavages(tmp_path):
+    """Test that a cleavage file with more columns than fit the font merges heatmap cells and leaves out labels."""
+    positions = [str(position) for position in range(1, 301)]
+    rows = [['', ''] + ['Non-Tryptic'] * len(positions), ['', ''] + positions, ['', ''] + ['general'] * len(positions)]
+    rows += [[sample, group] + [str((i + len(sample)) % 3 / 2) for i in range(len(positions))]
+             for sample, group in (('s1', 'Clean'), ('s02', 'Old'), ('s003', 'Clean'))]
+    pd.DataFrame(rows, columns=['ID', 'Group'] + [f'{position}_general' for position in positions]).to_csv(tmp_path / 'cleavages.csv', index=False)
+    regions = [('N-Term', 72, 'A', 'N'), ('', 390, 'A', ''), ('α', 432, 'B', 'α'), ('ε', 431, 'A', 'ε')]
+    job = {'plot': 'details', 'fasta': 'tests/test_data/input.fasta', 'config': 'tests.configs.default_config',
+           'config_overrides': {'REGIONS': regions},
+           'plot_config_overrides': {'GROUPS': {'Clean': [['Clean'], '#4DAF4A'], 'Old': [['Old'], '#17DFFF']},
+                                     'INPUT_FILES': {'A': ['Cleavage', str(tmp_path / 'cleavages.csv')]}}}
+    with pytest.warns(UserWarning, match='cleavage labels are left out'):
+        fig = render_server.create_figure(job, *render_server.load_job_configs(job))
+
+    labels = [annotation.text for annotation in fig.layout.annotations if annotation.text in positions]
+    assert 0 < len(labels) < len(positions) and labels[0] == '1'
+    heatmaps = [trace for trace in fig.data if trace.type == 'heatmap' and trace.x is not None]
+    # both regions are drawn with merged cells
+    assert len(heatmaps) == 2 and sum(len(heatmap.z[0]) for heatmap in heatmaps) < len(positions)
+
+
+def test_details_too_many_ptms(tmp_path):
+    """Test that PTMs narrower than a pixel are reported instead of drawn on top of each other."""
+    positions = range(1, 301)
+    rows = [['', ''] + ['Phospho'] * len(positions), ['', ''] + [f'S{position}' for position in positions],
+            ['', ''] + ['general'] * len(positions)]
+    rows += [[sample, group] + ['1'] * len(positions) for sample, group in (('s1', 'CTRL'), ('s2', 'AD'))]
+    pd.DataFrame(rows, columns=['ID', 'Group'] + [f'Phospho(S)@{position}_general' for position in positions]).to_csv(tmp_path / 'ptms.csv', index=False)
+    regions = [('N-Term', 72, 'A', 'N'), ('', 390, 'A', ''), ('α', 432, 'B', 'α'), ('ε', 431, 'A', 'ε')]
+    job = {'plot': 'details', 'fasta': 'tests/test_data/input.fasta', 'config': 'tests.configs.default_config',
+           'config_overrides': {'REGIONS': regions, 'FIGURE_WIDTH': 400},
+           'plot_config_overrides': {'INPUT_FILES': {'A': ['PTM', str(tmp_path / 'ptms.csv')]}}}
+    with pytest.raises(ValueError, match='PTMs do not fit'):
+        render_server.create_figure(job, *render_server.load_job_configs(job))
+
+
+def test_details_region_index():
+    """Test the assignment of sites to regions, sites of an exon isoform belong to the region of the exon."""
+    config = SimpleNamespace(REGIONS=[('N-Term', 72, 'A', 'N'), ('', 390, 'A', ''), ('α', 432, 'B', 'α'), ('ε', 431, 'A', 'ε'),
+                                      ('C-Term', 441, 'A', 'C')])
+    plotter = DetailsPlotter(config, None, None, 'tests/output')
+    utils.EXON_1_OFFSET.update({'index_start': 391, 'index_end': 432})
+    utils.EXON_2_OFFSET.update({'index_start': 391, 'index_end': 431})
+    try:
+        positions = [1, 72, 73, '7-9', 400, 420, 409, 433, 441]
+        isoforms = ['general', 'general', 'general', 'general', 'exon1', 'exon1', 'exon2', 'general', 'general']
+        starts = [int(str(position).split('-')[0]) for position in positions]
+        assert plotter.get_site_regions(starts, isoforms).tolist() == [0, 0, 1, 0, 2, 2, 3, 4, 4]
+        assert plotter.get_present_regions(positions[3:7], isoforms[3:7]) == [True, False, True, True, False]
+    finally:
+        utils.reset_layout()
+
+
+def test_details_label_rows():
+    """Test the packing of PTM labels into rows and the overlap once all rows are taken."""
+    plotter = DetailsPlotter(None, None, None, 'tests/output')
+    rows, overlapping = plotter.pack_label_rows(np.arange(6) * 20, 14, 3)
+    assert rows.tolist() == [0, 0, 0, 0, 0, 0] and overlapping == 0
+    rows, overlapping = plotter.pack_label_rows(np.arange(6) * 5, 14, 3)
+    assert rows.tolist() == [0, 1, 2, 0, 1, 2] and overlapping == 0
+    rows, overlapping = plotter.pack_label_rows(np.array([0, 20, 5, 10]), 14, 2)
+    assert rows.tolist() == [0, 1, 1, 0] and overlapping == 1
+
+
+def test_native_svg_export():
+    """Test that the native backend writes the figures as SVG without kaleido."""
+    regions = [('N-Term', 72, 'A', 'N'), ('', 390, 'A', ''), ('α', 432, 'B', 'α'), ('ε', 431, 'A', 'ε')]
+    job = {'plot': 'overview', 'fasta': 'tests/test_data/input.fasta', 'config': 'tests.configs.default_config',
+           'config_overrides': {'REGIONS': regions, 'EXPORT_BACKEND': 'native'}, 'plot_config': 'configs.default_overview',
+           'input': 'tests/results/expected_result_max_quant_mods.csv', 'format': 'svg'}
+    figure, content_type = render_server.render(job)
+    assert content_type == 'image/svg+xml'
+    root = ET.fromstring(figure)
+    config = render_server.load_job_configs(job)[0]
+    assert (root.get('width'), root.get('height')) == (str(config.FIGURE_WIDTH), str(config.FIGURE_HEIGHT))
+    namespace = '{http://www.w3.org/2000/svg}'
+    assert root.findall(f'.//{namespace}text') and root.findall(f'.//{namespace}rect')
+
+    heatmap = {'data': [{'type': 'heatmap', 'z': [[0, 1], [None, 0.5]], 'colorscale': [[0, '#ffffff'], [1, '#000000']],
+                         'showscale': False}],
+               'layout': {'width': 20, 'height': 20, 'margin': {'l': 0, 'r': 0, 't': 0, 'b': 0},
+                          'xaxis': {'range': [-0.5, 1.5]}, 'yaxis': {'range': [-0.5, 1.5]}}}
+    cells = ET.fromstring(static_export.figure_to_svg(heatmap)).findall(f'{namespace}g/{namespace}rect')
+    # the missing value is not drawn
+    assert [cell.get('fill') for cell in cells] == ['rgb(255,255,255)', 'rgb(0,0,0)', 'rgb(128,128,128)']
+
+
+def test_layout_geometry():
+    """Test that the layout of a plot holds the geometry of the figure as arrays."""
+    regions = [('N-Term', 72, 'A', 'N'), ('', 390, 'A', ''), ('α', 432, 'B', 'α'), ('ε', 431, 'A', 'ε')]
+    job = {'plot': 'overview', 'fasta': 'tests/test_data/input.fasta', 'config': 'tests.configs.default_config',
+           'config_overrides': {'REGIONS': regions}, 'plot_config': 'configs.default_overview',
+           'input': 'tests/results/expected_result_max_quant_mods.csv'}
+    config, plot_config = render_server.load_job_configs(job)
+    sequence_plot.CONFIG = config
+    utils.CONFIG = config
+    layout = OverviewPlotter(config, plot_config, job['fasta'], 'tests/output/layout').create_overview_layout()
+    fig = layout.to_figure()
+    assert fig.to_json() == render_server.create_figure(job, config, plot_config).to_json()
+    assert json.loads(layout.to_figure(validate=True).to_json()) == json.loads(fig.to_json())
+    # invalid properties are left out, unless the figure is validated
+    invalid = Layout().add_annotation(x=0, y=0, text='invalid', textangel=90)
+    assert invalid.to_figure().layout.annotations[0].text == 'invalid'
+    with pytest.raises(ValueError):
+        invalid.to_figure(validate=True)
+
+    geometry = layout.geometry()
+    assert geometry['size'] == (config.FIGURE_WIDTH, config.FIGURE_HEIGHT)
+    assert geometry['regions']['start'].tolist() == [1, 73, 391, 391]
+    assert geometry['regions']['end'].tolist() == [72, 390, 432, 431]
+    text_traces = sum(trace.mode == 'text' for trace in fig.data)
+    assert len(geometry['labels']) == len(fig.layout.annotations) + text_traces
+    assert len(geometry['paths']['offsets']) == len(fig.data) - text_traces + 1
+
+    # the residue table matches the position helpers for every site
+    for segment, isoform in enumerate(utils.ISOFORM_SEGMENTS):
+        for position in range(1, geometry['residues'].shape[1]):
+            try:
+                expected = utils.offset_line_for_exon(utils.get_position_with_offset(position, isoform) * utils.PIXELS_PER_AA
+                                                      + utils.SEQUENCE_OFFSET, position, config.FIGURE_ORIENTATION)
+            except ValueError:
+                with pytest.raises(ValueError):
+                    utils.residue_pixels([position], [isoform])
+                continue
+            assert geometry['residues'][segment, position] == expected
+            assert utils.residue_pixels([position], [isoform]) == [expected]
+
+
+def test_font_metrics():
+    """Test the measured label widths and the approximation of earlier versions."""
+    assert font_metrics.text_width('S202', 12, 'No Such Font') == (667 + 3 * 556) * 12 / 1000
+    assert font_metrics.text_width('α', 10, 'No Such Font') == font_metrics.DEFAULT_WIDTH * 10 / 1000
+    config = utils.CONFIG
+    try:
+        utils.CONFIG = SimpleNamespace(FONT='No Such Font', FONT_SIZE=12)
+        assert utils.get_label_length('<b>T35</b>') == 21
+        utils.CONFIG.TEXT_MEASUREMENT = 'approximate'
+        assert utils.get_label_length('T35') == 24
+    finally:
+        utils.CONFIG = config